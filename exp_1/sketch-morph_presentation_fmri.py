@@ -5,27 +5,58 @@
 
 # Optionally supply DBIC ID, accession number, and participant number:
 #   python actions_presentation.py <DBIC ID> <accession number> <participant_number> <run_number>
-# Command line arguments must be in order!
+# Command line arguments must be in order! Given arguments skip the run
+# configuration dialog.
 
 # TODO: localizer
 
 import sys
-import time
-import serial
-import pandas as pd
-import numpy as np
 from os import makedirs
 from os.path import join, exists, abspath, dirname
-from psychopy import visual, core, event, gui, logging, sound
-from psychopy.constants import (NOT_STARTED, STARTED, PLAYING, PAUSED,
-                                STOPPED, FINISHED, PRESSED, RELEASED, FOREVER)
 
-# Set up GUI for inputing participant/run information (with defaults)
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from sketch_fmri.startup import ImportTimer
+
+# heavy imports are timed so slow startups can be pinned down, the dialog
+# (wx) and serial modules are only imported when they are used
+import_times = ImportTimer()
+with import_times('numpy'):
+    import numpy as np
+with import_times('psychopy'):
+    from psychopy import visual, core, event, logging
+    from psychopy.constants import (NOT_STARTED, STARTED, PLAYING, PAUSED,
+                                    STOPPED, FINISHED, PRESSED, RELEASED,
+                                    FOREVER)
+with import_times('sketch_fmri'):
+    from sketch_fmri.atlas import TextureAtlas
+    from sketch_fmri.bidsevents import EventsWriter
+    from sketch_fmri.clipcache import ClipCache
+    from sketch_fmri.composite import Compositor
+    from sketch_fmri.drift import DriftCorrector
+    from sketch_fmri.fliplog import FlipRecorder
+    from sketch_fmri.framesched import FrameScheduler, measure_frame_period
+    from sketch_fmri.inputbus import InputBus
+    from sketch_fmri.phases import Segment, run_segments, to_frames, with_dim
+    from sketch_fmri.prefetch import Prefetcher
+    from sketch_fmri.rawmovie import movie_stim
+    from sketch_fmri.schedule import load_run
+    from sketch_fmri.serialreader import SerialReader
+    from sketch_fmri.session import current_session
+    from sketch_fmri.volumes import VolumeClock
+    from sketch_fmri.waiter import shared_waiter
+
+# a script started on its own is a session of one run, python -m
+# sketch_fmri.session plays several runs in one process and keeps the window
+# and stimulus caches open between them
+session = current_session()
+
+# Take participant/run information from the command line, or from a GUI
+# (with defaults) when none was given
 if len(sys.argv) > 1:
     DBIC_ID = sys.argv[1]
     accession = sys.argv[2]
     participant = sys.argv[3]
-    run = sys.argv[4]
+    run = int(sys.argv[4])
 else:
     #DBIC_ID = "e.g., SID000001"
     #accession = "e.g., A000001"
@@ -35,41 +66,44 @@ else:
     participant = "00"
     run = "00"
 
-run_configuration = gui.Dlg(title='Run configuration')
-run_configuration.addField("DBIC ID:", DBIC_ID)
-run_configuration.addField("Scan accession number:", accession)
-run_configuration.addField("Participant:", participant)
-run_configuration.addField("Run number:", run)
-run_configuration.show()
-
-if run_configuration.OK:
-    DBIC_ID = run_configuration.data[0]
-    accession = run_configuration.data[1]
-    participant = str(run_configuration.data[2])
-    run = int(run_configuration.data[3])
-elif not run_configuration.OK:
-    core.quit()
+    with import_times('psychopy.gui'):
+        from psychopy import gui
+    run_configuration = gui.Dlg(title='Run configuration')
+    run_configuration.addField("DBIC ID:", DBIC_ID)
+    run_configuration.addField("Scan accession number:", accession)
+    run_configuration.addField("Participant:", participant)
+    run_configuration.addField("Run number:", run)
+    run_configuration.show()
+
+    if run_configuration.OK:
+        DBIC_ID = run_configuration.data[0]
+        accession = run_configuration.data[1]
+        participant = str(run_configuration.data[2])
+        run = int(run_configuration.data[3])
+    elif not run_configuration.OK:
+        core.quit()
 
 # Start PsychoPy's clock (mostly for logging)
 run_clock = core.Clock()
 
+# button box / keyboard codes: 1 = yellow button (object repeated),
+# 2 = blue button (fixation dimmed), 5 = scanner trigger
+RESPONSE_KEYS = {'1': '1', '2': '2', '5': 'scanner_trigger'}
 
-# Add a new logging level name called bids
-# we will use this level to log information that will be saved
-# in the _events.tsv file for this run
-BIDS = 26
-logging.addLevel(BIDS, 'BIDS')
+# photo trials: (start, end, photo on screen) in seconds from trial onset, the
+# photo is shown three times and nudged to a new position before each repeat
+PHOTO_LAYOUT = [(0.0, 0.5, False), (0.5, 2.0, True), (2.0, 2.5, False),
+                (2.5, 4.0, True), (4.0, 4.5, False), (4.5, 6.0, True)]
+FIX_DIM_DURATION = 0.3
 
-def logbids(msg, t=None, obj=None):
-    """logbids(message)
-    logs a BIDS related message
-    """
-    logging.root.log(msg, level=BIDS, t=t, obj=obj)
+# a trial that starts late keeps the next onset on time: a clip is cut at
+# its planned end, other trials skip what was due while they were late
+OVERRUN_POLICIES = {'sketch': 'truncate'}
 
-# BIDS TEMPLATE
-logbids("onset\tduration\tstim_type\tstim_fn\trepetition")
-template_bids = '{onset:.3f}\t{duration:.3f}\t{stim_type}\t{stim_fn}\t' \
-                    '{repeat}'
+# scanner TR in seconds; onsets are placed on the volume clock fitted to the
+# TR pulses, or with RESYNC_TO_VOLUMES off in seconds since the first pulse
+TR = 2.
+RESYNC_TO_VOLUMES = True
 
 # Set up all the relevant directories here
 HERE = abspath(dirname(__file__))
@@ -84,12 +118,19 @@ logging.setDefaultClock(run_clock)
 log = logging.LogFile(f=join("res", 'log_p{:02d}_r{:02d}.txt'.format(
                 int(participant), int(run))), level=logging.INFO,
                 filemode='w')
+for line in import_times.report():
+    logging.info('startup: ' + line)
+
+# BIDS events go to their own _events.tsv next to the log, written by a
+# background thread so the frame loops only queue raw rows
+events = EventsWriter(join(RESDIR, 'sub-{:02d}_run-{:02d}_events.tsv'.format(
+                      int(participant), int(run))),
+                      ('onset', 'duration', 'stim_type', 'stim_fn', 'repetition'),
+                      ('{:.3f}', '{:.3f}', '{}', '{}', '{}'))
 
-# Load in events / trial order
-trials_file = join(CSVDIR,'Sub{:02d}_Run{:02d}.csv'.format(
-                         int(participant), int(run)))
-trials = pd.read_csv(trials_file)
-assert trials.shape[0] == 48
+# Load in events / trial order, from runs/study.npz if it has been packed
+trials = load_run(CSVDIR, participant, run)
+assert len(trials) == 48
 
 # Open window and wait for first scanner trigger
 
@@ -98,8 +139,15 @@ assert trials.shape[0] == 48
 #                     colorSpace='rgb255', name='Window')
 
 # for testing
-win = visual.Window([1680,1050], screen=0, fullscr=True, color=(128,128,128),
-                    colorSpace='rgb255', name='Window')
+win = session.keep('win', lambda: visual.Window(
+    [1680,1050], screen=0, fullscr=True, color=(128,128,128),
+    colorSpace='rgb255', name='Window'))
+
+# onsets and durations are scheduled in frames of the measured refresh period
+frame_period = session.keep('frame_period', lambda: measure_frame_period(win))
+logging.info('measured frame period is {0:.5f} s'.format(frame_period))
+# how late the OS wakes from a sleep is learned now, not after the trigger
+waiter = shared_waiter()
 
 # # fixation crosses
 # fixation = visual.TextStim(win, pos=(0, 0), text="+", name="Fixation",
@@ -109,12 +157,27 @@ win = visual.Window([1680,1050], screen=0, fullscr=True, color=(128,128,128),
 
 # concentric circles for fixation
 fixation_fn = join(HERE, 'fixation_green_thumb.png')
-fixation = visual.ImageStim(win, fixation_fn, name='Fixation', colorSpace='rgb', autoLog=True)
+fixation = session.keep('fixation', lambda: visual.ImageStim(
+    win, fixation_fn, name='Fixation', colorSpace='rgb', autoLog=True))
 fixation_dark_fn = join(HERE, 'fixation_green_dark_thumb.png')
-fixation_dark = visual.ImageStim(win, fixation_dark_fn, name='Fixation_dark', colorSpace='rgb', autoLog=True)
-
-# load stimuli
-stimuli = {}
+fixation_dark = session.keep('fixation_dark', lambda: visual.ImageStim(
+    win, fixation_dark_fn, name='Fixation_dark', colorSpace='rgb', autoLog=True))
+
+# the fixation is baked into the clips it is drawn on, and drawn along with
+# the photos from their atlas, so those frames are one draw
+compositor = session.keep('compositor', lambda: Compositor(
+    win, [(fixation, fixation_fn), (fixation_dark, fixation_dark_fn)]))
+
+# load trial info, the stimuli themselves are built just in time a few trials
+# ahead of the one on screen (repeated clips share one decoder, and clips
+# transcoded with `python -m sketch_fmri.rawclip stim` play from
+# memory-mapped frames)
+clips = session.keep('clips', lambda: ClipCache(
+    win, movie_class=movie_stim, pos=(0, 0), flipVert=False,
+    flipHoriz=False, loop=False, noAudio=True))
+trial_objs = []
+stim_numbers = []
+stim_types = []
 repeats = []
 durations = []
 trial_jitters = []
@@ -127,35 +190,110 @@ load_disp = visual.TextStim(win, text=load_text,
 load_disp.draw()
 win.flip()
 
-for trial in range(trials.shape[0]):
-    trial_obj = trials.loc[trial,'ObjectID']    # object category
-    stim_number = trials.loc[trial,'StimNo']    # which exemplar
-    stim_type = trials.loc[trial,'StimType']    # 'sketch' or 'photo'
-    repeat = trials.loc[trial,'Repeat']         # is this a repeat of last trial
-    repeats.append(repeat)
-    onsets.append(trials.loc[trial,'Onset'])
-    durations.append(trials.loc[trial,'Duration'])
-    trial_jitters.append(trials.loc[trial,'Jitter'])
-    fixation_change.append(trials.loc[trial,'FixChange'])
+for trial in range(len(trials)):
+    stim_type = trials['StimType'][trial]    # 'sketch' or 'photo'
+    trial_objs.append(trials['ObjectID'][trial])     # object category
+    stim_numbers.append(trials['StimNo'][trial])     # which exemplar
+    stim_types.append(stim_type)
+    repeats.append(trials['Repeat'][trial])  # is this a repeat of last trial
+    onsets.append(trials['Onset'][trial])
+    durations.append(trials['Duration'][trial])
+    trial_jitters.append(trials['Jitter'][trial])
+    fixation_change.append(trials['FixChange'][trial])
+    if stim_type not in ['fixation', 'photo', 'sketch']:
+        print('unknown stimulus type...')
+        win.close()
+        core.quit()
+
+def clip_path(trial_obj, stim_number):
+    """clip_path(trial_obj, stim_number)
+    the sketch clip of this object and exemplar
+    """
+    return join(STIMDIR, trial_obj+'_'+str(stim_number)+'_6s.mov')
+
+def photo_path(trial_obj, stim_number):
+    """photo_path(trial_obj, stim_number)
+    the photographic image of this object and exemplar
+    """
+    return join(STIMDIR, trial_obj+'_'+str(stim_number)+'.png')
+
+# every photo of the run and the fixation are packed into one texture and
+# uploaded once, a photo with the fixation on it is then a single draw
+photo_fns = [photo_path(trial_objs[trial], stim_numbers[trial])
+             for trial in range(len(trials)) if stim_types[trial] == 'photo']
+if photo_fns:
+    atlas = TextureAtlas(win, photo_fns + [fixation_fn, fixation_dark_fn])
+else:
+    atlas = None
+
+def load_stimulus(trial):
+    """load_stimulus(trial)
+    builds the stimulus shown in this trial
+    """
+    trial_obj = trial_objs[trial]
+    stim_number = stim_numbers[trial]
     print("Loading {0}".format(trial_obj))
+    if stim_types[trial] == 'fixation':
+        return fixation
+    elif stim_types[trial] == 'photo':
+        # the photographic image, from the atlas
+        return atlas.stim(photo_path(trial_obj, stim_number), name=trial_obj)
+    else:
+        # load the sketch video
+        return clips.get(clip_path(trial_obj, stim_number), name=trial_obj)
+
+def compile_trial(trial):
+    """compile_trial(trial)
+    loads the stimulus for this trial and lays the trial out as segments,
+    returns (stimulus, segments in frames, time of fixation change or None)
+    """
+    stimulus = load_stimulus(trial)
+    stim_type = stim_types[trial]
     if stim_type == 'fixation':
-        stimuli[trial] = fixation
+        segments = [Segment(0., durations[trial], (fixation,),
+                            log=('fixation trial start',))]
+        time_fix_change = .5+5*np.random.uniform()
     elif stim_type == 'photo':
-        # load the photographic image
-        img_fn = join(STIMDIR, trial_obj+'_'+str(stim_number)+'.png')
-        stimuli[trial] = visual.ImageStim(win, img_fn, name=trial_obj,
-                                    autoLog=True)
-    elif stim_type == 'sketch':
-        # load the sketch video
-        clip_fn = join(STIMDIR, trial_obj+'_'+str(stim_number)+'_6s.mov')
-        stimuli[trial] = visual.MovieStim3(win, clip_fn,
-                                    pos=(0, 0), flipVert=False,
-                                    flipHoriz=False, loop=False,
-                                    noAudio=True, name=trial_obj)
+        segments = []
+        shown = 0
+        for start, end, photo_on in PHOTO_LAYOUT:
+            if not photo_on:
+                segments.append(Segment(start, end, (fixation,)))
+                continue
+            shown += 1
+            moves = ()
+            if shown > 1:
+                pos = [0,0] + .01*(np.random.randint(low=-3, high=3, size=2))
+                moves = ((stimulus, pos),)
+            segments.append(Segment(start, end, (stimulus, fixation),
+                log=('{0} onset {1}'.format(trial_objs[trial], shown),),
+                moves=moves))
+        time_fix_change = 1.0+4.5*np.random.uniform()
     else:
-        print('unknown stimulus type...')
-        win.close()
-        core.quit()
+        # the sketch plays until the clip finishes
+        segments = [Segment(0., float('inf'), (stimulus, fixation))]
+        time_fix_change = .5+5*np.random.uniform()
+
+    if fixation_change[trial] == 1:
+        segments = with_dim(segments, time_fix_change, FIX_DIM_DURATION,
+                            fixation, fixation_dark)
+    else:
+        time_fix_change = None
+    segments = compositor.bake(segments, stimulus)
+    return stimulus, to_frames(segments, frame_period), time_fix_change
+
+def unload_trial(trial, compiled):
+    """unload_trial(trial, compiled)
+    frees the stimulus of a finished trial
+    """
+    if stim_types[trial] == 'sketch':
+        clips.release(compiled[0])
+
+# build the first trials now, later ones are built during ITI fixation
+stimuli = Prefetcher(compile_trial, len(trials), lookahead=2,
+                     release=unload_trial,
+                     clock=core.getTime)
+stimuli.fill()
 
 instructions = visual.TextStim(win, pos=[-.9, .6], wrapWidth=1.8,
                 alignHoriz='left', alignVert='top', name='Instructions',
@@ -198,45 +336,64 @@ if not exists(serial_path):
     win.flip()
     serial_exists = False
     b_serial = "No serial device detected, using keyboard"
-    event.waitKeys(keyList=['5'])
-
+    ser = None
     first_trigger = "Got sync from keyboard. Resetting clocks"
 else:
     waiting.draw()
     win.flip()
     serial_exists = True
     b_serial = "Serial device detected"
-    ser = serial.Serial(serial_path, 19200, timeout=.0001)
-    ser.flushInput()
-    scanner_wait = True
+    # the port is read on a background thread from here on
+    import serial
+    ser = SerialReader(serial.Serial(serial_path, 19200),
+                       clock=core.getTime).start()
+    first_trigger = "Got sync from scannner! Resetting clocks"
 
-    while scanner_wait:
-        ser_out = ser.read()
-        if b'5' in ser_out:
-            scanner_wait = False
-            first_trigger = "Got sync from scannner! Resetting clocks"
+# button box and keyboard arrive as one stream of timestamped events
+responses = InputBus(RESPONSE_KEYS, serial=ser)
+responses.clear()
+trigger_t = responses.wait_for('scanner_trigger')
 
 # Set run start time and reset PsychoPy's core.Clock() on first trigger
-run_clock.reset()
-run_start = time.time()
+run_clock.reset(core.getTime() - trigger_t)
+run_start = trigger_t
 timer_exp = core.Clock()
 
 logging.info(b_serial)
-logging.info(first_trigger)
+logging.info(first_trigger, t=0.)
 print(first_trigger)
 print(b_serial)
 bRepeat = 0
 
-# Start fixation after scanner trigger
+def check_responses():
+    """check_responses()
+    logs the button presses and scanner triggers since the last check
+    """
+    for t, source, code in responses.poll():
+        if code == 'scanner_trigger':
+            volumes.record(t)
+            # stamped with when it arrived, on the log's run clock
+            logging.info(code, t=t-run_start)
+        else:
+            events.put(t-run_start, 0., 'button_press', code, None)
+
+# Start fixation after scanner trigger, its flip anchors the frame count
+# every flip from here on is timestamped and saved next to the log at the end
+flips = FlipRecorder((onsets[-1]+durations[-1]+30)/frame_period, frame_period)
 fixation.draw()
-win.flip()
+sched = FrameScheduler(win, frame_period, win.flip(), recorder=flips,
+                       waiter=waiter)
+volumes = VolumeClock(trigger_t, TR)
+drift = DriftCorrector(sched, run_start, onsets, durations, stim_types,
+                       OVERRUN_POLICIES,
+                       clock=volumes.time_at if RESYNC_TO_VOLUMES else None)
 
 # Start looping through trials
-for trial in range(trials.shape[0]):
+for trial in range(len(trials)):
     # prepare stimulus for this trial
-    stim_type = trials.loc[trial,'StimType']
-    trial_obj = trials.loc[trial,'ObjectID']
-    stimulus = stimuli[trial]
+    stim_type = trials['StimType'][trial]
+    trial_obj = trials['ObjectID'][trial]
+    stimulus, segments, time_fix_change = stimuli.get(trial)
 
     if repeats[trial]:
         bRepeat = 1
@@ -245,977 +402,98 @@ for trial in range(trials.shape[0]):
 
     print("stimulus prepared")
 
-    if serial_exists:
-        ser.flushInput()
-
-    core.wait(onsets[trial] - (time.time()-run_start), hogCPUperiod=0.2)
-
-    stim_start = time.time()
-    if stim_type == 'fixation':
-        win.logOnFlip(level=logging.EXP, msg='fixation trial start')
-        stimulus.draw()
-        win.flip()
-        if fixation_change[trial] == 1:
-            time_fix_change = .5+5*(np.random.uniform(low=0.,high=1.,size=1))
-            logging.exp('time of fixation change is {0}'.format(time_fix_change))
-
-        fix_wait = True
-        now = time.time()
-        while now-stim_start <= durations[trial]:
-            if fixation_change[trial] == 0 or now-stim_start < time_fix_change:
-                stimulus.draw()
-            elif now-(stim_start+time_fix_change) > 0.3:
-                stimulus.draw()
-            elif fix_wait:
-                fixation_dark.draw()
-                win.logOnFlip('fixation change onset', level=logging.EXP)
-                fix_wait = False
-            else:
-                fixation_dark.draw()
-            now = time.time()
-            win.flip()
-
-            if serial_exists:
-                key = str(ser.read())
-            else:
-                key = event.getKeys(['1','2','5'])
-
-            if '1' in list(key):
-                which_key = '1'
-            elif '2' in list(key):
-                which_key = '2'
-            elif '5' in list(key):
-                which_key = 'scanner_trigger'
-                logging.info(which_key)
-            else:
-                which_key = False
-
-            if which_key in ['1','2']:
-                logbids(template_bids.format(
-                    onset=time.time()-run_start,
-                    duration=0.,
-                    stim_type='button_press',
-                    stim_fn=which_key,
-                    repeat='')
-                    )
-
-    elif stim_type == 'photo':
-        # first presentation
-        win.logOnFlip('{0} onset 1'.format(trial_obj), level=logging.EXP)
-        stimulus.draw()
-        fixation.draw()
-        core.wait(0.5-(time.time()-stim_start), hogCPUperiod=0.1)
-        win.flip()
-        stimulus.draw()
-        if fixation_change[trial] == 1:
-            time_fix_change = 1.0+4.5*(np.random.uniform(low=0.,high=1.,size=1))
-            logging.exp('time of fixation change is {0}'.format(time_fix_change))
-
-        if fixation_change[trial] == 1 and (time_fix_change < 1.7):
-            # dim fixation onset AND OFFSET during this presentation
-            fixation.draw()
-            win.flip()
-            stimulus.draw()
-            fixation_dark.draw()
-            win.logOnFlip('fixation change onset', level=logging.EXP)
-            core.wait(time_fix_change-(time.time()-stim_start), hogCPUperiod=0.1)
-
-            win.flip()
-            stimulus.draw()
-            fixation.draw()
-            core.wait(time_fix_change+.3-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            stimulus.pos = [0,0] + .01*(np.random.randint(low=-3, high=3, size=2))
-            fixation.draw()
-
-            while time.time() - stim_start < 2.0:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(2.0-(time.time()-stim_start), hogCPUperiod=0.1)
-
-        elif fixation_change[trial] == 1 and (1.7 <= time_fix_change < 2.0):
-            # dim fixation onset, extends into blank
-            fixation.draw()
-            win.flip()
-            stimulus.draw()
-            fixation_dark.draw()
-            win.logOnFlip('fixation change onset', level=logging.EXP)
-            core.wait(time_fix_change-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            stimulus.pos = [0,0] + .01*(np.random.randint(low=-3, high=3, size=2))
-            fixation_dark.draw()
-
-            if serial_exists:
-                key = str(ser.read())
-            else:
-                key = event.getKeys(['1','2','5'])
-
-            if '1' in list(key):
-                which_key = '1'
-            elif '2' in list(key):
-                which_key = '2'
-            elif '5' in list(key):
-                which_key = 'scanner_trigger'
-                logging.info(which_key)
-            else:
-                which_key = False
-
-            if which_key in ['1','2']:
-                logbids(template_bids.format(
-                    onset=time.time()-run_start,
-                    duration=0.,
-                    stim_type='button_press',
-                    stim_fn=which_key,
-                    repeat='')
-                    )
+    check_responses()
 
-        else:
-            # fixation does not dim in this section
-            fixation.draw()
-            win.flip()
-            stimulus.pos = [0,0] + .01*(np.random.randint(low=-3, high=3, size=2))
-            fixation.draw()
-            while time.time() - stim_start < 2.0:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-
-            # core.wait(2.0-(time.time()-stim_start), hogCPUperiod=0.1)
-
-        # first blank
-        win.flip()
-        if fixation_change[trial] == 1 and (1.7 < time_fix_change < 2.0):
-            # finish dim fixation period, then draw regular
-            fixation.draw()
-            core.wait(time_fix_change+.3-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            stimulus.draw()
-            fixation.draw()
-            win.logOnFlip('{0} onset 2'.format(trial_obj),level=logging.EXP)
-
-            while time.time()-stim_start < 2.5:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-
-            # core.wait(2.5-(time.time()-stim_start), hogCPUperiod=0.1)
-        elif fixation_change[trial] == 1 and (2.0 <= time_fix_change < 2.2):
-            # fixation dim happens all during the blank
-            fixation_dark.draw()
-            win.logOnFlip('fixation change onset', level=logging.EXP)
-            core.wait(time_fix_change-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            fixation.draw()
-            while time.time()-stim_start < time_fix_change+.3:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(time_fix_change+.3-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            stimulus.draw()
-            fixation.draw()
-            while time.time()-stim_start < 2.5:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(2.5-(time.time()-stim_start), hogCPUperiod=0.1)
-        elif fixation_change[trial] == 1 and (2.2 <= time_fix_change < 2.5):
-            # fixation dims during the blank, extends into next presentation
-            fixation_dark.draw()
-            win.logOnFlip('fixation change onset', level=logging.EXP)
-            while time.time()-stim_start < time_fix_change:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(time_fix_change-(time.time() - stim_start),hogCPUperiod=0.1)
-            win.flip()
-            stimulus.draw()
-            fixation_dark.draw()
-            win.logOnFlip('{0} onset 2'.format(trial_obj),level=logging.EXP)
-            while time.time()-stim_start < 2.5:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(2.5-(time.time()-stim_start), hogCPUperiod=0.1)
-        else:
-            # normal fixation for the whole blank
-            stimulus.draw()
-            fixation.draw()
-            win.logOnFlip('{0} onset 2'.format(trial_obj),level=logging.EXP)
-            while time.time()-stim_start < 2.5:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(2.5-(time.time()-stim_start), hogCPUperiod=0.1)
-
-        # second presentation
-        win.flip()
-        if fixation_change[trial] == 1 and (2.2 < time_fix_change < 2.5):
-            stimulus.draw()
-            fixation.draw()
-            core.wait(time_fix_change-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            fixation.draw()
-            while time.time()-stim_start < 4.0:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(4.0-(time.time()-stim_start),hogCPUperiod=0.1)
-        elif fixation_change[trial] == 1 and (2.5 < time_fix_change < 3.7):
-            # dim fixation onset AND OFFSET during this presentation
-            stimulus.draw()
-            fixation_dark.draw()
-            win.logOnFlip('fixation change onset', level=logging.EXP)
-            core.wait(time_fix_change-(time.time()-stim_start),hogCPUperiod=0.1)
-
-            win.flip()
-            stimulus.draw()
-            fixation.draw()
-            while time.time()-stim_start < time_fix_change+.3:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(time_fix_change+.3-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            stimulus.pos = [0,0] + .01*(np.random.randint(low=-3, high=3, size=2))
-            fixation.draw()
-            while time.time()-stim_start < 4.0:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(4.0-(time.time()-stim_start), hogCPUperiod=0.1)
-        elif fixation_change[trial] == 1 and (3.7 <= time_fix_change < 4.0):
-            # dim fixation onset, extends into blank
-            stimulus.draw()
-            fixation_dark.draw()
-            win.logOnFlip('fixation change onset', level=logging.EXP)
-            while time.time()-stim_start < time_fix_change:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(time_fix_change-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            stimulus.pos = [0,0] + .01*(np.random.randint(low=-3, high=3, size=2))
-            fixation_dark.draw()
-        else:
-            # fixation does not dim in this section
-            stimulus.pos = [0,0] + .01*(np.random.randint(low=-3, high=3, size=2))
-            fixation.draw()
-            while time.time()-stim_start < 4.0:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(4.0-(time.time()-stim_start), hogCPUperiod=0.1)
-
-        # second blank
-        win.flip()
-        if fixation_change[trial] == 1 and (3.7 < time_fix_change < 4.0):
-            # finish dim fixation period, then draw regular
-            fixation.draw()
-            while time.time()-stim_start < time_fix_change+.3:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(time_fix_change+.3-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            stimulus.draw()
-            fixation.draw()
-            win.logOnFlip('{0} onset 3'.format(trial_obj),level=logging.EXP)
-            while time.time()-stim_start < 4.5:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(4.5-(time.time()-stim_start), hogCPUperiod=0.1)
-        elif fixation_change[trial] == 1 and (4.0 <= time_fix_change < 4.2):
-            # fixation dim happens all during the blank
-            fixation_dark.draw()
-            win.logOnFlip('fixation change onset', level=logging.EXP)
-            while time.time()-stim_start < time_fix_change:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(time_fix_change-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            fixation.draw()
-            while time.time()-stim_start < time_fix_change+.3:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-                if key and key[-1] in ['1', '2', "b'1'","b'2'"]:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=key[-1],
-                        repeat='')
-                    )
-            # core.wait(time_fix_change+.3-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            stimulus.draw()
-            fixation.draw()
-            while time.time()-stim_start < 4.5:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(4.5-(time.time()-stim_start), hogCPUperiod=0.1)
-        elif fixation_change[trial] == 1 and (4.2 <= time_fix_change < 4.5):
-            # fixation dims during the blank, extends into next presentation
-            fixation_dark.draw()
-            win.logOnFlip('fixation change onset', level=logging.EXP)
-            core.wait(time_fix_change-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            stimulus.draw()
-            fixation_dark.draw()
-            win.logOnFlip('{0} onset 3'.format(trial_obj),level=logging.EXP)
-            while time.time()-stim_start < 4.5:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(4.5-(time.time()-stim_start), hogCPUperiod=0.1)
-        else:
-            # normal fixation for the whole blank
-            stimulus.draw()
-            fixation.draw()
-            win.logOnFlip('{0} onset 3'.format(trial_obj),level=logging.EXP)
-            while time.time()-stim_start < 4.5:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(4.5-(time.time()-stim_start), hogCPUperiod=0.1)
-
-        # third presentation
-        win.flip()
-        if fixation_change[trial] == 1 and (4.2 < time_fix_change < 4.5):
-            stimulus.draw()
-            fixation.draw()
-            core.wait(time_fix_change-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            if serial_exists:
-                key = str(ser.read())
-            else:
-                key = event.getKeys(['1','2','5'])
-
-            if '1' in list(key):
-                which_key = '1'
-            elif '2' in list(key):
-                which_key = '2'
-            elif '5' in list(key):
-                which_key = 'scanner_trigger'
-                logging.info(which_key)
-            else:
-                which_key = False
-
-            if which_key in ['1','2']:
-                logbids(template_bids.format(
-                    onset=time.time()-run_start,
-                    duration=0.,
-                    stim_type='button_press',
-                    stim_fn=which_key,
-                    repeat='')
-                    )
-        elif fixation_change[trial] == 1 and (4.2 <= time_fix_change < 4.5):
-            # finish dim fixation
-            stimulus.draw()
-            fixation.draw()
-            while time.time()-stim_start < time_fix_change+.3:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(time_fix_change+.3-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-        if fixation_change[trial] == 1 and time_fix_change > 4.5:
-            # fixation dims during this presentation
-            win.logOnFlip('fixation change onset', level=logging.EXP)
-            stimulus.draw()
-            fixation_dark.draw()
-            while time.time()-stim_start < time_fix_change:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(time_fix_change-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-            stimulus.draw()
-            fixation.draw()
-            while time.time()-stim_start < time_fix_change+.3:
-                if serial_exists:
-                    key = str(ser.read())
-                else:
-                    key = event.getKeys(['1','2','5'])
-
-                if '1' in list(key):
-                    which_key = '1'
-                elif '2' in list(key):
-                    which_key = '2'
-                elif '5' in list(key):
-                    which_key = 'scanner_trigger'
-                    logging.info(which_key)
-                else:
-                    which_key = False
-
-                if which_key in ['1','2']:
-                    logbids(template_bids.format(
-                        onset=time.time()-run_start,
-                        duration=0.,
-                        stim_type='button_press',
-                        stim_fn=which_key,
-                        repeat='')
-                        )
-            # core.wait(time_fix_change+.3-(time.time()-stim_start), hogCPUperiod=0.1)
-            win.flip()
-
-        while time.time()-stim_start < 6.0:
-            if serial_exists:
-                key = str(ser.read())
-            else:
-                key = event.getKeys(['1','2','5'])
-
-            if '1' in list(key):
-                which_key = '1'
-            elif '2' in list(key):
-                which_key = '2'
-            elif '5' in list(key):
-                which_key = 'scanner_trigger'
-                logging.info(which_key)
-            else:
-                which_key = False
-
-            if which_key in ['1','2']:
-                logbids(template_bids.format(
-                    onset=time.time()-run_start,
-                    duration=0.,
-                    stim_type='button_press',
-                    stim_fn=which_key,
-                    repeat='')
-                    )
-        # core.wait(6.0-(time.time()-stim_start), hogCPUperiod=0.1)
+    # build upcoming trials while fixation is up, without delaying this onset,
+    # then wake in the frame before it so the first flip lands on the onset
+    onset_frame = drift.plan(trial)
+    stimuli.fill(deadline=sched.time_of(onset_frame-1))
+    sched.wait_for_frame(onset_frame)
 
+    if time_fix_change is not None:
+        logging.exp('time of fixation change is {0}'.format(time_fix_change))
+    if stim_type == 'sketch':
+        clips.rewind(stimulus)
+        clip_done = lambda: stimulus.status == visual.FINISHED
+        length = sched.frames(stimulus.duration)
     else:
-        # show the sketch
-        if fixation_change[trial] == 1:
-            time_fix_change = .5+5*(np.random.uniform(low=0.,high=1.,size=1))
-            logging.exp('time of fixation change is {0}'.format(time_fix_change))
-        now = time.time()
-        fix_wait = True
-        while stimulus.status != visual.FINISHED:
-            stimulus.draw()
-            if fixation_change[trial] == 0 or now-stim_start < time_fix_change:
-                fixation.draw()
-            elif now-(stim_start+time_fix_change) > 0.3:
-                fixation.draw()
-            elif fix_wait:
-                fixation_dark.draw()
-                win.logOnFlip('fixation change onset', level=logging.EXP)
-                fix_wait = False
-            else:
-                fixation_dark.draw()
-
-            if serial_exists:
-                key = str(ser.read())
-            else:
-                key = event.getKeys(['1','2','5'])
-
-            if '1' in list(key):
-                which_key = '1'
-            elif '2' in list(key):
-                which_key = '2'
-            elif '5' in list(key):
-                which_key = 'scanner_trigger'
-                logging.info(which_key)
-            else:
-                which_key = False
-
-            if which_key in ['1','2']:
-                logbids(template_bids.format(
-                    onset=time.time()-run_start,
-                    duration=0.,
-                    stim_type='button_press',
-                    stim_fn=which_key,
-                    repeat='')
-                    )
-            now = time.time()
-            win.flip()
+        clip_done = None
+        length = segments[-1].end
+    flips.trial = trial
+    onset_frame, stop = drift.start(length)
+    stim_start = run_segments(sched, segments, onset_frame,
+                              on_frame=check_responses, until=clip_done,
+                              stop=stop)
 
     fixation.draw()
-    win.flip()
-    fix_start = time.time()
+    fix_start = sched.flip()
+    drift.finish(stim_start)
 
     print("Stimulus {0} was on for {1}".format(trial_obj+'_'+stim_type,fix_start-stim_start))
 
     # if fixation_change[trial] == 1:
-    #     logbids(template_bids.format(
-    #             onset=stim_start+time_fix_change-run_start,
-    #             duration=0.3,
-    #             stim_type='fixChange',
-    #             stim_fn='fixDark',
-    #             repeat='')
-    #         )
+    #     events.put(stim_start+time_fix_change-run_start, 0.3, 'fixChange',
+    #                'fixDark', None)
 
     # log the trial
-    logbids(template_bids.format(
-            onset=stim_start-run_start,
-            duration=time.time()-stim_start,
-            stim_type=stim_type,
-            stim_fn=trial_obj,
-            repeat=bRepeat)
-        )
-
-    while time.time()-stim_start <=durations[trial]+2-trial_jitters[trial]:
-        fixation.draw()
-        win.flip()
-
-    print("Fixation was on screen for {0}".format(time.time()-fix_start))
+    events.put(stim_start-run_start, fix_start-stim_start, stim_type,
+               trial_obj, bRepeat)
+    events.flush()
 
-    if serial_exists:
-        key = str(ser.read())
-    else:
-        key = event.getKeys(['1','2','5'])
-
-    if '1' in list(key):
-        which_key = '1'
-    elif '2' in list(key):
-        which_key = '2'
-    elif '5' in list(key):
-        which_key = 'scanner_trigger'
-        logging.info(which_key)
-    else:
-        which_key = False
-
-    if which_key in ['1','2']:
-        logbids(template_bids.format(
-            onset=time.time()-run_start,
-            duration=0.,
-            stim_type='button_press',
-            stim_fn=which_key,
-            repeat='')
-            )
-
-core.wait(8, hogCPUperiod=0.1)
+    iti_end = drift.planned + sched.frames(durations[trial]+2-trial_jitters[trial])
+    while sched.next_frame() < iti_end:
+        fixation.draw()
+        sched.flip()
+
+    print("Fixation was on screen for {0}".format(core.getTime()-fix_start))
+
+    check_responses()
+
+# the scanner keeps going for the tail, until the last volume of the run is
+# in; in a session the next run's first clips are decoded meanwhile
+n_volumes = int(np.ceil((onsets[-1]+durations[-1]+2-trial_jitters[-1]+8)/TR))
+if session.next_run is not None:
+    upcoming = load_run(CSVDIR, participant, session.next_run)
+    session.hold(clips, [clip_path(upcoming['ObjectID'][t], upcoming['StimNo'][t])
+                         for t in range(stimuli.lookahead+1)
+                         if upcoming['StimType'][t] == 'sketch'])
+stimuli.close()
+volumes.wait_for(n_volumes, check_responses, waiter=waiter)
+
+flips_fn = join(RESDIR, 'flips_p{:02d}_r{:02d}.npy'.format(
+                int(participant), int(run)))
+flips.save(flips_fn)
+dropped = "Dropped {0} frames, see {1}".format(flips.dropped,
+                                                 flips_fn[:-4]+'.txt')
+logging.info(dropped)
+print(dropped)
+drift_fn = join(RESDIR, 'drift_p{:02d}_r{:02d}.tsv'.format(
+                int(participant), int(run)))
+drift.save(drift_fn)
+corrected = "{0}, see {1}".format(drift.summary(), drift_fn)
+logging.info(corrected)
+print(corrected)
+volumes_fn = join(RESDIR, 'volumes_p{:02d}_r{:02d}.npy'.format(
+                  int(participant), int(run)))
+volumes.save(volumes_fn)
+scanned = "{0} volumes, TR {1:.6f} s ({2:+.1f} ppm), see {3}".format(
+    len(volumes), volumes.tr, volumes.drift*1e6, volumes_fn[:-4]+'.txt')
+logging.info(scanned)
+print(scanned)
+logging.info('waits: ' + waiter.summary())
 
 finished = "Finished run successfully!"
 logging.info(finished)
 print(finished)
-win.close()
-print('quitting because end of experiment...')
-core.quit()
+events.close()
+if serial_exists:
+    ser.close()
+if atlas is not None:
+    atlas.close()
+if session.next_run is None:
+    win.close()
+    print('quitting because end of experiment...')
+    core.quit()
+# the next run of the session opens its own log
+logging.flush()
+logging.root.removeTarget(log)
@@ -5,25 +5,56 @@
 
 # Optionally supply DBIC ID, accession number, and participant number:
 #   python actions_presentation.py <DBIC ID> <accession number> <participant_number> <run_number>
-# Command line arguments must be in order!
+# Command line arguments must be in order! Given arguments skip the run
+# configuration dialog.
 
 import sys
-import time
-import serial
-import pandas as pd
-import numpy as np
 from os import makedirs
 from os.path import join, exists, abspath, dirname
-from psychopy import visual, core, event, gui, logging, sound
-from psychopy.constants import (NOT_STARTED, STARTED, PLAYING, PAUSED,
-                                STOPPED, FINISHED, PRESSED, RELEASED, FOREVER)
 
-# Set up GUI for inputing participant/run information (with defaults)
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from sketch_fmri.startup import ImportTimer
+
+# heavy imports are timed so slow startups can be pinned down, the dialog
+# (wx) and serial modules are only imported when they are used
+import_times = ImportTimer()
+with import_times('numpy'):
+    import numpy as np
+with import_times('psychopy'):
+    from psychopy import visual, core, event, logging
+    from psychopy.constants import (NOT_STARTED, STARTED, PLAYING, PAUSED,
+                                    STOPPED, FINISHED, PRESSED, RELEASED,
+                                    FOREVER)
+with import_times('sketch_fmri'):
+    from sketch_fmri.bidsevents import EventsWriter
+    from sketch_fmri.clipcache import ClipCache
+    from sketch_fmri.composite import Compositor
+    from sketch_fmri.drift import DriftCorrector
+    from sketch_fmri.fliplog import FlipRecorder
+    from sketch_fmri.framesched import FrameScheduler, measure_frame_period
+    from sketch_fmri.inputbus import InputBus
+    from sketch_fmri.phases import Segment, run_segments, to_frames
+    from sketch_fmri.prefetch import Prefetcher
+    from sketch_fmri.rawmovie import movie_stim
+    from sketch_fmri.schedule import load_run
+    from sketch_fmri.serialreader import SerialReader
+    from sketch_fmri.session import current_session
+    from sketch_fmri.textscreens import TextScreenCache
+    from sketch_fmri.volumes import VolumeClock
+    from sketch_fmri.waiter import shared_waiter
+
+# a script started on its own is a session of one run, python -m
+# sketch_fmri.session plays several runs in one process and keeps the window
+# and stimulus caches open between them
+session = current_session()
+
+# Take participant/run information from the command line, or from a GUI
+# (with defaults) when none was given
 if len(sys.argv) > 1:
     DBIC_ID = sys.argv[1]
     accession = sys.argv[2]
     participant = sys.argv[3]
-    run = sys.argv[4]
+    run = int(sys.argv[4])
 else:
     #DBIC_ID = "e.g., SID000001"
     #accession = "e.g., A000001"
@@ -33,39 +64,38 @@ else:
     participant = "00"
     run = "00"
 
-run_configuration = gui.Dlg(title='Run configuration')
-run_configuration.addField("DBIC ID:", DBIC_ID)
-run_configuration.addField("Scan accession number:", accession)
-run_configuration.addField("Participant:", participant)
-run_configuration.addField("Run number:", run)
-run_configuration.show()
-
-if run_configuration.OK:
-    DBIC_ID = run_configuration.data[0]
-    accession = run_configuration.data[1]
-    participant = str(run_configuration.data[2])
-    run = int(run_configuration.data[3])
-elif not run_configuration.OK:
-    core.quit()
+    with import_times('psychopy.gui'):
+        from psychopy import gui
+    run_configuration = gui.Dlg(title='Run configuration')
+    run_configuration.addField("DBIC ID:", DBIC_ID)
+    run_configuration.addField("Scan accession number:", accession)
+    run_configuration.addField("Participant:", participant)
+    run_configuration.addField("Run number:", run)
+    run_configuration.show()
+
+    if run_configuration.OK:
+        DBIC_ID = run_configuration.data[0]
+        accession = run_configuration.data[1]
+        participant = str(run_configuration.data[2])
+        run = int(run_configuration.data[3])
+    elif not run_configuration.OK:
+        core.quit()
 
 # Start PsychoPy's clock (mostly for logging)
 run_clock = core.Clock()
 
-# Add a new logging level name called bids
-# we will use this level to log information that will be saved
-# in the _events.tsv file for this run
-BIDS = 26
-logging.addLevel(BIDS, 'BIDS')
+# button box / keyboard codes: buttons 1-4, 5 = scanner trigger
+RESPONSE_KEYS = {'1': '1', '2': '2', '3': '3', '4': '4',
+                 '5': 'scanner_trigger'}
 
-def logbids(msg, t=None, obj=None):
-    """logbids(message)
-    logs a BIDS related message
-    """
-    logging.root.log(msg, level=BIDS, t=t, obj=obj)
+# a trial that starts late keeps the next onset on time: a clip is cut at
+# its planned end, other trials skip what was due while they were late
+OVERRUN_POLICIES = {'sketch': 'truncate'}
 
-# BIDS TEMPLATE
-logbids("onset\tduration\tstim_type\tstim_fn")
-template_bids = '{onset:.3f}\t{duration:.3f}\t{stim_type}\t{stim_fn}'
+# scanner TR in seconds; onsets are placed on the volume clock fitted to the
+# TR pulses, or with RESYNC_TO_VOLUMES off in seconds since the first pulse
+TR = 2.
+RESYNC_TO_VOLUMES = True
 
 # Set up all the relevant directories here
 HERE = abspath(dirname(__file__))
@@ -80,12 +110,19 @@ logging.setDefaultClock(run_clock)
 log = logging.LogFile(f=join("res", 'log_p{:02d}_r{:02d}.txt'.format(
                 int(participant), int(run))), level=logging.INFO,
                 filemode='w')
+for line in import_times.report():
+    logging.info('startup: ' + line)
 
-# Load in events / trial order
-trials_file = join(CSVDIR,'Sub{:02d}_Run{:02d}.csv'.format(
-                         int(participant), int(run)))
-trials = pd.read_csv(trials_file)
-assert trials.shape[0] == 57
+# BIDS events go to their own _events.tsv next to the log, written by a
+# background thread so the frame loops only queue raw rows
+events = EventsWriter(join(RESDIR, 'sub-{:02d}_run-{:02d}_events.tsv'.format(
+                      int(participant), int(run))),
+                      ('onset', 'duration', 'stim_type', 'stim_fn'),
+                      ('{:.3f}', '{:.3f}', '{}', '{}'))
+
+# Load in events / trial order, from runs/study.npz if it has been packed
+trials = load_run(CSVDIR, participant, run)
+assert len(trials) == 57
 
 # Open window and wait for first scanner trigger
 
@@ -94,8 +131,15 @@ assert trials.shape[0] == 57
 #                     colorSpace='rgb255', name='Window')
 
 # for testing
-win = visual.Window([1680,1050], screen=0, fullscr=True, color=(128,128,128),
-                    colorSpace='rgb255', name='Window')
+win = session.keep('win', lambda: visual.Window(
+    [1680,1050], screen=0, fullscr=True, color=(128,128,128),
+    colorSpace='rgb255', name='Window'))
+
+# onsets and durations are scheduled in frames of the measured refresh period
+frame_period = session.keep('frame_period', lambda: measure_frame_period(win))
+logging.info('measured frame period is {0:.5f} s'.format(frame_period))
+# how late the OS wakes from a sleep is learned now, not after the trigger
+waiter = shared_waiter()
 
 # # fixation crosses
 # fixation = visual.TextStim(win, pos=(0, 0), text="+", name="Fixation",
@@ -105,10 +149,33 @@ win = visual.Window([1680,1050], screen=0, fullscr=True, color=(128,128,128),
 
 # concentric circles for fixation
 fixation_fn = join(HERE, 'fixation_green_thumb.png')
-fixation = visual.ImageStim(win, fixation_fn, name='Fixation', colorSpace='rgb', autoLog=True)
-
-# load stimuli
-stimuli = {}
+fixation = session.keep('fixation', lambda: visual.ImageStim(
+    win, fixation_fn, name='Fixation', colorSpace='rgb', autoLog=True))
+
+# the fixation is baked into the clips it is drawn on, so those frames are
+# one draw
+compositor = session.keep('compositor', lambda: Compositor(
+    win, [(fixation, fixation_fn)]))
+
+# load trial info, the stimuli themselves are built just in time a few trials
+# ahead of the one on screen (repeated clips share one decoder, and clips
+# transcoded with `python -m sketch_fmri.rawclip stim` play from
+# memory-mapped frames; each distinct text screen is rasterized once)
+clips = session.keep('clips', lambda: ClipCache(
+    win, movie_class=movie_stim, pos=(0, 0), flipVert=False,
+    flipHoriz=False, loop=False, noAudio=True))
+text_screens = session.keep('text_screens', lambda: TextScreenCache(win))
+BLOCK_INSTRUCTIONS = {
+    'Instruct_Animate': ("Attempt to see\n\n"
+                         "ANIMATE \n\nReport what you saw"),
+    'Instruct_Inanimate': ("Attempt to see \n\n"
+                           "INANIMATE \n\nReport what you saw"),
+    'Instruct_Neutral': ("View passively\n\n"
+                         "\n\nReport what you saw"),
+}
+trial_objs = []
+stim_numbers = []
+stim_types = []
 durations = []
 trial_jitters = []
 onsets = []
@@ -120,22 +187,44 @@ load_disp = visual.TextStim(win, text=load_text,
 load_disp.draw()
 win.flip()
 
-for trial in range(trials.shape[0]):
-    trial_obj = trials.loc[trial,'ObjectID']    # object category
-    stim_number = trials.loc[trial,'StimNo']    # which exemplar
-    stim_type = trials.loc[trial,'StimType']    # ['sketch','fixation','instructions','question']
-    onsets.append(trials.loc[trial,'Onset'])
-    durations.append(trials.loc[trial,'Duration'])
-    trial_jitters.append(trials.loc[trial,'Jitter'])
+for trial in range(len(trials)):
+    stim_type = trials['StimType'][trial]    # ['sketch','fixation','instructions','question']
+    trial_objs.append(trials['ObjectID'][trial])     # object category
+    stim_numbers.append(trials['StimNo'][trial])     # which exemplar
+    stim_types.append(stim_type)
+    onsets.append(trials['Onset'][trial])
+    durations.append(trials['Duration'][trial])
+    trial_jitters.append(trials['Jitter'][trial])
+    if stim_type not in ['fixation', 'question', 'sketch', 'Instruct_Animate', 'Instruct_Inanimate',
+                         'Instruct_Neutral', 'Prepare_Animate', 'Prepare_Inanimate',
+                         'Prepare_Neutral']:
+        print('unknown stimulus type...')
+        print(stim_type)
+        win.close()
+        core.quit()
+
+def clip_path(trial_obj, stim_number):
+    """clip_path(trial_obj, stim_number)
+    the sketch clip of this object and exemplar
+    """
+    return join(STIMDIR, trial_obj+'_'+str(stim_number)+'_6s.mov')
+
+def load_stimulus(trial):
+    """load_stimulus(trial)
+    builds the stimulus shown in this trial
+    """
+    trial_obj = trial_objs[trial]
+    stim_number = stim_numbers[trial]
+    stim_type = stim_types[trial]
     print("Loading {0}".format(trial_obj))
     if stim_type in ['fixation','Prepare_Animate','Prepare_Inanimate','Prepare_Neutral']:
-        stimuli[trial] = fixation
+        return fixation
     elif stim_type == 'question':
         # load question
         names = trial_obj.split('_')
         correct_name = names[0]
         wrong_name = names[1]
-        wherecorrect = trials.loc[trial,'WhereCorrect']
+        wherecorrect = trials['WhereCorrect'][trial]
         if wherecorrect == "right":
             right_text = correct_name
             left_text = wrong_name
@@ -143,51 +232,73 @@ for trial in range(trials.shape[0]):
             right_text = wrong_name
             left_text = correct_name
 
-        center_text = 'neither'
-        question_text = 'What object identity did you see?'
-        probe_left = visual.TextStim(win, text=left_text, pos=(-.3, 0),
-                                     alignHoriz='center', alignVert='center',
-                                     name='Left probe', color ='black')
-        probe_right = visual.TextStim(win, text=right_text, pos=(.3, 0),
-                                      alignHoriz='center', alignVert='center',
-                                      name='Right probe', color='black')
-        probe_center = visual.TextStim(win, text=center_text, pos=(0,-.3),
-                                      alignHoriz='center', alignVert='center',
-                                      name='Bottom probe', color='black')
-        question = visual.TextStim(win, text=question_text, pos=(0, .4), alignHoriz='center',
-                           alignVert='bottom', wrapWidth=2, color='black', name='What object?')
-        stimuli[trial] = [probe_left, probe_right, probe_center, question]
+        def build():
+            center_text = 'neither'
+            question_text = 'What object identity did you see?'
+            probe_left = visual.TextStim(win, text=left_text, pos=(-.3, 0),
+                                         alignHoriz='center', alignVert='center',
+                                         name='Left probe', color ='black')
+            probe_right = visual.TextStim(win, text=right_text, pos=(.3, 0),
+                                          alignHoriz='center', alignVert='center',
+                                          name='Right probe', color='black')
+            probe_center = visual.TextStim(win, text=center_text, pos=(0,-.3),
+                                          alignHoriz='center', alignVert='center',
+                                          name='Bottom probe', color='black')
+            question = visual.TextStim(win, text=question_text, pos=(0, .4), alignHoriz='center',
+                               alignVert='bottom', wrapWidth=2, color='black', name='What object?')
+            return [probe_left, probe_right, probe_center, question]
+        # one texture per distinct screen, shared by every trial showing it
+        return text_screens.get(('question', left_text, right_text, wherecorrect),
+                                build, name='Question')
     elif stim_type == 'sketch':
         # load the sketch video
-        clip_fn = join(STIMDIR, trial_obj+'_'+str(stim_number)+'_6s.mov')
-        stimuli[trial] = visual.MovieStim3(win, clip_fn,
-                                    pos=(0, 0), flipVert=False,
-                                    flipHoriz=False, loop=False,
-                                    noAudio=True, name=trial_obj)
-    elif stim_type == 'Instruct_Animate':
-        stimuli[trial] = visual.TextStim(win, wrapWidth=1.8,
-                        alignHoriz='center', alignVert='center', name='Instructions',
-                        text=("Attempt to see\n\n"
-                              "ANIMATE \n\nReport what you saw"), color='black')
-                        # pos=[-.9, .6],
-    elif stim_type == 'Instruct_Inanimate':
-        stimuli[trial] = visual.TextStim(win, wrapWidth=1.8,
-                        alignHoriz='center', alignVert='center', name='Instructions',
-                        text=("Attempt to see \n\n"
-                              "INANIMATE \n\nReport what you saw"), color='black')
-                        # pos=[-.9, .6],
-    elif stim_type == 'Instruct_Neutral':
-        stimuli[trial] = visual.TextStim(win, wrapWidth=1.8,
+        return clips.get(clip_path(trial_obj, stim_number), name=trial_obj)
+    elif stim_type.split('_')[0] == 'Instruct':
+        return text_screens.get(
+            ('instructions', stim_type),
+            lambda: [visual.TextStim(win, wrapWidth=1.8,
                         alignHoriz='center', alignVert='center', name='Instructions',
-                        text=("View passively\n\n"
-                              "\n\nReport what you saw"),
-                        color='black')
+                        text=BLOCK_INSTRUCTIONS[stim_type], color='black')],
                         # pos=[-.9, .6],
+            name='Instructions')
+
+def compile_trial(trial):
+    """compile_trial(trial)
+    loads the stimulus for this trial and lays the trial out as segments,
+    returns (stimulus, segments in frames)
+    """
+    stimulus = load_stimulus(trial)
+    stim_type = stim_types[trial]
+    if stim_type == 'fixation':
+        segments = [Segment(0., durations[trial]-.2, (stimulus,),
+                            log=('fixation trial start',))]
+    elif stim_type.split('_')[0] == 'Prepare':
+        segments = [Segment(0., durations[trial]-.2, (stimulus,),
+                            log=('prep period start',))]
+    elif stim_type.split('_')[0] == 'Instruct':
+        segments = [Segment(0., durations[trial]-.2, (stimulus,),
+                            log=('block instructions start',))]
+    elif stim_type == 'question':
+        # the probes stay up for the whole response window
+        segments = [Segment(0., durations[trial], (stimulus,))]
     else:
-        print('unknown stimulus type...')
-        print(stim_type)
-        win.close()
-        core.quit()
+        # the sketch plays until the clip finishes
+        segments = [Segment(0., float('inf'), (stimulus, fixation))]
+        segments = compositor.bake(segments, stimulus)
+    return stimulus, to_frames(segments, frame_period)
+
+def unload_trial(trial, compiled):
+    """unload_trial(trial, compiled)
+    frees the stimulus of a finished trial
+    """
+    if stim_types[trial] == 'sketch':
+        clips.release(compiled[0])
+
+# build the first trials now, later ones are built during ITI fixation
+stimuli = Prefetcher(compile_trial, len(trials), lookahead=2,
+                     release=unload_trial,
+                     clock=core.getTime)
+stimuli.fill()
 
 instructions = visual.TextStim(win, wrapWidth=1.8,
                 alignHoriz='center', alignVert='center', name='Instructions',
@@ -232,290 +343,151 @@ if not exists(serial_path):
     win.flip()
     serial_exists = False
     b_serial = "No serial device detected, using keyboard"
-    event.waitKeys(keyList=['5'])
-
+    ser = None
     first_trigger = "Got sync from keyboard. Resetting clocks"
 else:
     waiting.draw()
     win.flip()
     serial_exists = True
     b_serial = "Serial device detected"
-    ser = serial.Serial(serial_path, 19200, timeout=.0001)
-    ser.flushInput()
-    scanner_wait = True
+    # the port is read on a background thread from here on
+    import serial
+    ser = SerialReader(serial.Serial(serial_path, 19200),
+                       clock=core.getTime).start()
+    first_trigger = "Got sync from scannner! Resetting clocks"
 
-    while scanner_wait:
-        ser_out = ser.read()
-        if b'5' in ser_out:
-            scanner_wait = False
-            first_trigger = "Got sync from scannner! Resetting clocks"
+# button box and keyboard arrive as one stream of timestamped events
+responses = InputBus(RESPONSE_KEYS, serial=ser)
+responses.clear()
+trigger_t = responses.wait_for('scanner_trigger')
 
 # Set run start time and reset PsychoPy's core.Clock() on first trigger
-run_clock.reset()
-run_start = time.time()
+run_clock.reset(core.getTime() - trigger_t)
+run_start = trigger_t
 timer_exp = core.Clock()
 
 logging.info(b_serial)
-logging.info(first_trigger)
+logging.info(first_trigger, t=0.)
 print(first_trigger)
 print(b_serial)
 bRepeat = 0
 
-# Start fixation after scanner trigger
+def check_responses():
+    """check_responses()
+    logs the button presses and scanner triggers since the last check
+    """
+    for t, source, code in responses.poll():
+        if code == 'scanner_trigger':
+            volumes.record(t)
+            # stamped with when it arrived, on the log's run clock
+            logging.info(code, t=t-run_start)
+        else:
+            events.put(t-run_start, 0., 'button_press', code)
+
+# Start fixation after scanner trigger, its flip anchors the frame count
+# every flip from here on is timestamped and saved next to the log at the end
+flips = FlipRecorder((onsets[-1]+durations[-1]+30)/frame_period, frame_period)
 fixation.draw()
-win.flip()
+sched = FrameScheduler(win, frame_period, win.flip(), recorder=flips,
+                       waiter=waiter)
+volumes = VolumeClock(trigger_t, TR)
+drift = DriftCorrector(sched, run_start, onsets, durations, stim_types,
+                       OVERRUN_POLICIES,
+                       clock=volumes.time_at if RESYNC_TO_VOLUMES else None)
 
 # Start looping through trials
 # for trial in range(20):
-for trial in range(trials.shape[0]):
+for trial in range(len(trials)):
     # prepare stimulus for this trial
-    stim_type = trials.loc[trial,'StimType']
-    trial_obj = trials.loc[trial,'ObjectID']
-    stimulus = stimuli[trial]
+    stim_type = trials['StimType'][trial]
+    trial_obj = trials['ObjectID'][trial]
+    stimulus, segments = stimuli.get(trial)
 
     print("stimulus prepared")
 
-    if serial_exists:
-        ser.flushInput()
+    check_responses()
 
-    core.wait(onsets[trial] - (time.time()-run_start), hogCPUperiod=0.1)
+    # build upcoming trials while fixation is up, without delaying this onset,
+    # then wake in the frame before it so the first flip lands on the onset
+    onset_frame = drift.plan(trial)
+    stimuli.fill(deadline=sched.time_of(onset_frame-1))
+    sched.wait_for_frame(onset_frame)
 
-    stim_start = time.time()
-    if stim_type == 'fixation':
-        win.logOnFlip(level=logging.EXP, msg='fixation trial start')
-        stimulus.draw()
-        win.flip()
-
-        now = time.time()
-        while now-stim_start <= durations[trial]-.2:
-            stimulus.draw()
-            win.flip()
-
-            if serial_exists:
-                key = str(ser.read())
-            else:
-                key = event.getKeys(['1','2','3','4','5'])
-
-            if '1' in list(key):
-                which_key = '1'
-            elif '2' in list(key):
-                which_key = '2'
-            elif '3' in list(key):
-                which_key = '3'
-            elif '4' in list(key):
-                which_key = '4'
-            elif '5' in list(key):
-                which_key = 'scanner_trigger'
-                logging.info(which_key)
-            else:
-                which_key = False
-
-            if which_key in ['1','2','3','4']:
-                logbids(template_bids.format(
-                    onset=time.time()-run_start,
-                    duration=0.,
-                    stim_type='button_press',
-                    stim_fn=which_key)
-                    )
-            now = time.time()
-    elif stim_type.split('_')[0] == 'Prepare':
-        win.logOnFlip(level=logging.EXP, msg='prep period start')
-        stimulus.draw()
-        win.flip()
-
-        now = time.time()
-        while now-stim_start <= durations[trial]-.2:
-            stimulus.draw()
-            win.flip()
-
-            if serial_exists:
-                key = str(ser.read())
-            else:
-                key = event.getKeys(['1','2','3','4','5'])
-
-            if '1' in list(key):
-                which_key = '1'
-            elif '2' in list(key):
-                which_key = '2'
-            elif '3' in list(key):
-                which_key = '3'
-            elif '4' in list(key):
-                which_key = '4'
-            elif '5' in list(key):
-                which_key = 'scanner_trigger'
-                logging.info(which_key)
-            else:
-                which_key = False
-
-            if which_key in ['1','2','3','4']:
-                logbids(template_bids.format(
-                    onset=time.time()-run_start,
-                    duration=0.,
-                    stim_type='button_press',
-                    stim_fn=which_key)
-                    )
-            now = time.time()
-    elif stim_type in ['Instruct_Animate','Instruct_Inanimate', 'Instruct_Neutral']:
-        win.logOnFlip(level=logging.EXP, msg='block instructions start')
-        stimulus.draw()
-        win.flip()
-        now = time.time()
-        while now-stim_start <= durations[trial]-.2:
-            stimulus.draw()
-            win.flip()
-
-            if serial_exists:
-                key = str(ser.read())
-            else:
-                key = event.getKeys(['1','2','3','4','5'])
-
-            if '1' in list(key):
-                which_key = '1'
-            elif '2' in list(key):
-                which_key = '2'
-            elif '3' in list(key):
-                which_key = '3'
-            elif '4' in list(key):
-                which_key = '4'
-            elif '5' in list(key):
-                which_key = 'scanner_trigger'
-                logging.info(which_key)
-            else:
-                which_key = False
-
-            if which_key in ['1','2','3','4']:
-                logbids(template_bids.format(
-                    onset=time.time()-run_start,
-                    duration=0.,
-                    stim_type='button_press',
-                    stim_fn=which_key)
-                    )
-            now = time.time()
-    elif stim_type == 'question':
-        now = time.time()
-        # display question
-        stimulus[0].draw()
-        stimulus[1].draw()
-        stimulus[2].draw()
-        stimulus[3].draw()
-        win.flip()
-
-        while now-stim_start <= durations[trial]:
-            if serial_exists:
-                key = str(ser.read())
-            else:
-                key = event.getKeys(['1','2','3','4','5'])
-
-            if '1' in list(key):
-                which_key = '1'
-            elif '2' in list(key):
-                which_key = '2'
-            elif '3' in list(key):
-                which_key = '3'
-            elif '4' in list(key):
-                which_key = '4'
-            elif '5' in list(key):
-                which_key = 'scanner_trigger'
-                logging.info(which_key)
-            else:
-                which_key = False
-
-            if which_key in ['1','2','3','4']:
-                logbids(template_bids.format(
-                    onset=time.time()-run_start,
-                    duration=0.,
-                    stim_type='button_press',
-                    stim_fn=which_key)
-                    )
-            now = time.time()
+    if stim_type == 'sketch':
+        clips.rewind(stimulus)
+        clip_done = lambda: stimulus.status == visual.FINISHED
+        length = sched.frames(stimulus.duration)
     else:
-        # show the sketch
-        now = time.time()
-        while stimulus.status != visual.FINISHED:
-            stimulus.draw()
-            fixation.draw()
-
-            if serial_exists:
-                key = str(ser.read())
-            else:
-                key = event.getKeys(['1','2','3','4','5'])
-
-            if '1' in list(key):
-                which_key = '1'
-            elif '2' in list(key):
-                which_key = '2'
-            elif '3' in list(key):
-                which_key = '3'
-            elif '4' in list(key):
-                which_key = '4'
-            elif '5' in list(key):
-                which_key = 'scanner_trigger'
-                logging.info(which_key)
-            else:
-                which_key = False
-
-            if which_key in ['1','2','3','4']:
-                logbids(template_bids.format(
-                    onset=time.time()-run_start,
-                    duration=0.,
-                    stim_type='button_press',
-                    stim_fn=which_key)
-                    )
-            now = time.time()
-            win.flip()
+        clip_done = None
+        length = segments[-1].end
+    flips.trial = trial
+    onset_frame, stop = drift.start(length)
+    stim_start = run_segments(sched, segments, onset_frame,
+                              on_frame=check_responses, until=clip_done,
+                              stop=stop)
 
     fixation.draw()
-    win.flip()
-    fix_start = time.time()
+    fix_start = sched.flip()
+    drift.finish(stim_start)
 
     print("Stimulus {0} was on for {1}".format(trial_obj+'_'+stim_type,fix_start-stim_start))
 
 
     # log the trial
-    logbids(template_bids.format(
-            onset=stim_start-run_start,
-            duration=time.time()-stim_start,
-            stim_type=stim_type,
-            stim_fn=trial_obj)
-        )
-
-    # while time.time()-stim_start <=durations[trial]+2-trial_jitters[trial]:
+    events.put(stim_start-run_start, fix_start-stim_start, stim_type,
+               trial_obj)
+    events.flush()
+
+    # while core.getTime()-stim_start <=durations[trial]+2-trial_jitters[trial]:
     #     fixation.draw()
     #     win.flip()
 
-    # print("Fixation was on screen for {0}".format(time.time()-fix_start))
-
-    if serial_exists:
-        key = str(ser.read())
-    else:
-        key = event.getKeys(['1','2','3','4','5'])
-
-    if '1' in list(key):
-        which_key = '1'
-    elif '2' in list(key):
-        which_key = '2'
-    elif '3' in list(key):
-        which_key = '3'
-    elif '4' in list(key):
-        which_key = '4'
-    elif '5' in list(key):
-        which_key = 'scanner_trigger'
-        logging.info(which_key)
-    else:
-        which_key = False
-
-    if which_key in ['1','2','3','4']:
-        logbids(template_bids.format(
-            onset=time.time()-run_start,
-            duration=0.,
-            stim_type='button_press',
-            stim_fn=which_key)
-            )
-
-core.wait(6, hogCPUperiod=0.1)
+    # print("Fixation was on screen for {0}".format(core.getTime()-fix_start))
+
+    check_responses()
+
+# the scanner keeps going for the tail, until the last volume of the run is
+# in; in a session the next run's first clips are decoded meanwhile
+n_volumes = int(np.ceil((onsets[-1]+durations[-1]+6)/TR))
+if session.next_run is not None:
+    upcoming = load_run(CSVDIR, participant, session.next_run)
+    session.hold(clips, [clip_path(upcoming['ObjectID'][t], upcoming['StimNo'][t])
+                         for t in range(stimuli.lookahead+1)
+                         if upcoming['StimType'][t] == 'sketch'])
+stimuli.close()
+volumes.wait_for(n_volumes, check_responses, waiter=waiter)
+
+flips_fn = join(RESDIR, 'flips_p{:02d}_r{:02d}.npy'.format(
+                int(participant), int(run)))
+flips.save(flips_fn)
+dropped = "Dropped {0} frames, see {1}".format(flips.dropped,
+                                                 flips_fn[:-4]+'.txt')
+logging.info(dropped)
+print(dropped)
+drift_fn = join(RESDIR, 'drift_p{:02d}_r{:02d}.tsv'.format(
+                int(participant), int(run)))
+drift.save(drift_fn)
+corrected = "{0}, see {1}".format(drift.summary(), drift_fn)
+logging.info(corrected)
+print(corrected)
+volumes_fn = join(RESDIR, 'volumes_p{:02d}_r{:02d}.npy'.format(
+                  int(participant), int(run)))
+volumes.save(volumes_fn)
+scanned = "{0} volumes, TR {1:.6f} s ({2:+.1f} ppm), see {3}".format(
+    len(volumes), volumes.tr, volumes.drift*1e6, volumes_fn[:-4]+'.txt')
+logging.info(scanned)
+print(scanned)
+logging.info('waits: ' + waiter.summary())
 
 finished = "Finished run successfully!"
 logging.info(finished)
 print(finished)
-win.close()
-core.quit()
+events.close()
+if serial_exists:
+    ser.close()
+if session.next_run is None:
+    win.close()
+    core.quit()
+# the next run of the session opens its own log
+logging.flush()
+logging.root.removeTarget(log)
@@ -7,10 +7,14 @@ import sys
 import numpy as np
 from os import makedirs
 from os.path import join, exists, abspath, dirname
-from psychopy import visual, core, event, gui, logging, sound
+from psychopy import visual, core, event, logging
 from psychopy.constants import (NOT_STARTED, STARTED, PLAYING, PAUSED,
                                 STOPPED, FINISHED, PRESSED, RELEASED, FOREVER)
 
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from sketch_fmri.rawmovie import movie_stim
+from sketch_fmri.waiter import shared_waiter
+
 
 # Set up all the relevant directories here
 HERE = abspath(dirname(__file__))
@@ -48,12 +52,12 @@ for obj_no in range(len(sub_objects)):
     trial_obj = sub_objects[obj_no]    # object category
     stim_number = 0    # which exemplar
 
-    # load the sketch video
+    # load the sketch video, from the decoded frames shared with the runs
     clip_fn = join(STIMDIR, trial_obj+'_'+str(stim_number)+'_8s.mov')
-    stimuli[obj_no] = visual.MovieStim3(win, clip_fn,
-                                pos=(0, 0), flipVert=False,
-                                flipHoriz=False, loop=False,
-                                noAudio=True, name=trial_obj)
+    stimuli[obj_no] = movie_stim(win, clip_fn,
+                                 pos=(0, 0), flipVert=False,
+                                 flipHoriz=False, loop=False,
+                                 noAudio=True, name=trial_obj)
 
 instructions = visual.TextStim(win, wrapWidth=1.8,
                 alignHoriz='center', alignVert='center', name='Instructions',
@@ -83,10 +87,13 @@ while instructions_wait:
 
 win.mouseVisible = False
 
+# waits sleep and only spin for the last moment before their deadline
+waiter = shared_waiter()
+
 # Start fixation
 fixation.draw()
 win.flip()
-core.wait(2., hogCPUperiod=0.2)
+waiter.wait(2.)
 
 # Start looping through trials
 for obj_no in range(len(sub_objects)):
@@ -125,10 +132,10 @@ for obj_no in range(len(sub_objects)):
     probe_right.draw()
     win.flip()
 
-    core.wait(2., hogCPUperiod=0.2)
+    waiter.wait(2.)
     fixation.draw()
     win.flip()
-    core.wait(2., hogCPUperiod=0.2)
+    waiter.wait(2.)
 
     # show the sketch
     while stimulus.status != visual.FINISHED:
@@ -138,9 +145,9 @@ for obj_no in range(len(sub_objects)):
 
     fixation.draw()
     win.flip()
-    core.wait(2, hogCPUperiod=0.2)
+    waiter.wait(2)
 
-core.wait(4., hogCPUperiod=0.2)
+waiter.wait(4.)
 
 lay_still = visual.TextStim(win, wrapWidth=1.8,
                 alignHoriz='center', alignVert='center', name='Instructions',
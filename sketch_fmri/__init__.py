@@ -0,0 +1,4 @@
+# Shared helpers for the exp_1 and exp_2 presentation scripts.
+#
+# The presentation scripts are run from inside their experiment directory,
+# so they put the repository root on sys.path before importing from here.
@@ -0,0 +1,203 @@
+"""Texture atlas for the photos of a run.
+
+Instead of an ImageStim per photo trial, each decoding its PNG and
+uploading its own texture, the distinct photos of a run are packed into
+one (or, if they do not fit, a few) large textures when the run loads,
+along with the fixation images. A photo is drawn as a rectangle of that
+texture, and a photo with the fixation on top is two rectangles of the
+same texture drawn in one call (see `sketch_fmri.composite`).
+"""
+
+import ctypes
+from collections import namedtuple
+
+import numpy as np
+
+from sketch_fmri.stimcache import shared_cache
+
+Region = namedtuple('Region', ['page', 'x', 'y', 'width', 'height'])
+Region.__doc__ = """Where an image is in the atlas: its page, and the
+bottom-left corner and size of its rectangle in pixels."""
+
+MAX_PAGE_SIZE = 4096
+
+
+def shelf_pack(sizes, page_size, gutter=1):
+    """Place (width, height) rectangles on square pages of `page_size`.
+
+    Rectangles go tallest first onto shelves, left to right, `gutter`
+    pixels apart. Returns ([(page, x, y)] in the order of `sizes`,
+    [(width, height) used on each page]).
+    """
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i][1])
+    placed = [None] * len(sizes)
+    used = []
+    x = y = shelf = 0
+    for i in order:
+        width, height = sizes[i]
+        if width > page_size or height > page_size:
+            raise ValueError('a {0}x{1} image does not fit a {2} pixel '
+                             'atlas page'.format(width, height, page_size))
+        if used and x + width > page_size:
+            x, y, shelf = 0, y + shelf + gutter, 0
+        if not used or y + height > page_size:
+            used.append((0, 0))
+            x = y = shelf = 0
+        placed[i] = (len(used) - 1, x, y)
+        x += width + gutter
+        shelf = max(shelf, height)
+        used[-1] = (max(used[-1][0], x - gutter), max(used[-1][1], y + shelf))
+    return placed, used
+
+
+class AtlasStim(object):
+    """One image of a `TextureAtlas`, drawn like an ImageStim at its native
+    pixel size."""
+
+    def __init__(self, atlas, image_fn, pos=(0, 0), units=None, name=None,
+                 autoLog=None):
+        self.atlas = atlas
+        self.image_fn = image_fn
+        self.pos = pos
+        self.units = units or atlas.win.units
+        self.name = name
+
+    def draw(self, win=None):
+        self.atlas.draw([(self.image_fn,
+                          self.atlas.to_pix(self.pos, self.units))])
+
+
+class AtlasGroup(object):
+    """Images of a `TextureAtlas` at fixed pixel positions, drawn in order
+    with one call per atlas page."""
+
+    def __init__(self, atlas, placed):
+        self.atlas = atlas
+        self.placed = list(placed)
+
+    def draw(self, win=None):
+        self.atlas.draw(self.placed)
+
+
+class TextureAtlas(object):
+    """Images packed into as few textures as they fit in, uploaded once.
+
+    Images are read from the stimulus cache (the shared
+    `sketch_fmri.stimcache.StimulusCache` unless `cache` is given). Call
+    `close` once the atlas is no longer drawn to free its textures.
+    """
+
+    def __init__(self, win, image_fns, page_size=None, cache=None):
+        self.win = win
+        self.cache = cache
+        image_fns = sorted(set(image_fns))
+        images = [self._load(fn) for fn in image_fns]
+        if page_size is None:
+            page_size = self._max_page_size()
+        placed, used = shelf_pack([(image.shape[1], image.shape[0])
+                                   for image in images], page_size)
+        pages = [np.zeros((height, width, 4), dtype=np.uint8)
+                 for width, height in used]
+        self.regions = {}
+        for fn, image, (page, x, y) in zip(image_fns, images, placed):
+            height, width = image.shape[:2]
+            pages[page][y:y + height, x:x + width] = image
+            self.regions[fn] = Region(page, x, y, width, height)
+        self.page_sizes = used
+        self._textures = [self._upload(page) for page in pages]
+
+    def __contains__(self, image_fn):
+        return image_fn in self.regions
+
+    def stim(self, image_fn, **kwargs):
+        """An `AtlasStim` of `image_fn`, which must be in the atlas."""
+        if image_fn not in self.regions:
+            raise KeyError('{0} is not in the atlas'.format(image_fn))
+        return AtlasStim(self, image_fn, **kwargs)
+
+    def group(self, placed):
+        """An `AtlasGroup` of (image file, pixel position) pairs."""
+        return AtlasGroup(self, placed)
+
+    def to_pix(self, pos, units):
+        """`pos` in `units` of the window as pixels from its centre."""
+        from psychopy.tools.monitorunittools import convertToPix
+        return convertToPix(np.zeros(2), np.asarray(pos, float), units,
+                            self.win)
+
+    def draw(self, placed):
+        """Draw (image file, pixel position) pairs, one call per page."""
+        by_page = {}
+        for image_fn, (x, y) in placed:
+            region = self.regions[image_fn]
+            width, height = self.page_sizes[region.page]
+            # texture and screen rectangles, both (left, bottom, right, top)
+            by_page.setdefault(region.page, []).append((
+                (region.x / float(width), region.y / float(height),
+                 (region.x + region.width) / float(width),
+                 (region.y + region.height) / float(height)),
+                (x - region.width / 2., y - region.height / 2.,
+                 x + region.width / 2., y + region.height / 2.)))
+        for page in sorted(by_page):
+            self._draw_page(self._textures[page], by_page[page])
+
+    def close(self):
+        """Free the atlas textures."""
+        for texture in self._textures:
+            self._delete(texture)
+        self._textures = []
+
+    def _load(self, image_fn):
+        """Bottom-up RGBA pixels of `image_fn`."""
+        cache = self.cache if self.cache is not None else shared_cache()
+        return cache.image(image_fn)
+
+    def _max_page_size(self):
+        import pyglet.gl as GL
+        size = GL.GLint()
+        GL.glGetIntegerv(GL.GL_MAX_TEXTURE_SIZE, ctypes.byref(size))
+        return min(size.value, MAX_PAGE_SIZE)
+
+    def _upload(self, page):
+        import pyglet.gl as GL
+        texture = GL.GLuint()
+        GL.glGenTextures(1, ctypes.byref(texture))
+        GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+        # nearest like ImageStim without interpolate, so no gutter is sampled
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER,
+                           GL.GL_NEAREST)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER,
+                           GL.GL_NEAREST)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        page = np.ascontiguousarray(page)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, page.shape[1],
+                        page.shape[0], 0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE,
+                        page.ctypes.data_as(ctypes.c_void_p))
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        return texture
+
+    def _delete(self, texture):
+        import pyglet.gl as GL
+        GL.glDeleteTextures(1, ctypes.byref(texture))
+
+    def _draw_page(self, texture, quads):
+        import pyglet.gl as GL
+        GL.glPushMatrix()
+        self.win.setScale('pix')
+        GL.glEnable(GL.GL_TEXTURE_2D)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+        GL.glColor4f(1., 1., 1., 1.)
+        GL.glBegin(GL.GL_QUADS)
+        for (s0, t0, s1, t1), (x0, y0, x1, y1) in quads:
+            GL.glTexCoord2f(s0, t0)
+            GL.glVertex2f(x0, y0)
+            GL.glTexCoord2f(s1, t0)
+            GL.glVertex2f(x1, y0)
+            GL.glTexCoord2f(s1, t1)
+            GL.glVertex2f(x1, y1)
+            GL.glTexCoord2f(s0, t1)
+            GL.glVertex2f(x0, y1)
+        GL.glEnd()
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        GL.glDisable(GL.GL_TEXTURE_2D)
+        GL.glPopMatrix()
@@ -0,0 +1,254 @@
+"""Benchmarks for the presentation scripts, run headless.
+
+Each presentation script is played on the virtual clock of
+`sketch_fmri.simulate` against an existing run file, and the real time it
+spends is measured: the load phase up to the trigger wait, and the cost of
+a frame in each trial type. Drawing is stubbed out, so a frame's cost is
+the Python work of the loop, not the GPU's. The events writer and input
+polling are timed on their own. Each result is the best of several
+repeats. Results are written as JSON and can be compared against a stored
+baseline; anything slower than the baseline by more than the tolerance (and
+for times, by more than a microsecond) is flagged and the exit status is 1.
+
+    python -m sketch_fmri.bench --save bench_baseline.json
+    python -m sketch_fmri.bench --compare bench_baseline.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+
+from os.path import abspath, dirname, exists, join
+
+import numpy as np
+
+ROOT = dirname(dirname(abspath(__file__)))
+SCRIPTS = {'exp_1': 'exp_1/sketch-morph_presentation_fmri.py',
+           'ambisketch': 'exp_2/ambisketch_presentation_fmri.py',
+           'sketchID': 'exp_2/sketchID_presentation_fmri.py'}
+# run files each script is played against by default: exp_1 runs alternate
+# sketch and photo, so runs 1 and 2 cover both frame loops; exp_2 runs 1-4
+# are sketchID runs and from 5 on ambisketch runs, with the Instruct and
+# Prepare screens
+DEFAULT_RUNS = {'exp_1': (1, 2), 'ambisketch': (5,), 'sketchID': (1,)}
+
+
+def trial_types(stim_types):
+    """Group the run file's StimType values the way the frame loops do."""
+    return [stim_type.split('_')[0] for stim_type in stim_types]
+
+
+def bench_script(name, script, participant, run):
+    """Load phase and per-frame cost of one simulated run.
+
+    Raises RuntimeError if the run file is missing or the script fails, so
+    a run that cannot be played is never left out of a comparison.
+    """
+    import pandas as pd
+    from sketch_fmri.simulate import simulate
+
+    runs = join(dirname(script), 'runs',
+                'Sub{:02d}_Run{:02d}.csv'.format(participant, run))
+    if not exists(runs):
+        raise RuntimeError('{0}: no {1}'.format(name, runs))
+    with tempfile.TemporaryDirectory() as res:
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                sim = simulate(script, participant, run, res=res)
+        except Exception as err:
+            raise RuntimeError('{0} failed on {1}: {2!r}'.format(
+                name, runs, err)) from err
+        flips = np.load(join(res, 'flips_p{:02d}_r{:02d}.npy'.format(
+            participant, run)))
+    results = {name + '.load': sim.real_listen - sim.real_start}
+
+    # flips after the trigger are the last len(flips) the window made
+    real = np.asarray(sim.real_flips[-len(flips):])
+    cost = np.diff(real)
+    busy = np.diff(flips['frame']) == 1
+    same = flips['trial'][1:] == flips['trial'][:-1]
+    frame_trials = flips['trial'][1:]
+    kinds = np.array(trial_types(pd.read_csv(runs)['StimType']))
+    for kind in np.unique(kinds):
+        trials = np.flatnonzero(kinds == kind)
+        keep = busy & same & np.isin(frame_trials, trials)
+        if keep.any():
+            results['{0}.frame.{1}'.format(name, kind)] = float(
+                np.median(cost[keep]))
+    return results
+
+
+def bench_events(n_rows=20000):
+    """Cost of queueing one row, and rows written per second end to end."""
+    from sketch_fmri.bidsevents import EventsWriter
+
+    with tempfile.TemporaryDirectory() as tmp:
+        events = EventsWriter(join(tmp, 'events.tsv'),
+                              ('onset', 'duration', 'stim_type', 'stim_fn'),
+                              ('{:.3f}', '{:.3f}', '{}', '{}'))
+        start = time.perf_counter()
+        for row in range(n_rows):
+            events.put(row * .5, 0., 'button_press', '1')
+        queued = time.perf_counter()
+        events.close()
+        done = time.perf_counter()
+    return {'events.put': (queued - start) / n_rows,
+            'events.rows_per_s': n_rows / (done - start)}
+
+
+class _Port(object):
+    """In-memory serial port that hands out `data` in reads of `chunk`."""
+
+    def __init__(self, data, chunk):
+        self.data = data
+        self.chunk = chunk
+        self.timeout = None
+        self.in_waiting = 0
+
+    def read(self, size=1):
+        if not self.data:
+            time.sleep(self.timeout or 0.)
+            return b''
+        size = max(size, self.chunk)
+        out, self.data = self.data[:size], self.data[size:]
+        return out
+
+    def flushInput(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def bench_input(n_polls=20000, n_bytes=2000):
+    """Cost of an input poll with nothing pending and with a burst pending."""
+    from sketch_fmri.inputbus import InputBus
+    from sketch_fmri.serialreader import SerialReader
+
+    keymap = {'1': '1', '2': '2', '5': 'scanner_trigger'}
+    reader = SerialReader(_Port(b'', 1))
+    bus = InputBus(keymap, serial=reader, keyboard=False)
+    start = time.perf_counter()
+    for poll in range(n_polls):
+        bus.poll()
+    idle = (time.perf_counter() - start) / n_polls
+
+    reader = SerialReader(_Port(b'125' * (n_bytes // 3), 64)).start()
+    while reader.pending() < n_bytes // 3 * 3:
+        time.sleep(0.001)
+    bus = InputBus(keymap, serial=reader, keyboard=False)
+    start = time.perf_counter()
+    found = bus.poll()
+    burst = (time.perf_counter() - start) / len(found)
+    reader.close()
+    return {'input.poll_idle': idle, 'input.poll_per_event': burst}
+
+
+# results where bigger is better; everything else is a time
+HIGHER_IS_BETTER = ('events.rows_per_s',)
+
+
+def regressions(results, baseline, tolerance, floor=1e-6):
+    """Names of results worse than `baseline` by more than `tolerance`.
+
+    A time must also be more than `floor` seconds slower: the per-call
+    timings are a fraction of a microsecond, where timer noise alone is more
+    than any relative tolerance.
+    """
+    slower = []
+    for name, value in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if name in HIGHER_IS_BETTER:
+            worse = value < base / (1 + tolerance)
+        else:
+            worse = value - base > max(base * tolerance, floor)
+        if worse:
+            slower.append(name)
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--participant', type=int, default=1)
+    parser.add_argument('--run', type=int,
+                        help='run file for every script (default exp_1 '
+                             'runs 1 and 2, ambisketch 5, sketchID 1)')
+    parser.add_argument('--script-run', action='append', default=[],
+                        metavar='NAME=RUN',
+                        help='run file for one script, e.g. ambisketch=5, '
+                             'may be given more than once per script (the '
+                             'exp_2 scripts share a runs directory)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='take the best of this many repeats')
+    parser.add_argument('--save', metavar='JSON',
+                        help='write the results here (e.g. as a baseline)')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='baseline to compare the results against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='flag results this much worse than baseline')
+    parser.add_argument('--floor', type=float, default=1e-6,
+                        help='and times at least this many seconds slower '
+                             '(default %(default)s)')
+    args = parser.parse_args(argv)
+    script_runs = dict(DEFAULT_RUNS)
+    if args.run is not None:
+        script_runs = dict.fromkeys(SCRIPTS, (args.run,))
+    overridden = set()
+    for override in args.script_run:
+        name, run = override.split('=')
+        if name not in SCRIPTS:
+            parser.error('unknown script {0}, one of {1}'.format(
+                name, ', '.join(sorted(SCRIPTS))))
+        if name not in overridden:
+            script_runs[name] = ()
+            overridden.add(name)
+        script_runs[name] += (int(run),)
+
+    sys.path.insert(0, ROOT)
+    from sketch_fmri.simulate import install
+    install()
+
+    results = {}
+    for repeat in range(args.repeat):
+        found = [dict(bench_events(), **bench_input())]
+        for name, script in sorted(SCRIPTS.items()):
+            # runs of one script give the same names, e.g. exp_1.load
+            found += [bench_script(name, join(ROOT, script),
+                                   args.participant, run)
+                      for run in script_runs[name]]
+        for name, value in [item for timed in found
+                            for item in timed.items()]:
+            best = max if name in HIGHER_IS_BETTER else min
+            results[name] = best(results.get(name, value), value)
+
+    for name, value in sorted(results.items()):
+        print('{0:<32}{1:.6g}'.format(name, value))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'machine': platform.node(),
+                       'python': platform.python_version(),
+                       'results': results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        slower = regressions(results, baseline, args.tolerance, args.floor)
+        for name in slower:
+            print('SLOWER {0}: {1:.6g} vs baseline {2:.6g}'.format(
+                name, results[name], baseline[name]))
+        missing = sorted(set(baseline) - set(results))
+        for name in missing:
+            print('MISSING {0}: in the baseline, not measured'.format(name))
+        if slower or missing:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""Buffered writer for a run's BIDS ``_events.tsv``.
+
+The frame loops hand over rows as plain tuples of numbers and strings. A
+background thread formats them and writes the file, so no string formatting
+or logging lock is taken in frame-critical code.
+"""
+
+import queue
+import threading
+
+_FLUSH = object()
+_CLOSE = object()
+
+
+class EventsWriter(object):
+    """Write rows to a tab-separated events file on a background thread.
+
+    columns names the header and formats gives a format spec per column,
+    e.g. ``('{:.3f}', '{:.3f}', '{}', '{}')``. None is written as ``n/a``.
+    """
+
+    def __init__(self, path, columns, formats):
+        if len(columns) != len(formats):
+            raise ValueError('need one format per column')
+        self.path = path
+        self.columns = tuple(columns)
+        self.formats = tuple(formats)
+        self._queue = queue.SimpleQueue()
+        self._file = open(path, 'w')
+        self._file.write('\t'.join(self.columns) + '\n')
+        self._thread = threading.Thread(target=self._run, name='EventsWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, *row):
+        """Queue one row; cheap enough to call inside a frame loop."""
+        self._queue.put(row)
+
+    def flush(self):
+        """Ask the writer to push everything queued so far to disk."""
+        self._queue.put(_FLUSH)
+
+    def close(self):
+        """Write out every queued row and close the file."""
+        self._queue.put(_CLOSE)
+        self._thread.join()
+
+    def _format(self, row):
+        return '\t'.join('n/a' if value is None else fmt.format(value)
+                         for fmt, value in zip(self.formats, row)) + '\n'
+
+    def _run(self):
+        f = self._file
+        while True:
+            row = self._queue.get()
+            if row is _CLOSE:
+                break
+            elif row is _FLUSH:
+                f.flush()
+            else:
+                f.write(self._format(row))
+        f.close()
@@ -0,0 +1,89 @@
+"""Shared cache of decoded sketch clips.
+
+A run shows the same ``<ObjectID>_<StimNo>_<len>.mov`` file many times (one-back
+repeats, the m sequence), so each distinct clip is decoded once and the movie
+stimulus is shared by every trial that uses it.
+"""
+
+import hashlib
+import os
+
+from psychopy.constants import NOT_STARTED
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Return the sha1 hex digest of the contents of `path`."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ClipCache(object):
+    """Decode each clip file once and share the stimulus across trials.
+
+    Clips are keyed by the contents of the file, so two file names pointing
+    at identical footage also share a decoder. Call `rewind` on a clip
+    before each trial that plays it, and `release` once a trial is done with
+    it so the decoder is freed when no loaded trial still uses it.
+
+    movie_class is called as ``movie_class(win, path, name=..., **kwargs)``
+    and defaults to `psychopy.visual.MovieStim3`.
+    """
+
+    def __init__(self, win, movie_class=None, **movie_kwargs):
+        if movie_class is None:
+            from psychopy import visual
+            movie_class = visual.MovieStim3
+        self.win = win
+        self.movie_class = movie_class
+        self.movie_kwargs = movie_kwargs
+        self._clips = {}
+        self._digests = {}
+        self._users = {}
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._clips)
+
+    def key(self, path):
+        """Content key for `path`, hashed once per (path, size, mtime)."""
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        stamp = (path, st.st_size, st.st_mtime)
+        if stamp not in self._digests:
+            self._digests[stamp] = file_digest(path)
+        return self._digests[stamp]
+
+    def get(self, path, name=None):
+        """Return the shared movie stimulus for `path`, decoding on first use."""
+        key = self.key(path)
+        clip = self._clips.get(key)
+        if clip is None:
+            clip = self.movie_class(self.win, path, name=name,
+                                    **self.movie_kwargs)
+            self._clips[key] = clip
+            self._keys[id(clip)] = key
+        self._users[key] = self._users.get(key, 0) + 1
+        return clip
+
+    def release(self, clip):
+        """Drop one use of `clip`, unloading it once nothing uses it."""
+        key = self._keys.get(id(clip))
+        if key is None:
+            return
+        self._users[key] -= 1
+        if self._users[key] == 0:
+            del self._users[key], self._clips[key], self._keys[id(clip)]
+            clip.stop()
+
+    def rewind(self, clip):
+        """Put a shared clip back at its first frame before it plays again."""
+        if clip.status == NOT_STARTED:
+            return clip
+        if getattr(clip, '_mov', True) is None:
+            # MovieStim3 may release its reader once the clip has finished
+            clip.loadMovie(clip.filename)
+        clip.reset()
+        return clip
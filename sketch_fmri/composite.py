@@ -0,0 +1,105 @@
+"""Stimuli with the fixation overlay baked in.
+
+Sketch and photo frames draw the stimulus and then the fixation ImageStim
+on top of it, two draws and a blended overlay per frame. A `Compositor`
+makes that one draw instead: a clip played by
+`sketch_fmri.rawmovie.RawMovieStim` has the fixation blended into each
+frame as the frame is read, before its upload, and a photo in a
+`sketch_fmri.atlas.TextureAtlas` is drawn together with the fixation from
+the same atlas texture in one call. `Compositor.bake` rewrites a compiled
+trial's segments to draw those.
+"""
+
+import numpy as np
+from psychopy.tools.monitorunittools import convertToPix
+
+from sketch_fmri.atlas import AtlasStim
+from sketch_fmri.stimcache import shared_cache
+
+
+class OverlaidMovie(object):
+    """Draws a shared clip with one overlay blended into its frames."""
+
+    def __init__(self, clip, overlay):
+        self.clip = clip
+        self.overlay = overlay
+
+    def draw(self, win=None):
+        self.clip.overlay = self.overlay
+        self.clip.draw(win)
+
+
+class Compositor(object):
+    """Bake overlay images into the stimuli they are drawn on top of.
+
+    overlays is a sequence of (overlay stimulus, image file) pairs, e.g. the
+    fixation and dimmed fixation ImageStims and their PNGs. Overlays are
+    placed at their own `pos`, so a photo moved between showings is drawn
+    with the fixation still at the fixation's position. Overlay images are
+    read from the stimulus cache, the shared
+    `sketch_fmri.stimcache.StimulusCache` unless `cache` is given.
+    """
+
+    def __init__(self, win, overlays, cache=None):
+        self.win = win
+        self.overlays = list(overlays)
+        self.cache = cache
+        self._rgba = {}
+
+    def bake(self, segments, stimulus):
+        """Return `segments` with each ``(stimulus, overlay)`` draw replaced
+        by one draw of the composite, where `stimulus` can be composited."""
+        pos = stimulus.pos
+        baked = []
+        for seg in segments:
+            for stim, new_pos in seg.moves:
+                if stim is stimulus:
+                    pos = new_pos
+            if len(seg.stims) == 2 and seg.stims[0] is stimulus:
+                composite = self.composite(stimulus, seg.stims[1], pos)
+                if composite is not None:
+                    seg = seg._replace(stims=(composite,))
+            baked.append(seg)
+        return baked
+
+    def composite(self, stimulus, overlay, pos):
+        """`stimulus` at `pos` with `overlay` on top as one stimulus, or None
+        if `overlay` is not known or `stimulus` cannot be composited."""
+        overlay_fn = self._overlay_fn(overlay)
+        if overlay_fn is None:
+            return None
+        if isinstance(stimulus, AtlasStim):
+            atlas = stimulus.atlas
+            if overlay_fn not in atlas:
+                return None
+            # both rectangles come from the atlas, so this is one draw
+            return atlas.group([
+                (stimulus.image_fn, atlas.to_pix(pos, stimulus.units)),
+                (overlay_fn, atlas.to_pix(overlay.pos, overlay.units))])
+        if hasattr(stimulus, 'overlay'):
+            # a RawMovieStim, which blends the overlay into each frame
+            offset = self._offset(overlay, pos, stimulus.units)
+            return OverlaidMovie(stimulus, (self._overlay_rgba(overlay_fn),
+                                            tuple(offset)))
+        return None
+
+    def _overlay_fn(self, overlay):
+        for stim, image_fn in self.overlays:
+            if stim is overlay:
+                return image_fn
+        return None
+
+    def _offset(self, overlay, pos, units):
+        """Pixel offset of `overlay`'s centre from a stimulus at `pos`."""
+        zero = np.zeros(2)
+        return (convertToPix(zero, np.asarray(overlay.pos, float),
+                             overlay.units, self.win) -
+                convertToPix(zero, np.asarray(pos, float), units, self.win))
+
+    def _overlay_rgba(self, overlay_fn):
+        """Bottom-up float32 RGBA of `overlay_fn` in [0, 1], loaded once."""
+        if overlay_fn not in self._rgba:
+            cache = self.cache if self.cache is not None else shared_cache()
+            over = np.asarray(cache.image(overlay_fn), dtype=np.float32)
+            self._rgba[overlay_fn] = over / 255
+        return self._rgba[overlay_fn]
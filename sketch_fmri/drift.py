@@ -0,0 +1,153 @@
+"""Planned against actual trial onsets, and how overruns are absorbed.
+
+Every trial has a planned onset and end frame on the run's frame grid,
+from the run CSV's onsets and durations. A trial that starts late (a decode
+stall, the trial before it running over) would push everything after it
+back unless the lost time is taken from somewhere. Each trial type has a
+policy for that:
+
+drop_frames -- keep the trial on its planned frames, skipping whatever was
+    due while it was late; it ends on its planned end frame
+truncate -- play the trial from its start and cut it at its planned end
+
+The next onset stays on its planned frame in either case, so the run length
+and its alignment to the TRs do not change. Nothing can be planned for
+frame 0, the flip that anchors the grid, so a trial due then is planned for
+frame 1. A trial ends on the flip that puts the fixation up, so a trial
+followed straight away by the next one is planned to end the frame before
+the next onset. Every trial's planned and
+actual frames and the correction made are saved as a table next to the
+flip record.
+"""
+
+from psychopy import logging
+
+POLICIES = ('drop_frames', 'truncate')
+COLUMNS = ('trial', 'stim_type', 'policy', 'planned_onset', 'onset',
+           'planned_end', 'end', 'late', 'dropped', 'truncated',
+           'fixation_lost', 'correction')
+
+
+class DriftCorrector(object):
+    """Plan each trial of a run on the frame grid and record how it went.
+
+    sched is the run's `FrameScheduler` and run_start the time of the first
+    trigger. policies maps a stim type to one of POLICIES, other types get
+    `default`. clock(seconds), if given, is the time of an onset that many
+    seconds into the run (e.g. `VolumeClock.time_at`), by default it is
+    run_start + seconds. For each trial call `plan` before waiting for its
+    onset, `start` once the onset is due, and `finish` after the flip that
+    ends it.
+    """
+
+    def __init__(self, sched, run_start, onsets, durations, stim_types,
+                 policies=None, default='drop_frames', clock=None):
+        policies = dict(policies or {})
+        for policy in list(policies.values()) + [default]:
+            if policy not in POLICIES:
+                raise ValueError('unknown overrun policy {0!r}'.format(policy))
+        self.sched = sched
+        self.run_start = run_start
+        self.onsets = onsets
+        self.durations = durations
+        self.stim_types = stim_types
+        self.policies = policies
+        self.default = default
+        if clock is None:
+            clock = lambda seconds: run_start + seconds
+        self.clock = clock
+        self.rows = []
+        self.trial = None
+        self.planned = self.planned_end = None
+
+    def policy(self, trial):
+        return self.policies.get(self.stim_types[trial], self.default)
+
+    def plan(self, trial):
+        """Planned onset frame of `trial`, to wait for."""
+        self.trial = trial
+        # frame 0 is the flip that anchors the grid, an onset at 0 s (or
+        # placed before it by the volume clock) is due on the first flip
+        # after it
+        self.planned = max(1, self.sched.frame_at(
+            self.clock(self.onsets[trial])))
+        self.planned_end = self.sched.frame_at(
+            self.clock(self.onsets[trial] + self.durations[trial]))
+        if trial + 1 < len(self.onsets):
+            self.planned_end = min(self.planned_end, self.sched.frame_at(
+                self.clock(self.onsets[trial + 1])) - 1)
+        return self.planned
+
+    def start(self, length):
+        """Start the planned trial, `length` frames of content long (may be
+        inf); returns (onset frame, frames after it the trial is cut at) to
+        pass on to `run_segments`."""
+        due = self.sched.next_frame()
+        self._late = max(0, due - self.planned)
+        self._length = length
+        self._dropped = self._recorded_drops()
+        if self.policy(self.trial) == 'drop_frames':
+            self._onset = self.planned
+        else:
+            self._onset = self.planned + self._late
+        return self._onset, self.planned_end - self._onset
+
+    def finish(self, onset_t):
+        """Record the trial, given the timestamp of its onset flip; the
+        latest flip is taken as the one that ended it. Returns the
+        correction made under the trial's policy: 'truncated' if it was cut
+        short, 'dropped_frames' if it started late or the flip that ended
+        it landed late (fixation lost), and 'none' if the trial went to
+        plan."""
+        policy = self.policy(self.trial)
+        end = self.sched.frame
+        late = self._late
+        truncated = fixation_lost = 0
+        if policy == 'drop_frames':
+            # what was due before the late start is never shown
+            truncated = min(late, self._length)
+        elif policy == 'truncate' and self._length != float('inf'):
+            truncated = max(0, self._onset + self._length - self.planned_end)
+        fixation_lost = max(0, end - self.planned_end)
+        dropped = self._recorded_drops() - self._dropped
+        if truncated and policy == 'truncate':
+            correction = 'truncated'
+        elif truncated or late or fixation_lost:
+            correction = 'dropped_frames'
+        else:
+            correction = 'none'
+        self.rows.append((self.trial, self.stim_types[self.trial], policy,
+                          self.planned, self.sched.frame_at(onset_t),
+                          self.planned_end, end, late, dropped, truncated,
+                          fixation_lost, correction))
+        if correction != 'none':
+            logging.info('trial {0} {1}: started {2} frames late, {3} frames '
+                         'cut, {4} frames of fixation lost'.format(
+                             self.trial, correction, late, truncated,
+                             fixation_lost))
+        return correction
+
+    def _recorded_drops(self):
+        recorder = self.sched.recorder
+        return 0 if recorder is None else recorder.dropped
+
+    def corrections(self):
+        """Rows of the trials that needed a correction."""
+        return [row for row in self.rows if row[-1] != 'none']
+
+    def summary(self):
+        """One line on how many trials needed correcting."""
+        corrected = self.corrections()
+        return ('{0} of {1} trials corrected: {2} started late, {3} frames '
+                'cut, {4} frames of fixation lost'.format(
+                    len(corrected), len(self.rows),
+                    sum(1 for row in self.rows if row[7]),
+                    sum(row[9] for row in self.rows),
+                    sum(row[10] for row in self.rows)))
+
+    def save(self, path):
+        """Write every trial's row as a tab-separated table."""
+        with open(path, 'w') as f:
+            f.write('\t'.join(COLUMNS) + '\n')
+            for row in self.rows:
+                f.write('\t'.join(str(value) for value in row) + '\n')
@@ -0,0 +1,111 @@
+"""Flip timestamps for a run, and a dropped-frame report.
+
+Every flip made through the `FrameScheduler` is recorded into a preallocated
+array together with the index of the trial on screen. That is every flip
+from the one after the trigger that anchors the frame grid to the end of
+the run; the flips before it (loading and waiting screens, measuring the
+frame period) are made with `win.flip()` and are not recorded, as they put
+up static screens with no target frame to miss. At the end of the run the
+array is saved as ``.npy`` and summarised (frame intervals, dropped frames
+per trial, worst stalls) in a text file next to it.
+"""
+
+from os.path import splitext
+
+import numpy as np
+
+FLIP = np.dtype([('t', 'f8'), ('frame', 'i4'), ('trial', 'i4'),
+                 ('dropped', 'i4')])
+
+
+class FlipRecorder(object):
+    """Preallocated record of flip timestamps.
+
+    Each flip is stored with the frame it landed on, the trial on screen and
+    how many frames later than its target frame it landed. Idle stretches
+    without flips (waiting for an onset) are not counted as dropped. Set
+    `trial` when a trial starts; flips before the first trial are recorded
+    with trial -1. The array doubles in size if the run turns out longer than
+    `capacity` flips.
+    """
+
+    def __init__(self, capacity, period):
+        self.period = period
+        self.trial = -1
+        self._flips = np.zeros(int(capacity), dtype=FLIP)
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def record(self, t, frame, dropped=0):
+        """Store one flip for the current trial."""
+        if self._n == len(self._flips):
+            self._flips = np.concatenate([self._flips,
+                                          np.zeros_like(self._flips)])
+        self._flips[self._n] = (t, frame, self.trial, dropped)
+        self._n += 1
+
+    @property
+    def flips(self):
+        return self._flips[:self._n]
+
+    @property
+    def dropped(self):
+        """Total number of frames dropped so far."""
+        return int(self.flips['dropped'].sum())
+
+    def summary(self, n_stalls=10):
+        """Return the text report of frame intervals and dropped frames."""
+        return summarize(self.flips, self.period, n_stalls)
+
+    def save(self, path, n_stalls=10):
+        """Save the flips to `path` (.npy) and the summary beside it (.txt)."""
+        np.save(path, self.flips)
+        with open(splitext(path)[0] + '.txt', 'w') as f:
+            f.write(self.summary(n_stalls))
+
+
+def summarize(flips, period, n_stalls=10):
+    """Text report for a flip array as saved by `FlipRecorder`.
+
+    Interval statistics only use consecutive frames' flips, not the gaps
+    where the screen was deliberately left alone.
+    """
+    lines = ['flips: {0}'.format(len(flips)),
+             'frame period: {0:.3f} ms'.format(period * 1000),
+             'dropped frames: {0}'.format(flips['dropped'].sum())]
+    if len(flips) < 2:
+        return '\n'.join(lines) + '\n'
+
+    intervals = np.diff(flips['t']) * 1000
+    steps = np.diff(flips['frame'])
+    busy = intervals[steps - flips['dropped'][1:] == 1]
+    if len(busy):
+        lines.append('intervals (ms): mean {0:.3f} sd {1:.3f} median {2:.3f} '
+                     'min {3:.3f} max {4:.3f}'.format(
+                         busy.mean(), busy.std(), np.median(busy),
+                         busy.min(), busy.max()))
+
+    lines.append('')
+    lines.append('trial\tflips\tdropped')
+    # grouped by trial wherever a trial's flips are in the record, as those
+    # of trial -1 or a trial shown again are not all in one stretch
+    trials, index, counts = np.unique(flips['trial'], return_inverse=True,
+                                      return_counts=True)
+    per_trial = np.bincount(index.ravel(), weights=flips['dropped'],
+                            minlength=len(trials)).astype(int)
+    for trial, count, n_dropped in zip(trials, counts, per_trial):
+        lines.append('{0}\t{1}\t{2}'.format(trial, count, n_dropped))
+
+    lines.append('')
+    lines.append('worst stalls')
+    lines.append('t\ttrial\tinterval_ms\tdropped')
+    order = np.lexsort((intervals, flips['dropped'][1:]))[::-1][:n_stalls]
+    for i in order:
+        if flips['dropped'][i + 1] == 0:
+            break
+        lines.append('{0:.4f}\t{1}\t{2:.3f}\t{3}'.format(
+            flips['t'][i + 1], flips['trial'][i + 1], intervals[i],
+            flips['dropped'][i + 1]))
+    return '\n'.join(lines) + '\n'
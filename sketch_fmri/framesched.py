@@ -0,0 +1,90 @@
+"""Frame-count scheduling.
+
+The refresh period is measured once, then every onset and duration from the
+run CSV is turned into a frame index on a grid anchored to a real flip. The
+next stimulus is drawn into the back buffer during the frame before its onset
+and the flip lands on the target frame, instead of on whichever vsync follows
+a `core.wait`.
+"""
+
+import numpy as np
+from psychopy import core
+
+from sketch_fmri.waiter import shared_waiter
+
+
+def measure_frame_period(win, n_frames=60, warmup=10):
+    """Flip `n_frames` times and return the median interval in seconds."""
+    for frame in range(warmup):
+        win.flip()
+    stamps = np.empty(n_frames)
+    for frame in range(n_frames):
+        stamps[frame] = win.flip()
+    return float(np.median(np.diff(stamps)))
+
+
+class FrameScheduler(object):
+    """Track which frame is on screen and flip on target frames.
+
+    t0 is the timestamp of a flip that defines frame 0. `frame` is the index
+    of the frame on screen after the latest flip, advanced by the number of
+    refresh periods between flip timestamps, so a dropped frame shifts the
+    count rather than the schedule. Times are extrapolated from the latest
+    flip, so a small error in the measured period does not build up over a
+    run. Flip timestamps, those of the flips made through the scheduler
+    only, are passed on to `recorder` (a `FlipRecorder`), if given. Waits go through `waiter`, by default the shared `PrecisionWaiter`.
+    """
+
+    def __init__(self, win, period, t0, margin=0.25, recorder=None,
+                 waiter=None):
+        self.win = win
+        self.period = period
+        self.margin = margin
+        self.recorder = recorder
+        self.waiter = waiter if waiter is not None else shared_waiter()
+        self.frame = 0
+        self.last_t = t0
+        if recorder is not None:
+            recorder.record(t0, 0)
+
+    def frames(self, seconds):
+        """Number of whole frames closest to `seconds` (inf stays inf)."""
+        if seconds == float('inf'):
+            return seconds
+        return int(round(seconds / self.period))
+
+    def frame_at(self, t):
+        """Index of the frame that starts closest to time `t`."""
+        return self.frame + int(round((t - self.last_t) / self.period))
+
+    def time_of(self, frame):
+        """Expected time at which `frame` reaches the screen."""
+        return self.last_t + (frame - self.frame) * self.period
+
+    def next_frame(self):
+        """Index of the frame the next flip will land on."""
+        elapsed = core.getTime() - self.last_t
+        return self.frame + int(elapsed // self.period) + 1
+
+    def flip(self, target=None):
+        """Flip the window and update `frame`; returns the flip timestamp.
+
+        target is the frame the caller drew for, by default the one due when
+        flip is called. Landing later than that counts as dropped frames.
+        """
+        if target is None:
+            target = self.next_frame()
+        t = self.win.flip()
+        self.frame += max(1, int(round((t - self.last_t) / self.period)))
+        self.last_t = t
+        if self.recorder is not None:
+            self.recorder.record(t, self.frame, max(self.frame - target, 0))
+        return t
+
+    def wait_for_frame(self, target):
+        """Wait until the frame before `target` is on screen.
+
+        Returns `margin` of a frame into it, so whatever is drawn next and
+        flipped lands on `target`.
+        """
+        self.waiter.wait_until(self.time_of(target - 1 + self.margin))
@@ -0,0 +1,106 @@
+"""One timestamped input stream for the button box, scanner and keyboard.
+
+Serial bytes (from a `SerialReader`) and keyboard presses are merged into
+``InputEvent(t, source, code)`` records ordered by time. Timestamps come from
+the serial thread and from the keyboard backend's own event time, so they do
+not depend on when in the frame the bus was polled. Which keys matter, and
+what they mean, is set once per experiment with a keymap.
+"""
+
+import time
+from collections import namedtuple
+
+from psychopy import core, event
+
+InputEvent = namedtuple('InputEvent', ['t', 'source', 'code'])
+
+
+class KeyboardSource(object):
+    """Hardware-timestamped keyboard presses.
+
+    Uses `psychopy.hardware.keyboard.Keyboard` (Psychtoolbox or iohub backend,
+    timestamps on the `core.getTime` clock) when available and falls back to
+    timestamped `event.getKeys`.
+    """
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        try:
+            from psychopy.hardware import keyboard
+            self._kb = keyboard.Keyboard()
+            self._kb.clearEvents()
+        except ImportError:
+            self._kb = None
+
+    def poll(self):
+        if self._kb is not None:
+            return [(press.tDown, press.name) for press in
+                    self._kb.getKeys(keyList=self.keys, waitRelease=False)]
+        return [(t, key) for key, t in
+                event.getKeys(keyList=self.keys, timeStamped=True)]
+
+    def clear(self):
+        if self._kb is not None:
+            self._kb.clearEvents()
+        else:
+            event.clearEvents('keyboard')
+
+
+class InputBus(object):
+    """Merge serial and keyboard input into one stream of `InputEvent`.
+
+    keymap maps the raw character sent by the button box, or the key name on
+    the keyboard, to the code reported for it; anything else is ignored. e.g.
+    ``{'1': '1', '2': '2', '5': 'scanner_trigger'}``. The keyboard is read
+    only when there is no serial port, unless `keyboard` is True (or a
+    source of its own), so a key press cannot stand in for the scanner.
+    """
+
+    def __init__(self, keymap, serial=None, keyboard=None):
+        self.keymap = dict(keymap)
+        self.serial = serial
+        if keyboard is None:
+            keyboard = serial is None
+        if keyboard is True:
+            keyboard = KeyboardSource(self.keymap)
+        self.keyboard = keyboard or None
+        # events polled by wait_for after the one it waited for
+        self._pending = []
+
+    def poll(self):
+        """Return the events that arrived since the last poll, oldest first."""
+        found, self._pending = self._pending, []
+        if self.serial is not None and self.serial.pending():
+            times, codes = self.serial.events()
+            for t, code in zip(times.tolist(), codes.tolist()):
+                code = self.keymap.get(chr(code))
+                if code is not None:
+                    found.append(InputEvent(t, 'serial', code))
+        if self.keyboard is not None:
+            for t, key in self.keyboard.poll():
+                found.append(InputEvent(t, 'keyboard', self.keymap[key]))
+        if len(found) > 1:
+            found.sort()
+        return found
+
+    def clear(self):
+        """Discard anything that has arrived but not been polled."""
+        self._pending = []
+        if self.serial is not None:
+            self.serial.flushInput()
+        if self.keyboard is not None:
+            self.keyboard.clear()
+
+    def wait_for(self, code, poll=0.0005):
+        """Block until an event with `code` arrives and return its time.
+
+        Events before it are dropped; those polled along with it that came
+        after it are returned by the next `poll`.
+        """
+        while True:
+            found = self.poll()
+            for i, evt in enumerate(found):
+                if evt.code == code:
+                    self._pending = found[i + 1:]
+                    return evt.t
+            time.sleep(poll)
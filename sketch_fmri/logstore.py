@@ -0,0 +1,262 @@
+"""Study-wide event store built from the run logs.
+
+Each ``res/log_pXX_rYY.txt`` written by PsychoPy is read line by line and
+its BIDS rows, EXP events (stimulus onsets logged on the flip, fixation
+changes) and scanner triggers are written as typed columns to a Parquet
+file per run, partitioned by experiment and participant::
+
+    <store>/<table>/experiment=exp_1/participant=3/run-04.parquet
+
+Logs written since the BIDS rows moved to their own ``_events.tsv`` have
+no BIDS lines; their rows are read from the events file next to the log.
+A manifest records the size and modification time of every file read, so
+updating the store after a scan session only parses the new logs.
+
+    python -m sketch_fmri.logstore
+
+updates the store; `read_table` loads a table of it with pandas.
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import time
+from os.path import abspath, dirname, exists, join, relpath
+
+ROOT = dirname(dirname(abspath(__file__)))
+DEFAULT_STORE = join(ROOT, 'logstore')
+MANIFEST = 'manifest.json'
+LOG_FILE = re.compile(r'log_p(\d+)_r(\d+)\.txt$')
+TABLES = ('bids', 'exp', 'triggers')
+TRIGGER = 'scanner_trigger'
+SYNC = 'Got sync from'
+
+
+def schemas():
+    """pyarrow schema of each table, without the partition columns."""
+    import pyarrow as pa
+
+    return {
+        'bids': pa.schema([('run', pa.int16()), ('onset', pa.float64()),
+                           ('duration', pa.float64()),
+                           ('stim_type', pa.string()),
+                           ('stim_fn', pa.string()),
+                           ('repetition', pa.int16())]),
+        'exp': pa.schema([('run', pa.int16()), ('t', pa.float64()),
+                          ('message', pa.string())]),
+        'triggers': pa.schema([('run', pa.int16()), ('t', pa.float64()),
+                               ('n', pa.int32()), ('sync', pa.bool_())]),
+    }
+
+
+def events_path(log_fn):
+    """The ``_events.tsv`` written next to the log `log_fn`."""
+    participant, run = LOG_FILE.search(log_fn).groups()
+    return join(dirname(log_fn), 'sub-{0:02d}_run-{1:02d}_events.tsv'.format(
+        int(participant), int(run)))
+
+
+def _value(text):
+    return None if text in ('n/a', 'None', '') else text
+
+
+def _bids_row(columns, fields):
+    row = dict(zip(columns, fields))
+    repetition = _value(row.get('repetition'))
+    return (float(row['onset']), float(row['duration']),
+            _value(row.get('stim_type')), _value(row.get('stim_fn')),
+            None if repetition is None else int(repetition))
+
+
+def parse_log(lines):
+    """Yield (table, row) for every BIDS row, EXP event and trigger in the
+    lines of a log, one line at a time.
+
+    Rows are tuples in the column order of `schemas`, without the run.
+    """
+    columns = None
+    n_triggers = 0
+    for line in lines:
+        parts = line.rstrip('\r\n').split(' \t', 2)
+        if len(parts) < 3:
+            continue
+        try:
+            t = float(parts[0])
+        except ValueError:
+            continue
+        level, message = parts[1].strip(), parts[2]
+        if level == 'BIDS':
+            fields = message.split('\t')
+            if fields[0] == 'onset':
+                columns = fields
+            elif columns is not None:
+                yield 'bids', _bids_row(columns, fields)
+        elif level == 'EXP':
+            yield 'exp', (t, message)
+        elif level == 'INFO' and (message == TRIGGER or
+                                  message.startswith(SYNC)):
+            yield 'triggers', (t, n_triggers, message != TRIGGER)
+            n_triggers += 1
+
+
+def parse_events(lines):
+    """Yield ('bids', row) for every row of an ``_events.tsv``."""
+    columns = None
+    for line in lines:
+        fields = line.rstrip('\r\n').split('\t')
+        if columns is None:
+            columns = fields
+        elif len(fields) == len(columns):
+            yield 'bids', _bids_row(columns, fields)
+
+
+def _stamp(path):
+    if not exists(path):
+        return None
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+class LogStore(object):
+    """The Parquet tables under `root` and the manifest of what is in them.
+
+    `update` parses the logs that changed since they were last stored.
+    """
+
+    def __init__(self, root=DEFAULT_STORE):
+        self.root = root
+        self._manifest_fn = join(root, MANIFEST)
+        self.manifest = {}
+        if exists(self._manifest_fn):
+            with open(self._manifest_fn) as f:
+                self.manifest = json.load(f)
+
+    def part(self, table, experiment, participant, run):
+        """Parquet file of `table` for one run."""
+        return join(self.root, table, 'experiment=' + experiment,
+                    'participant={0}'.format(participant),
+                    'run-{0:02d}.parquet'.format(run))
+
+    def stamps(self, log_fn):
+        """(size, mtime) of a log and of its events file, None if missing."""
+        return [_stamp(log_fn), _stamp(events_path(log_fn))]
+
+    def add(self, log_fn, experiment, key=None):
+        """Parse one log and replace its run's rows in every table.
+
+        key is the log's name in the manifest, by default its path from the
+        directory holding the experiment. Returns the number of rows written.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        participant, run = [int(x) for x in
+                            LOG_FILE.search(log_fn).groups()]
+        stamps = self.stamps(log_fn)
+        rows = dict((table, []) for table in TABLES)
+        with open(log_fn, errors='replace') as f:
+            for table, row in parse_log(f):
+                rows[table].append(row)
+        if not rows['bids'] and stamps[1] is not None:
+            with open(events_path(log_fn), errors='replace') as f:
+                for table, row in parse_events(f):
+                    rows[table].append(row)
+
+        for table, schema in schemas().items():
+            columns = list(zip(*rows[table])) or [[]] * (len(schema) - 1)
+            arrays = [pa.array([run] * len(rows[table]), schema[0].type)]
+            arrays += [pa.array(column, field.type)
+                       for column, field in zip(columns, list(schema)[1:])]
+            fn = self.part(table, experiment, participant, run)
+            if not exists(dirname(fn)):
+                os.makedirs(dirname(fn))
+            part_fn = '{0}.{1}.part'.format(fn, os.getpid())
+            pq.write_table(pa.Table.from_arrays(arrays, schema=schema),
+                           part_fn)
+            os.replace(part_fn, fn)
+        self.manifest[key or self._key(log_fn)] = stamps
+        return sum(len(table_rows) for table_rows in rows.values())
+
+    def remove(self, key):
+        """Drop the rows of a log that no longer exists."""
+        experiment = key.split('/')[0]
+        participant, run = [int(x) for x in LOG_FILE.search(key).groups()]
+        for table in TABLES:
+            fn = self.part(table, experiment, participant, run)
+            if exists(fn):
+                os.remove(fn)
+        del self.manifest[key]
+
+    def update(self, root=ROOT, experiments=('exp_1', 'exp_2')):
+        """Store every new or changed log of `experiments`, drop the rows
+        of deleted ones and save the manifest.
+
+        Returns (logs parsed, logs unchanged).
+        """
+        seen = set()
+        parsed = unchanged = 0
+        for experiment in experiments:
+            for log_fn in sorted(glob.glob(join(root, experiment, 'res',
+                                                'log_p*_r*.txt'))):
+                key = self._key(log_fn, root)
+                seen.add(key)
+                if self.manifest.get(key) == self.stamps(log_fn):
+                    unchanged += 1
+                    continue
+                self.add(log_fn, experiment, key)
+                parsed += 1
+        for key in list(self.manifest):
+            if key.split('/')[0] in experiments and key not in seen:
+                self.remove(key)
+        self.save()
+        return parsed, unchanged
+
+    def save(self):
+        """Write the manifest."""
+        if not exists(self.root):
+            os.makedirs(self.root)
+        part_fn = '{0}.{1}.part'.format(self._manifest_fn, os.getpid())
+        with open(part_fn, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(part_fn, self._manifest_fn)
+
+    def _key(self, log_fn, root=None):
+        if root is None:
+            root = dirname(dirname(dirname(abspath(log_fn))))
+        return relpath(abspath(log_fn), root).replace(os.sep, '/')
+
+
+def read_table(table, store=DEFAULT_STORE, filters=None):
+    """`table` of the store as a pandas DataFrame, with experiment and
+    participant columns. filters are passed on to `pandas.read_parquet`,
+    e.g. ``[('participant', '=', 3)]``."""
+    import pandas as pd
+
+    return pd.read_parquet(join(store, table), filters=filters)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('experiments', nargs='*', default=['exp_1', 'exp_2'],
+                        help='exp_1 and/or exp_2 (default both)')
+    parser.add_argument('--root', default=ROOT,
+                        help='directory holding exp_1 and exp_2')
+    parser.add_argument('--store', default=DEFAULT_STORE,
+                        help='directory of the Parquet tables (default '
+                             '%(default)s)')
+    args = parser.parse_args(argv)
+    for experiment in args.experiments:
+        if experiment not in ('exp_1', 'exp_2'):
+            parser.error('unknown experiment {0}'.format(experiment))
+
+    start = time.time()
+    parsed, unchanged = LogStore(args.store).update(args.root,
+                                                    args.experiments)
+    print('{0} log{1} parsed, {2} unchanged, in {3:.1f} s'.format(
+        parsed, '' if parsed == 1 else 's', unchanged, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
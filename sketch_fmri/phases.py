@@ -0,0 +1,102 @@
+"""Table-driven trial phases.
+
+A trial is compiled once, at load time, into an ordered list of `Segment`s:
+which stimuli are on screen, from when to when, whether responses are polled,
+and what gets logged when the segment starts. `run_segments` is the single
+frame loop that plays any such list, so a new timing variant is a new table
+rather than another copy of the loop. Segment times are laid out in seconds
+and converted to frame counts with `to_frames` before they are run.
+"""
+
+from collections import namedtuple
+
+from psychopy import logging
+
+Segment = namedtuple('Segment', ['start', 'end', 'stims', 'listen', 'log',
+                                 'moves'], defaults=(True, (), ()))
+Segment.__doc__ = """One stretch of a trial with a fixed set of stimuli on screen.
+
+start, end -- seconds (or frames, after `to_frames`) from trial onset,
+    end may be float('inf')
+stims -- drawn in this order on every frame of the segment
+listen -- poll for responses after each flip
+log -- messages logged (level EXP) on the flip that starts the segment
+moves -- (stimulus, pos) pairs applied when the segment starts
+"""
+
+
+def with_dim(segments, onset, duration, fixation, dim_fixation,
+             log='fixation change onset'):
+    """Return `segments` with `fixation` swapped for `dim_fixation` between
+    `onset` and `onset + duration`, splitting segments where needed."""
+    offset = onset + duration
+    compiled = []
+    for seg in segments:
+        cuts = sorted(set([seg.start, seg.end] +
+                          [c for c in (onset, offset)
+                           if seg.start < c < seg.end]))
+        for i, (start, end) in enumerate(zip(cuts[:-1], cuts[1:])):
+            part = seg._replace(start=start, end=end)
+            if i > 0:
+                part = part._replace(log=(), moves=())
+            if onset <= start and end <= offset:
+                stims = tuple(dim_fixation if stim is fixation else stim
+                              for stim in part.stims)
+                part = part._replace(stims=stims)
+                if start == onset:
+                    part = part._replace(log=part.log + (log,))
+            compiled.append(part)
+    return compiled
+
+
+def to_frames(segments, period):
+    """Return `segments` with start and end rounded to whole frames."""
+    def frames(seconds):
+        if seconds == float('inf'):
+            return seconds
+        return int(round(seconds / period))
+    return [seg._replace(start=frames(seg.start), end=frames(seg.end))
+            for seg in segments]
+
+
+def run_segments(sched, segments, onset_frame, on_frame=None, until=None,
+                 stop=float('inf')):
+    """Play frame-count `segments` with frame 0 landing on `onset_frame`.
+
+    sched is the run's `FrameScheduler`. Each pass draws the segment due on
+    the frame the coming flip lands on, so every segment starts on its exact
+    frame. on_frame is called after each flip in listening segments; the trial
+    ends after the last segment, as soon as until() is true or `stop` frames
+    after onset, whichever comes first.
+
+    Returns the timestamp of the onset flip, or the scheduled onset time if
+    the trial was already over.
+    """
+    n = len(segments)
+    current = 0
+    entered = -1
+    onset_t = None
+    while True:
+        target = sched.next_frame()
+        rel = target - onset_frame
+        while current < n and rel >= segments[current].end:
+            current += 1
+        if current == n or rel >= stop or (until is not None and until()):
+            break
+        while entered < current:
+            entered += 1
+            for stim, pos in segments[entered].moves:
+                stim.pos = pos
+            for msg in segments[entered].log:
+                sched.win.logOnFlip(msg, level=logging.EXP)
+        seg = segments[current]
+        for stim in seg.stims:
+            stim.draw()
+        t = sched.flip(target)
+        if onset_t is None:
+            onset_t = t
+        if seg.listen and on_frame is not None:
+            on_frame()
+    if onset_t is None:
+        onset_t = sched.time_of(onset_frame)
+    return onset_t
@@ -0,0 +1,77 @@
+"""Just-in-time stimulus loading with a small lookahead window.
+
+Instead of building every stimulus behind the "Loading stimuli..." screen, the
+presentation scripts keep only the current trial and the next `lookahead`
+trials built. The next trials are built while the current trial's ITI fixation
+is on screen, and only while there is time left before the next onset.
+"""
+
+import time
+
+
+class Prefetcher(object):
+    """Build trial stimuli a few trials ahead of the one on screen.
+
+    build(trial) returns the stimulus for a trial and release(trial, stimulus),
+    if given, is called once a trial is over so its resources can be freed.
+    """
+
+    def __init__(self, build, n_trials, lookahead=2, release=None,
+                 clock=time.time):
+        self.build = build
+        self.release = release
+        self.n_trials = n_trials
+        self.lookahead = lookahead
+        self.clock = clock
+        self.current = 0
+        self._ready = {}
+        self._next = 0
+        self._cost = 0.
+
+    def expected_cost(self):
+        """Slowest build seen so far, used to decide whether one still fits."""
+        return self._cost
+
+    def _build_next(self):
+        t0 = self.clock()
+        self._ready[self._next] = self.build(self._next)
+        self._cost = max(self._cost, self.clock() - t0)
+        self._next += 1
+
+    def fill(self, deadline=None):
+        """Build pending trials in the window, stopping before `deadline`.
+
+        Returns the number of trials built. Without a deadline the whole
+        window is built.
+        """
+        built = 0
+        last = min(self.n_trials, self.current + self.lookahead + 1)
+        while self._next < last:
+            if (deadline is not None and
+                    self.clock() + self.expected_cost() > deadline):
+                break
+            self._build_next()
+            built += 1
+        return built
+
+    def get(self, trial):
+        """Return the stimulus for `trial` and release earlier trials.
+
+        If prefetching fell behind, the missing trials are built now.
+        """
+        for done in [t for t in self._ready if t < trial]:
+            stimulus = self._ready.pop(done)
+            if self.release is not None:
+                self.release(done, stimulus)
+        self.current = trial
+        if self._next <= trial:
+            self._next = trial
+            self._build_next()
+        return self._ready[trial]
+
+    def close(self):
+        """Release every trial still built, e.g. at the end of a run."""
+        for trial in sorted(self._ready):
+            stimulus = self._ready.pop(trial)
+            if self.release is not None:
+                self.release(trial, stimulus)
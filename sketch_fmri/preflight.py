@@ -0,0 +1,236 @@
+"""Preflight check of the run files and the stimuli they need.
+
+Every ``runs/SubXX_RunYY.csv`` of both experiments is read and checked
+against the script that plays it (number of trials, known StimType
+values), and the stimulus files its trials show are collected. Each file
+is then opened and decoded on a process pool, checking that it exists,
+decodes to the end, lasts as long as its name says (``_6s.mov``) and has
+the same resolution as the other stimuli of its kind. A current
+``.rawclip`` transcode is checked against its clip as well.
+
+    python -m sketch_fmri.preflight
+
+prints every problem found and exits with status 1 if there is any.
+"""
+
+import argparse
+import re
+import sys
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from os.path import abspath, dirname, exists, join
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+Layout = namedtuple('Layout', ['script', 'experiment', 'marker', 'n_trials',
+                               'stim_types', 'clip_suffix', 'overlays'])
+Layout.__doc__ = """What a presentation script expects of its run files.
+
+marker -- a column only this script's run files have, None if the script
+    is the only one of its experiment
+n_trials -- rows per run file
+stim_types -- StimType values the script knows, photo and sketch rows need
+    a stimulus file
+clip_suffix -- appended to ``<ObjectID>_<StimNo>`` for a sketch clip
+overlays -- fixation images next to the script
+"""
+
+INSTRUCTED = ['Instruct_Animate', 'Instruct_Inanimate', 'Instruct_Neutral',
+              'Prepare_Animate', 'Prepare_Inanimate', 'Prepare_Neutral']
+LAYOUTS = [
+    Layout('sketch-morph_presentation_fmri.py', 'exp_1', None, 48,
+           ['fixation', 'photo', 'sketch'], '_6s.mov',
+           ['fixation_green_thumb.png', 'fixation_green_dark_thumb.png']),
+    Layout('ambisketch_presentation_fmri.py', 'exp_2', 'WhereCorrect', 57,
+           ['fixation', 'question', 'sketch'] + INSTRUCTED, '_6s.mov',
+           ['fixation_green_thumb.png']),
+    Layout('sketchID_presentation_fmri.py', 'exp_2', 'WhereAnimate', 72,
+           ['fixation', 'question', 'sketch'], '_8s.mov',
+           ['fixation_green_thumb.png']),
+]
+SECONDS = re.compile(r'_(\d+(?:\.\d+)?)s\.mov$')
+
+
+def layout_of(experiment, columns):
+    """The layout of a run file of `experiment` with these columns."""
+    for layout in LAYOUTS:
+        if layout.experiment == experiment and (
+                layout.marker is None or layout.marker in columns):
+            return layout
+    return None
+
+
+def required(root=ROOT, experiments=('exp_1', 'exp_2')):
+    """Check the run files and collect the stimuli they need.
+
+    Returns (problems, needed): problems with the run files themselves, and
+    {stimulus path: names of the run files that show it}.
+    """
+    from sketch_fmri.schedule import read_run_files
+
+    problems, needed = [], {}
+    for experiment in experiments:
+        here = join(root, experiment)
+        runs = read_run_files(join(here, 'runs'))
+        if not runs:
+            problems.append('{0}: no run files in {1}'.format(
+                experiment, join(here, 'runs')))
+        for (subject, run), frame in sorted(runs.items()):
+            name = '{0}/runs/Sub{1:02d}_Run{2:02d}.csv'.format(
+                experiment, subject, run)
+            layout = layout_of(experiment, frame.columns)
+            if layout is None:
+                problems.append('{0}: no script plays it'.format(name))
+                continue
+            if len(frame) != layout.n_trials:
+                problems.append('{0}: {1} trials, {2} expects {3}'.format(
+                    name, len(frame), layout.script, layout.n_trials))
+            for fn in layout.overlays:
+                needed.setdefault(join(here, fn), []).append(name)
+            for row, (stim_type, obj, number) in enumerate(zip(
+                    frame['StimType'], frame['ObjectID'], frame['StimNo'])):
+                if stim_type not in layout.stim_types:
+                    problems.append('{0} row {1}: unknown StimType {2!r}'
+                                    .format(name, row, stim_type))
+                elif stim_type in ('photo', 'sketch'):
+                    suffix = '.png' if stim_type == 'photo' else \
+                        layout.clip_suffix
+                    fn = join(here, 'stim', '{0}_{1}{2}'.format(
+                        obj, number, suffix))
+                    needed.setdefault(fn, []).append(name)
+    return problems, needed
+
+
+def check_stimulus(path):
+    """Open and decode one stimulus file.
+
+    Returns (path, info, problems), info being what was found out about the
+    file: its size (width, height) and for clips fps, frames and duration.
+    """
+    info, problems = {}, []
+    if not exists(path):
+        return path, info, ['missing']
+    if not path.endswith('.mov'):
+        try:
+            from PIL import Image
+            with Image.open(path) as image:
+                image.load()
+                info['size'] = image.size
+        except Exception as err:
+            problems.append('does not decode: {0!r}'.format(err))
+        return path, info, problems
+
+    from moviepy.editor import VideoFileClip
+    try:
+        clip = VideoFileClip(path, audio=False)
+    except Exception as err:
+        return path, info, ['does not open: {0!r}'.format(err)]
+    try:
+        info['size'] = tuple(clip.size)
+        info['fps'] = fps = clip.fps
+        n_frames = 0
+        try:
+            for frame in clip.iter_frames(dtype='uint8'):
+                n_frames += 1
+        except Exception as err:
+            problems.append('fails to decode after frame {0}: {1!r}'.format(
+                n_frames, err))
+        info['frames'] = n_frames
+        info['duration'] = n_frames / fps
+    finally:
+        clip.close()
+
+    match = SECONDS.search(path)
+    if match and abs(n_frames - fps * float(match.group(1))) > 1:
+        problems.append('{0} frames at {1:g} fps is {2:.3f} s, expected '
+                        '{3} s'.format(n_frames, fps, n_frames / fps,
+                                       match.group(1)))
+    problems += check_rawclip(path, n_frames)
+    return path, info, problems
+
+
+def check_rawclip(path, n_frames):
+    """Problems with the current ``.rawclip`` transcode of `path`, if any."""
+    from sketch_fmri.rawclip import is_current, rawclip_path, read_header
+
+    if not is_current(path):
+        return []
+    try:
+        header = read_header(rawclip_path(path))
+    except ValueError as err:
+        return [str(err)]
+    if header['n_frames'] != n_frames:
+        return ['transcode has {0} frames, the clip {1}'.format(
+            header['n_frames'], n_frames)]
+    return []
+
+
+def odd_sizes(results):
+    """Problems for stimuli whose size differs from the usual size of their
+    kind (photos, or clips of one length) in their experiment."""
+    groups = {}
+    for path, info, problems in results:
+        if 'size' in info:
+            kind = SECONDS.search(path)
+            key = (dirname(dirname(path)),
+                   kind.group(0) if kind else path.rsplit('.', 1)[-1])
+            groups.setdefault(key, []).append((path, info['size']))
+    odd = {}
+    for members in groups.values():
+        usual, count = Counter(size for path, size in members).most_common(1)[0]
+        for path, size in members:
+            if size != usual:
+                odd[path] = '{0}x{1}, the others are {2}x{3}'.format(
+                    size[0], size[1], usual[0], usual[1])
+    return odd
+
+
+def preflight(root=ROOT, experiments=('exp_1', 'exp_2'), jobs=None):
+    """Run every check; returns (problems, number of stimuli checked)."""
+    problems, needed = required(root, experiments)
+    paths = sorted(needed)
+    if jobs == 1:
+        results = list(map(check_stimulus, paths))
+    else:
+        with ProcessPoolExecutor(jobs) as pool:
+            results = list(pool.map(check_stimulus, paths))
+    odd = odd_sizes(results)
+    for path, info, found in results:
+        if path in odd:
+            found = found + [odd[path]]
+        users = sorted(set(needed[path]))
+        for problem in found:
+            problems.append('{0}: {1} (used by {2}{3})'.format(
+                path, problem, users[0],
+                ' and {0} more'.format(len(users) - 1)
+                if len(users) > 1 else ''))
+    return problems, len(paths)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('experiments', nargs='*', default=['exp_1', 'exp_2'],
+                        help='exp_1 and/or exp_2 (default both)')
+    parser.add_argument('--root', default=ROOT,
+                        help='directory holding exp_1 and exp_2')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='worker processes (default one per CPU)')
+    args = parser.parse_args(argv)
+    for experiment in args.experiments:
+        if experiment not in ('exp_1', 'exp_2'):
+            parser.error('unknown experiment {0}'.format(experiment))
+
+    sys.path.insert(0, ROOT)
+    start = time.time()
+    problems, n_checked = preflight(args.root, args.experiments, args.jobs)
+    for problem in problems:
+        print(problem)
+    print('{0} stimulus files checked in {1:.1f} s, {2} problem{3}'.format(
+        n_checked, time.time() - start, len(problems),
+        '' if len(problems) == 1 else 's'))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""Raw frame files for the sketch clips.
+
+A ``.rawclip`` file is a small fixed-size header followed by every frame of a
+clip as packed uint8 RGB, so the presentation scripts can memory-map it instead
+of decoding the ``.mov`` with ffmpeg during the run. Rows are stored bottom-up,
+which is the order OpenGL expects, so frames can be uploaded without copying.
+
+Transcode every clip in one or more stimulus directories with:
+
+    python -m sketch_fmri.rawclip exp_1/stim exp_2/stim
+"""
+
+import argparse
+import glob
+import os
+
+import numpy as np
+
+MAGIC = b'SKRAWCLP'
+VERSION = 1
+HEADER_SIZE = 64
+HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('n_frames', '<u4'),
+                   ('fps', '<f8'), ('height', '<u4'), ('width', '<u4'),
+                   ('channels', '<u4')])
+EXT = '.rawclip'
+
+
+def rawclip_path(movie_fn):
+    """Path of the transcoded frames for `movie_fn`."""
+    return os.path.splitext(movie_fn)[0] + EXT
+
+
+def is_current(movie_fn):
+    """True if `movie_fn` has a transcode at least as new as the movie."""
+    raw_fn = rawclip_path(movie_fn)
+    return (os.path.exists(raw_fn) and
+            os.path.getmtime(raw_fn) >= os.path.getmtime(movie_fn))
+
+
+def read_header(raw_fn):
+    """Return the header of `raw_fn` as a numpy record."""
+    header = np.fromfile(raw_fn, dtype=HEADER, count=1)
+    if header.size == 0 or header[0]['magic'] != MAGIC:
+        raise ValueError('{0} is not a rawclip file'.format(raw_fn))
+    if header[0]['version'] != VERSION:
+        raise ValueError('{0} has rawclip version {1}, expected {2}'.format(
+            raw_fn, header[0]['version'], VERSION))
+    return header[0]
+
+
+def open_rawclip(raw_fn):
+    """Memory-map `raw_fn` and return ``(frames, fps)``.
+
+    frames is a read-only (n_frames, height, width, channels) uint8 array.
+    """
+    header = read_header(raw_fn)
+    shape = (int(header['n_frames']), int(header['height']),
+             int(header['width']), int(header['channels']))
+    frames = np.memmap(raw_fn, dtype=np.uint8, mode='r',
+                       offset=HEADER_SIZE, shape=shape)
+    return frames, float(header['fps'])
+
+
+def write_rawclip(raw_fn, frames, fps):
+    """Write an iterable of top-down (height, width, channels) uint8 frames."""
+    header = np.zeros(1, dtype=HEADER)
+    header['magic'] = MAGIC
+    header['version'] = VERSION
+    header['fps'] = fps
+    tmp_fn = '{0}.{1}.part'.format(raw_fn, os.getpid())
+    n_frames = 0
+    with open(tmp_fn, 'wb') as f:
+        f.write(b'\0' * HEADER_SIZE)
+        for frame in frames:
+            frame = np.asarray(frame, dtype=np.uint8)
+            if n_frames == 0:
+                header['height'], header['width'], header['channels'] = \
+                    frame.shape
+            f.write(np.ascontiguousarray(frame[::-1]).tobytes())
+            n_frames += 1
+        header['n_frames'] = n_frames
+        f.seek(0)
+        f.write(header.tobytes())
+    os.replace(tmp_fn, raw_fn)
+    return n_frames
+
+
+def decode_movie(movie_fn, raw_fn, size=None):
+    """Decode `movie_fn` into `raw_fn`, scaled to `size` (width, height) if
+    given. Returns the number of frames written."""
+    from moviepy.editor import VideoFileClip
+    target = None if size is None else (size[1], size[0])
+    clip = VideoFileClip(movie_fn, audio=False, target_resolution=target)
+    try:
+        return write_rawclip(raw_fn, clip.iter_frames(dtype='uint8'),
+                             clip.fps)
+    finally:
+        clip.close()
+
+
+def transcode(movie_fn, force=False):
+    """Decode `movie_fn` once and write its frames next to it.
+
+    Returns the number of frames written, or 0 if the transcode is current.
+    """
+    if not force and is_current(movie_fn):
+        return 0
+    return decode_movie(movie_fn, rawclip_path(movie_fn))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Transcode sketch clips to memory-mappable raw frames.')
+    parser.add_argument('stimdirs', nargs='+',
+                        help='directories containing .mov clips')
+    parser.add_argument('--force', action='store_true',
+                        help='transcode clips that are already current')
+    args = parser.parse_args(argv)
+
+    for stimdir in args.stimdirs:
+        for movie_fn in sorted(glob.glob(os.path.join(stimdir, '*.mov'))):
+            n_frames = transcode(movie_fn, force=args.force)
+            if n_frames:
+                print('{0}: {1} frames'.format(movie_fn, n_frames))
+
+
+if __name__ == '__main__':
+    main()
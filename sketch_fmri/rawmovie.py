@@ -0,0 +1,200 @@
+"""Movie stimulus that plays a memory-mapped ``.rawclip`` file.
+
+`RawMovieStim` stands in for `visual.MovieStim3`: it has the same status
+values and draw/reset/play interface used by the presentation scripts, but
+each new frame is a page-cache read from the mmap plus one texture upload,
+with no codec work on the render thread. Frames go into an unsigned byte
+texture drawn without a shader, as MovieStim3 draws, so they reach the
+screen unchanged; `visual.ImageStim` would make a signed float texture
+for its own image and recolour it. An overlay (the fixation) can be
+blended into each frame before its upload, see `sketch_fmri.composite`.
+"""
+
+import ctypes
+
+import numpy as np
+import pyglet.gl as GL
+from psychopy import core, logging, visual
+from psychopy.constants import FINISHED, NOT_STARTED, PAUSED, PLAYING, STOPPED
+
+from sketch_fmri.rawclip import is_current, open_rawclip, rawclip_path
+from sketch_fmri.stimcache import shared_cache
+
+
+class RawMovieStim(visual.ImageStim):
+    """Play a transcoded clip from its memory-mapped frames.
+
+    Accepts the MovieStim3 keywords the scripts pass (``loop``, ``noAudio``);
+    everything else goes to `visual.ImageStim`, which only provides the
+    position, size and opacity: the frames are in a texture of their own.
+    The clip is shown at its native pixel size unless ``size`` is given.
+    """
+
+    def __init__(self, win, filename, loop=False, noAudio=True, **kwargs):
+        self.filename = filename
+        self.frames, self._fps = open_rawclip(filename)
+        n_frames, height, width, channels = self.frames.shape
+        if channels == 4:
+            self._pixFormat, internal = GL.GL_RGBA, GL.GL_RGBA8
+        else:
+            self._pixFormat, internal = GL.GL_RGB, GL.GL_RGB8
+        kwargs.setdefault('units', 'pix')
+        kwargs.setdefault('size', (width, height))
+        super(RawMovieStim, self).__init__(win, **kwargs)
+        self._frameTexID = GL.GLuint()
+        GL.glGenTextures(1, ctypes.byref(self._frameTexID))
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self._frameTexID)
+        smoothing = GL.GL_LINEAR if self.interpolate else GL.GL_NEAREST
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER,
+                           smoothing)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER,
+                           smoothing)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S,
+                           GL.GL_CLAMP)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T,
+                           GL.GL_CLAMP)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, internal, width, height, 0,
+                        self._pixFormat, GL.GL_UNSIGNED_BYTE, None)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        self.loop = loop
+        self.duration = n_frames / self._fps
+        self._frameIndex = -1
+        self._startT = None
+        self.status = NOT_STARTED
+        self.overlay = None
+        self._uploaded = None
+
+    def getFPS(self):
+        return self._fps
+
+    def getCurrentFrameTime(self):
+        return max(self._frameIndex, 0) / self._fps
+
+    def play(self, log=None):
+        if self.status == PAUSED:
+            self._startT = core.getTime() - self.getCurrentFrameTime()
+        elif self.status != PLAYING:
+            self._startT = core.getTime()
+        self.status = PLAYING
+
+    def pause(self, log=None):
+        if self.status == PLAYING:
+            self.status = PAUSED
+
+    def stop(self, log=None):
+        self.status = STOPPED
+
+    def reset(self):
+        self._frameIndex = -1
+        self._uploaded = None
+        self._startT = None
+        self.status = NOT_STARTED
+
+    def seek(self, t):
+        self._startT = core.getTime() - t
+
+    def _blend(self, frame):
+        """Copy of `frame` with `overlay` blended in.
+
+        overlay is (rgba, (x, y)): a bottom-up float32 image with alpha in
+        [0, 1], and the pixel offset of its centre from the frame's centre.
+        """
+        rgba, (x, y) = self.overlay
+        frame = frame.copy()
+        height, width = frame.shape[:2]
+        bottom = int(round(height / 2. + y - rgba.shape[0] / 2.))
+        left = int(round(width / 2. + x - rgba.shape[1] / 2.))
+        rows = slice(max(bottom, 0), min(bottom + rgba.shape[0], height))
+        cols = slice(max(left, 0), min(left + rgba.shape[1], width))
+        over = rgba[rows.start - bottom:rows.stop - bottom,
+                    cols.start - left:cols.stop - left]
+        alpha = over[..., 3:]
+        region = frame[rows, cols]
+        region[..., :3] = (region[..., :3] * (1 - alpha) +
+                           over[..., :3] * (255 * alpha) + .5)
+        if frame.shape[2] == 4:
+            region[..., 3] = np.maximum(region[..., 3], 255 * alpha[..., 0])
+        return frame
+
+    def _uploadFrame(self, index):
+        frame = self.frames[index]
+        if self.overlay is not None:
+            frame = self._blend(frame)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self._frameTexID)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0,
+                           frame.shape[1], frame.shape[0],
+                           self._pixFormat, GL.GL_UNSIGNED_BYTE,
+                           frame.ctypes.data_as(ctypes.c_void_p))
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        self._frameIndex = index
+        self._uploaded = (index, self.overlay)
+
+    def _currentIndex(self):
+        n_frames = self.frames.shape[0]
+        index = int((core.getTime() - self._startT) * self._fps)
+        if index < n_frames:
+            return index
+        if self.loop:
+            self._startT += n_frames / self._fps
+            return index % n_frames
+        self.status = FINISHED
+        if self.autoLog:
+            self.win.logOnFlip("Set %s finished" % self.name,
+                               level=logging.EXP, obj=self)
+        return n_frames - 1
+
+    def draw(self, win=None):
+        if self.status == NOT_STARTED:
+            self.play()
+        if self.status == PLAYING:
+            index = self._currentIndex()
+            if (self._uploaded is None or index != self._uploaded[0] or
+                    self.overlay is not self._uploaded[1]):
+                self._uploadFrame(index)
+        if win is None:
+            win = self.win
+        self._selectWindow(win)
+        GL.glPushMatrix()
+        win.setScale('pix')
+        # no shader, so the texture's bytes are the colours on screen
+        GL.glUseProgram(0)
+        GL.glActiveTexture(GL.GL_TEXTURE1)
+        GL.glDisable(GL.GL_TEXTURE_2D)
+        GL.glActiveTexture(GL.GL_TEXTURE0)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self._frameTexID)
+        GL.glEnable(GL.GL_TEXTURE_2D)
+        GL.glColor4f(1, 1, 1, self.opacity)
+        # rows are bottom-up, so texture row 0 is the bottom edge
+        vertsPix = self.verticesPix
+        GL.glBegin(GL.GL_QUADS)
+        for (u, v), vertex in zip(((1, 0), (0, 0), (0, 1), (1, 1)),
+                                  vertsPix):
+            GL.glTexCoord2f(u, v)
+            GL.glVertex2f(vertex[0], vertex[1])
+        GL.glEnd()
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        GL.glDisable(GL.GL_TEXTURE_2D)
+        GL.glPopMatrix()
+
+    def __del__(self):
+        try:
+            GL.glDeleteTextures(1, ctypes.byref(self._frameTexID))
+        except (AttributeError, ImportError, TypeError):
+            pass
+        super(RawMovieStim, self).__del__()
+
+
+def movie_stim(win, filename, cache=None, **kwargs):
+    """Build a `RawMovieStim` for the clip `filename`.
+
+    Plays the clip's ``.rawclip`` transcode if it has a current one, and
+    otherwise its frames in the stimulus cache (the shared
+    `sketch_fmri.stimcache.StimulusCache` unless `cache` is given), which
+    are decoded into the cache the first time the clip is used.
+    """
+    if is_current(filename):
+        return RawMovieStim(win, rawclip_path(filename), **kwargs)
+    if cache is None:
+        cache = shared_cache()
+    return RawMovieStim(win, cache.clip(filename), **kwargs)
@@ -0,0 +1,323 @@
+"""Counterbalanced run files for experiments 1 and 2.
+
+Builds the same ``runs/SubXX_RunYY.csv`` files as the
+``generate_run_files.ipynb`` notebooks, from explicit seeds. Each subject
+gets its own random stream spawned from the study seed, so a subject's
+files do not depend on how many subjects are generated or in which process.
+The trial tables are built as whole numpy arrays per subject and subjects
+are generated on a process pool.
+
+    python -m sketch_fmri.runfiles exp_1 --seed 2019
+    python -m sketch_fmri.runfiles exp_2 --seed 2019
+"""
+
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from os.path import abspath, dirname, join
+
+import numpy as np
+import pandas as pd
+
+from sketch_fmri import schedule
+
+ROOT = dirname(dirname(abspath(__file__)))
+N_SUBJECTS = 20
+
+# -- experiment 1 ------------------------------------------------------------
+
+# m sequence (Aguirre et al, 2011) for 16 categories plus blank fixation (0)
+M_SEQUENCE = np.array([
+    1, 1, 8, 15, 3, 6, 10, 1, 3, 10, 14, 16, 12, 5, 4, 5, 16, 0, 10, 10, 12,
+    14, 13, 9, 15, 10, 13, 15, 4, 7, 1, 16, 6, 16, 7, 0, 15, 15, 1, 4, 11, 5,
+    14, 15, 11, 14, 6, 2, 10, 7, 9, 7, 2, 0, 14, 14, 10, 6, 8, 16, 4, 14, 8, 4,
+    9, 3, 15, 2, 5, 2, 3, 0, 4, 4, 15, 9, 12, 7, 6, 4, 12, 6, 5, 13, 14, 3, 16,
+    3, 13, 0, 6, 6, 14, 5, 1, 2, 9, 6, 1, 9, 16, 11, 4, 13, 7, 13, 11, 0, 9, 9,
+    4, 16, 10, 3, 5, 9, 10, 5, 7, 8, 6, 11, 2, 11, 8, 0, 5, 5, 6, 7, 15, 13, 16,
+    5, 15, 16, 2, 12, 9, 8, 3, 8, 12, 0, 16, 16, 9, 2, 14, 11, 7, 16, 14, 7, 3,
+    1, 5, 12, 13, 12, 1, 0, 7, 7, 5, 3, 4, 8, 2, 7, 4, 2, 13, 10, 16, 1, 11, 1,
+    10, 0, 2, 2, 16, 13, 6, 12, 3, 2, 6, 3, 11, 15, 7, 10, 8, 10, 15, 0, 3, 3,
+    7, 11, 9, 1, 13, 3, 9, 13, 8, 14, 2, 15, 12, 15, 14, 0, 13, 13, 2, 8, 5, 10,
+    11, 13, 5, 11, 12, 4, 3, 14, 1, 14, 4, 0, 11, 11, 3, 12, 16, 15, 8, 11, 16,
+    8, 1, 6, 13, 4, 10, 4, 6, 0, 8, 8, 13, 1, 7, 14, 12, 8, 7, 12, 10, 9, 11, 6,
+    15, 6, 9, 0, 12, 12, 11, 10, 2, 4, 1, 12, 2, 1, 15, 5, 8, 9, 14, 9, 5, 0])
+
+EXP1_OBJECTS = ['alarm-clock', 'bush', 'cactus', 'face_female', 'face_lion',
+                'face_male', 'face_pig', 'foot', 'hand', 'hedgehog',
+                'hockey-stick', 'rabbit', 'radio', 'scissors', 'strawberry',
+                'sun']
+EXP1_RUNS = 12
+EXP1_TRIALS = 48
+
+
+def occurrence(seq):
+    """For each element of `seq`, how many times its value came before."""
+    seq = np.asarray(seq)
+    order = np.argsort(seq, kind='stable')
+    sorted_seq = seq[order]
+    starts = np.flatnonzero(np.r_[True, sorted_seq[1:] != sorted_seq[:-1]])
+    counts = np.diff(np.r_[starts, len(seq)])
+    rank = np.empty(len(seq), dtype=int)
+    rank[order] = np.arange(len(seq)) - np.repeat(starts, counts)
+    return rank
+
+
+def exp1_subject(subject, objects, jitter):
+    """Run files of one experiment 1 subject as {run: DataFrame}.
+
+    subject counts from 1, objects is the subject's order of the 16
+    categories and jitter a (12, 48) array of ITI jitters. Sketch runs show
+    the categories in `objects` order, photo runs in reverse; which of the
+    two takes the odd runs alternates between subjects.
+    """
+    # the kth occurrence of each category uses exemplar k % 4, and the kth
+    # occurrence of category k has the fixation dim (a float, as the notebook
+    # wrote it)
+    rank = occurrence(M_SEQUENCE)
+    stim_no = (rank % 4).reshape(-1, EXP1_TRIALS)
+    fix_change = (rank == M_SEQUENCE).astype(float).reshape(-1, EXP1_TRIALS)
+
+    forward = np.r_[['fixation'], objects]
+    backward = np.r_[['fixation'], objects[::-1]]
+    order = {'sketch': forward[M_SEQUENCE].reshape(-1, EXP1_TRIALS),
+             'photo': backward[M_SEQUENCE].reshape(-1, EXP1_TRIALS)}
+    first = 'sketch' if subject % 2 else 'photo'
+    second = 'photo' if subject % 2 else 'sketch'
+
+    onsets = 4 + 8 * np.arange(EXP1_TRIALS)
+    runs = {}
+    for run in range(EXP1_RUNS):
+        stim_type = first if run % 2 == 0 else second
+        block = run // 2
+        object_ids = order[stim_type][block]
+        repeat = np.r_[False, object_ids[1:] == object_ids[:-1]]
+        runs[run + 1] = pd.DataFrame({
+            'ObjectID': object_ids,
+            'StimNo': stim_no[block],
+            'FixChange': fix_change[block],
+            'Onset': onsets,
+            'Duration': np.full(EXP1_TRIALS, 6),
+            'Jitter': jitter[run],
+            'Repeat': repeat,
+            'StimType': np.where(object_ids == 'fixation', 'fixation',
+                                 stim_type)})
+    return runs
+
+
+def exp1_draw(rng):
+    """Random draws for one experiment 1 subject, in `exp1_subject` order."""
+    return (rng.permutation(EXP1_OBJECTS),
+            0.5 + rng.uniform(-.2, .2, size=(EXP1_RUNS, EXP1_TRIALS)))
+
+
+# -- experiment 2 ------------------------------------------------------------
+
+EXP2_ID_OBJECTS = ['fixation', 'pig_alarm-clock', 'hedgehog_bush',
+                   'hand_cactus', 'face_radio', 'face_strawberry',
+                   'foot_hockey-stick', 'rabbit_scissors', 'lion_sun']
+EXP2_AMBI_OBJECTS = EXP2_ID_OBJECTS[1:]
+EXP2_ID_RUNS = range(1, 5)
+EXP2_AMBI_RUNS = range(5, 17)
+BLOCK_TYPES = ('Animate', 'Inanimate', 'Neutral')
+
+# sketchID blocks: 9 (sketch, question) pairs, 108 s apart
+ID_BLOCKS = 4
+ID_ONSETS = np.array([4, 14, 16, 26, 28, 38, 40, 50, 52, 62, 64, 74, 76, 86,
+                      88, 98, 100, 110])
+ID_DURATIONS = np.tile([8, 2], 9)
+
+# ambisketch blocks: fixation, instructions, prepare and 8 (sketch, question)
+# pairs, 98 s apart
+AMBI_BLOCKS = 3
+AMBI_ONSETS = np.array([0, 8, 10, 18, 26, 28, 36, 38, 46, 48, 56, 58, 66, 68,
+                        76, 78, 86, 88, 96])
+AMBI_DURATIONS = np.array([8, 2, 8] + [8, 2] * 8)
+
+
+def balanced_latin_squares(n):
+    """Balanced latin square rows for n conditions (1-based), doubled with
+    the reversed rows for odd n."""
+    j = np.arange(n)
+    first = np.where(j % 2, j // 2 + 1, n - j // 2)
+    rows = (first[None, :] + j[:, None]) % n + 1
+    if n % 2:
+        rows = np.vstack([rows, rows[:, ::-1]])
+    return rows
+
+
+def sides(left):
+    """'left'/'right' labels for a boolean array."""
+    return np.where(left, 'left', 'right')
+
+
+def exp2_id_subject(objects, left, jitter):
+    """sketchID run files (runs 1-4) of one subject as {run: DataFrame}.
+
+    objects is the subject's order of the 9 entries of `EXP2_ID_OBJECTS`,
+    left a (4, 4, 8) boolean array of which questions put the animate answer
+    on the left, per run, block and morph, and jitter a (4, 72) array.
+    """
+    squares = balanced_latin_squares(len(objects))
+    runs = {}
+    for i, run in enumerate(EXP2_ID_RUNS):
+        object_ids, stim_no, where = [], [], []
+        for block in range(ID_BLOCKS):
+            morphs = objects[squares[(i * ID_BLOCKS + block) % len(squares)]
+                             - 1]
+            fixation = morphs == 'fixation'
+            answers = np.full(len(morphs), 'None', dtype=object)
+            answers[~fixation] = sides(left[i, block])
+            object_ids.append(np.repeat(morphs, 2))
+            stim_no.append(np.repeat(np.where(fixation, -1, block + 4), 2))
+            where.append(np.column_stack(
+                [np.full(len(morphs), 'None', dtype=object),
+                 answers]).ravel())
+        object_ids = np.concatenate(object_ids)
+        runs[run] = pd.DataFrame({
+            'ObjectID': object_ids,
+            'Onset': (ID_ONSETS + 108 * np.arange(ID_BLOCKS)[:, None]).ravel(),
+            'Jitter': jitter[i],
+            'StimNo': np.concatenate(stim_no),
+            'WhereAnimate': np.concatenate(where),
+            'Duration': np.tile(ID_DURATIONS, ID_BLOCKS),
+            'StimType': np.where(object_ids == 'fixation', 'fixation',
+                                 np.tile(['sketch', 'question'],
+                                         len(object_ids) // 2))})
+    return runs
+
+
+def exp2_ambi_subject(objects, exemplar_of_type, left, jitter):
+    """ambisketch run files (runs 5-16) of one subject as {run: DataFrame}.
+
+    objects is the subject's order of `EXP2_AMBI_OBJECTS`, exemplar_of_type
+    a permutation of (0, 1, 2) picking which exemplar slot each block type
+    uses, left a (12, 3, 8) boolean array of which questions put the correct
+    answer on the left and jitter a (12, 57) array. The six orders of block
+    types, and of exemplars, are each used twice across the 12 runs.
+    """
+    squares = balanced_latin_squares(len(objects))
+    type_orders = list(itertools.permutations(BLOCK_TYPES)) * 2
+    exemplar_orders = list(itertools.permutations([1, 2, 3])) * 2
+    runs = {}
+    for i, run in enumerate(EXP2_AMBI_RUNS):
+        object_ids, stim_no, where, stim_types = [], [], [], []
+        for block, block_type in enumerate(type_orders[i]):
+            morphs = objects[squares[(i * AMBI_BLOCKS + block) % len(squares)]
+                             - 1]
+            if block_type == 'Inanimate':
+                # the inanimate reading is the correct answer
+                answers = np.array(['_'.join(morph.split('_')[::-1])
+                                    for morph in morphs])
+            else:
+                answers = morphs
+            exemplar = exemplar_orders[i][
+                exemplar_of_type[BLOCK_TYPES.index(block_type)]]
+            object_ids.append(np.r_[['fixation', 'instructions', 'prepare'],
+                                    np.column_stack([morphs,
+                                                     answers]).ravel()])
+            stim_no.append(np.r_[[-1, -1, -1], np.tile([exemplar, -1], 8)])
+            where.append(np.r_[['None'] * 3, np.column_stack(
+                [np.full(8, 'None'), sides(left[i, block])]).ravel()])
+            stim_types.append(['fixation', 'Instruct_' + block_type,
+                               'Prepare_' + block_type] +
+                              ['sketch', 'question'] * 8)
+        runs[run] = pd.DataFrame({
+            'ObjectID': np.concatenate(object_ids),
+            'Onset': (AMBI_ONSETS +
+                      98 * np.arange(AMBI_BLOCKS)[:, None]).ravel(),
+            'Jitter': jitter[i],
+            'StimNo': np.concatenate(stim_no),
+            'WhereCorrect': np.concatenate(where),
+            'Duration': np.tile(AMBI_DURATIONS, AMBI_BLOCKS),
+            'StimType': np.concatenate(stim_types)})
+    return runs
+
+
+def balanced_sides(rng, shape):
+    """Boolean arrays with four True and four False in each last-axis row."""
+    base = np.broadcast_to(np.r_[[True] * 4, [False] * 4], shape)
+    return rng.permuted(base, axis=-1)
+
+
+def exp2_draw(rng):
+    """Random draws for one experiment 2 subject."""
+    id_draws = (rng.permutation(EXP2_ID_OBJECTS),
+                balanced_sides(rng, (len(EXP2_ID_RUNS), ID_BLOCKS, 8)),
+                0.5 + rng.uniform(-.2, .2, size=(len(EXP2_ID_RUNS), 72)))
+    ambi_draws = (rng.permutation(EXP2_AMBI_OBJECTS),
+                  rng.permutation(3),
+                  balanced_sides(rng, (len(EXP2_AMBI_RUNS), AMBI_BLOCKS, 8)),
+                  0.5 + rng.uniform(-.2, .2, size=(len(EXP2_AMBI_RUNS), 57)))
+    return id_draws, ambi_draws
+
+
+# -- study -------------------------------------------------------------------
+
+def subject_runs(experiment, subject, seed):
+    """All run files of one subject as {run: DataFrame}."""
+    rng = np.random.default_rng(np.random.SeedSequence(seed,
+                                                       spawn_key=(subject,)))
+    if experiment == 'exp_1':
+        return exp1_subject(subject, *exp1_draw(rng))
+    id_draws, ambi_draws = exp2_draw(rng)
+    runs = exp2_id_subject(*id_draws)
+    runs.update(exp2_ambi_subject(*ambi_draws))
+    return runs
+
+
+def _subject_runs(args):
+    return args[1], subject_runs(*args)
+
+
+def generate(experiment, seed, subjects=range(1, N_SUBJECTS + 1), jobs=None):
+    """Build the run files of `subjects` as {(subject, run): DataFrame}."""
+    if experiment not in ('exp_1', 'exp_2'):
+        raise ValueError('experiment must be exp_1 or exp_2')
+    tasks = [(experiment, subject, seed) for subject in subjects]
+    if jobs == 1:
+        built = map(_subject_runs, tasks)
+    else:
+        pool = ProcessPoolExecutor(jobs)
+        built = pool.map(_subject_runs, tasks)
+    study = {}
+    for subject, runs in built:
+        for run, frame in runs.items():
+            study[subject, run] = frame
+    if jobs != 1:
+        pool.shutdown()
+    return study
+
+
+def write(study, outdir):
+    """Write every run of a generated study to `outdir`, as CSVs and as the
+    packed study schedule."""
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    for (subject, run), frame in sorted(study.items()):
+        frame.to_csv(join(outdir, 'Sub{:02d}_Run{:02d}.csv'.format(subject,
+                                                                   run)))
+    schedule.write(join(outdir, schedule.SCHEDULE), study)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('experiment', choices=['exp_1', 'exp_2'])
+    parser.add_argument('--seed', type=int, required=True,
+                        help='study seed, keep it to regenerate the files')
+    parser.add_argument('--subjects', type=int, default=N_SUBJECTS)
+    parser.add_argument('--out', default=None,
+                        help='output directory (default <experiment>/runs)')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='worker processes (default one per CPU)')
+    args = parser.parse_args(argv)
+
+    study = generate(args.experiment, args.seed,
+                     range(1, args.subjects + 1), args.jobs)
+    outdir = args.out or join(ROOT, args.experiment, 'runs')
+    write(study, outdir)
+    print('wrote {0} run files to {1}'.format(len(study), outdir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""Study schedule: every subject's run files in one typed ``study.npz``.
+
+The run CSVs of an experiment are packed into a single structured array,
+one field per CSV column, with text columns (``ObjectID``, ``StimType``,
+...) stored as small integer codes plus their categories, and an index of
+where each (subject, run) starts and stops. A presentation script loads
+its run as a slice of that array, without pandas; the schedule is read
+once per process, so a session of several runs loads it only once.
+`load_run` falls back to the run's CSV when there is no schedule.
+
+    python -m sketch_fmri.schedule exp_1/runs exp_2/runs
+
+packs the CSVs already in those directories.
+"""
+
+import argparse
+import glob
+import os
+import re
+from os.path import abspath, basename, exists, getmtime, join
+
+import numpy as np
+
+SCHEDULE = 'study.npz'
+RUN_FILE = re.compile(r'Sub(\d+)_Run(\d+)\.csv$')
+INDEX = np.dtype([('subject', 'i4'), ('run', 'i4'), ('start', 'i8'),
+                  ('stop', 'i8')])
+
+# schedules loaded in this process, by path, with the size and mtime of the
+# file they were read from
+_loaded = {}
+
+
+class RunTable(object):
+    """Trials of one run, column by column.
+
+    ``table[column]`` is a numpy array with one entry per trial; text
+    columns are decoded from their codes on first use.
+    """
+
+    def __init__(self, rows, categories):
+        self.rows = rows
+        self.categories = categories
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def columns(self):
+        return self.rows.dtype.names
+
+    def __getitem__(self, column):
+        if column not in self.categories:
+            return self.rows[column]
+        if column not in self._decoded:
+            self._decoded[column] = self.categories[column][self.rows[column]]
+        return self._decoded[column]
+
+
+class Schedule(object):
+    """A loaded ``study.npz``; `run` returns a `RunTable` per (subject, run)."""
+
+    def __init__(self, path):
+        with np.load(path, allow_pickle=False) as npz:
+            self.trials = npz['trials']
+            self.index = npz['index']
+            self.categories = {name[len('cat_'):]: npz[name]
+                               for name in npz.files
+                               if name.startswith('cat_')}
+        self._where = {(int(subject), int(run)): (int(start), int(stop))
+                       for subject, run, start, stop in self.index}
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def run(self, subject, run):
+        start, stop = self._where[int(subject), int(run)]
+        return RunTable(self.trials[start:stop], self.categories)
+
+
+def shared_schedule(path):
+    """The `Schedule` at `path`, read once per process and again only if
+    the file changes, so the runs of a session share one load of it."""
+    path = abspath(path)
+    st = os.stat(path)
+    stamp = (st.st_size, st.st_mtime)
+    if path not in _loaded or _loaded[path][0] != stamp:
+        _loaded[path] = (stamp, Schedule(path))
+    return _loaded[path][1]
+
+
+def from_frames(runs):
+    """Pack {(subject, run): DataFrame} into (trials, index, categories)."""
+    keys = sorted(runs)
+    frames = [runs[key] for key in keys]
+    columns = []
+    for frame in frames:
+        columns += [col for col in frame.columns
+                    if col not in columns and not col.startswith('Unnamed')]
+
+    fields, values, categories = [], {}, {}
+    for col in columns:
+        parts = [frame[col].to_numpy() if col in frame else None
+                 for frame in frames]
+        kinds = {part.dtype.kind for part in parts if part is not None}
+        if kinds <= set('biuf'):
+            dtype = ('?' if kinds == {'b'} else
+                     'f8' if 'f' in kinds else 'i4')
+            missing = np.nan if dtype == 'f8' else 0
+            column = np.concatenate([
+                part.astype(dtype) if part is not None else
+                np.full(len(frame), missing, dtype=dtype)
+                for part, frame in zip(parts, frames)])
+        else:
+            text = np.concatenate([
+                part.astype(str) if part is not None else
+                np.full(len(frame), '')
+                for part, frame in zip(parts, frames)])
+            categories[col], column = np.unique(text, return_inverse=True)
+            dtype = 'u1' if len(categories[col]) <= 256 else 'u2'
+            column = column.astype(dtype)
+        fields.append((col, dtype))
+        values[col] = column
+
+    trials = np.empty(sum(len(frame) for frame in frames), dtype=fields)
+    for col in columns:
+        trials[col] = values[col]
+    stops = np.cumsum([len(frame) for frame in frames])
+    index = np.array([(subject, run, stop - len(frame), stop)
+                      for (subject, run), frame, stop
+                      in zip(keys, frames, stops)], dtype=INDEX)
+    return trials, index, categories
+
+
+def write(path, runs):
+    """Write {(subject, run): DataFrame} as a schedule at `path`."""
+    trials, index, categories = from_frames(runs)
+    np.savez(path, trials=trials, index=index,
+             **{'cat_' + col: cats for col, cats in categories.items()})
+
+
+def read_run_files(rundir):
+    """Every ``SubXX_RunYY.csv`` in `rundir` as {(subject, run): DataFrame}."""
+    import pandas as pd
+    runs = {}
+    for fn in glob.glob(join(rundir, 'Sub*_Run*.csv')):
+        match = RUN_FILE.search(basename(fn))
+        if match:
+            runs[int(match.group(1)), int(match.group(2))] = pd.read_csv(
+                fn, keep_default_na=False)
+    return runs
+
+
+def load_run(rundir, participant, run):
+    """Trials of one run from ``study.npz`` in `rundir`, or from its CSV.
+
+    The CSV is used if the schedule does not have the run, or if the CSV
+    was edited after the schedule was packed.
+    """
+    participant, run = int(participant), int(run)
+    csv_fn = join(rundir, 'Sub{:02d}_Run{:02d}.csv'.format(participant, run))
+    schedule_fn = join(rundir, SCHEDULE)
+    if exists(schedule_fn) and not (
+            exists(csv_fn) and getmtime(csv_fn) > getmtime(schedule_fn)):
+        schedule = shared_schedule(schedule_fn)
+        if (participant, run) in schedule:
+            return schedule.run(participant, run)
+    import pandas as pd
+    frame = pd.read_csv(csv_fn, keep_default_na=False)
+    trials, index, categories = from_frames({(participant, run): frame})
+    return RunTable(trials, categories)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('rundirs', nargs='+',
+                        help='directories of SubXX_RunYY.csv files')
+    args = parser.parse_args(argv)
+    for rundir in args.rundirs:
+        runs = read_run_files(rundir)
+        if not runs:
+            print('no run files in {0}'.format(rundir))
+            continue
+        write(join(rundir, SCHEDULE), runs)
+        print('packed {0} runs into {1}'.format(
+            len(runs), join(rundir, SCHEDULE)))
+
+
+if __name__ == '__main__':
+    main()
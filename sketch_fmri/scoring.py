@@ -0,0 +1,213 @@
+"""Behavioural scoring of the exp_1 one-back and fixation-dim tasks.
+
+In exp_1 the yellow button (``1``) means the object is the same as in the
+previous trial (``repetition`` 1 in the events) and the blue button
+(``2``) that the fixation dimmed (the ``fixation change onset`` EXP event).
+Each button press is matched to the trial on screen by a binary search of
+the trial onsets, over every run of the study at once: runs are laid end
+to end on one time axis so a single `numpy.searchsorted` per task covers
+them all. A trial is a hit when it is a target and the first press that
+counts for it falls in its response window, a false alarm when it is not
+a target and gets a press.
+
+    python -m sketch_fmri.scoring
+
+scores the runs in the log store (`sketch_fmri.logstore`) and prints hits,
+false alarms, d' and RTs per run, participant and for the study.
+"""
+
+import argparse
+import time
+from statistics import NormalDist
+
+import numpy as np
+
+from sketch_fmri.logstore import DEFAULT_STORE, read_table
+
+YELLOW, BLUE = '1', '2'
+DIM_EVENT = 'fixation change onset'
+# presses this soon after the target are anticipations, not responses
+MIN_RT = .15
+# a dim is missed without a press within this long
+MAX_DIM_RT = 2.
+# shortest ITI, the one-back response window of a run's last trial
+MIN_ITI = 2.
+# runs are laid out this far apart on the common time axis
+RUN_SPAN = 1e5
+RUN_KEYS = ['participant', 'run']
+TRIAL_TYPES = ['photo', 'sketch', 'fixation']
+
+
+def first_responses(onsets, targets, windows, presses):
+    """First counted press of each trial.
+
+    onsets are the sorted trial onsets, targets the time each trial's
+    response is timed from and windows how long after it a press counts.
+    Each press belongs to the last trial with an onset before it. Returns
+    (responded, rt) per trial, rt being NaN without a response.
+    """
+    trial = np.searchsorted(onsets, presses, side='right') - 1
+    counted = trial >= 0
+    trial, rt = trial[counted], presses[counted] - targets[trial[counted]]
+    counted = (rt >= MIN_RT) & (rt <= windows[trial])
+    trial, rt = trial[counted], rt[counted]
+    # presses are sorted, so a trial's first one is its first occurrence
+    responded_trials, first = np.unique(trial, return_index=True)
+    responded = np.zeros(len(onsets), dtype=bool)
+    responded[responded_trials] = True
+    rts = np.full(len(onsets), np.nan)
+    rts[responded_trials] = rt[first]
+    return responded, rts
+
+
+def d_prime(hits, targets, false_alarms, noise):
+    """d' with the log-linear correction, so rates of 0 and 1 stay finite."""
+    z = np.vectorize(NormalDist().inv_cdf, otypes=[float])
+    hit_rate = (np.asarray(hits) + .5) / (np.asarray(targets) + 1.)
+    fa_rate = (np.asarray(false_alarms) + .5) / (np.asarray(noise) + 1.)
+    return z(hit_rate) - z(fa_rate)
+
+
+def response_windows(trials):
+    """How long after each trial's onset a press counts for it: up to the
+    next trial's onset, and for a run's last trial to its end plus MIN_ITI.
+    trials are on the common time axis (column ``g``), in order."""
+    onsets = trials['g'].values
+    offsets = trials['offset'].values
+    same_run = np.append(offsets[1:] == offsets[:-1], False)
+    return np.where(same_run, np.append(onsets[1:], 0.) - onsets,
+                    trials['duration'].values + MIN_ITI)
+
+
+def score_trials(bids, exp):
+    """Score every trial of the runs in the `bids` and `exp` tables.
+
+    Both are tables of the log store, restricted to exp_1. Returns one row
+    per trial and task (``repeat`` or ``dim``) with whether it was a target,
+    responded to, and the RT. Raises ValueError if a trial has more than
+    one fixation dim.
+    """
+    import pandas as pd
+
+    bids = bids.assign(participant=bids['participant'].astype(int))
+    exp = exp.assign(participant=exp['participant'].astype(int))
+    runs = bids[RUN_KEYS].drop_duplicates().sort_values(RUN_KEYS)
+    runs = runs.assign(offset=np.arange(len(runs)) * RUN_SPAN)
+
+    def on_axis(frame, column):
+        frame = frame.merge(runs, on=RUN_KEYS)
+        return frame.assign(g=frame[column] + frame['offset']).sort_values('g')
+
+    presses = on_axis(bids[bids['stim_type'] == 'button_press'], 'onset')
+    yellow = presses.loc[presses['stim_fn'] == YELLOW, 'g'].values
+    blue = presses.loc[presses['stim_fn'] == BLUE, 'g'].values
+
+    all_trials = on_axis(bids[bids['stim_type'].isin(TRIAL_TYPES)],
+                         'onset').reset_index(drop=True)
+    all_onsets = all_trials['g'].values
+    # a press counts for the trial on screen or its ITI, up to the next
+    # trial's onset whatever its type
+    windows = response_windows(all_trials)
+
+    # the one-back task is over the objects, and its targets are the run
+    # file's Repeat column: the same object as the row before, so an object
+    # shown again after a fixation trial is not a repetition
+    objects = all_trials['stim_type'].isin(['photo', 'sketch']).values
+    trials = all_trials[objects].reset_index(drop=True)
+    onsets = trials['g'].values
+    repeat = trials['repetition'].fillna(0).values.astype(bool)
+    repeat_responded, repeat_rt = first_responses(
+        onsets, onsets, windows[objects], yellow)
+
+    # the fixation dims in fixation trials too, so the dim task is over
+    # every trial; a dim belongs to the trial it happened in and is
+    # responded to within MAX_DIM_RT, other trials count a blue press at
+    # any point in their window
+    dims = on_axis(exp[exp['message'] == DIM_EVENT], 't')['g'].values
+    dim_trial = np.searchsorted(all_onsets, dims, side='right') - 1
+    dims, dim_trial = dims[dim_trial >= 0], dim_trial[dim_trial >= 0]
+    repeated = dim_trial[1:][dim_trial[1:] == dim_trial[:-1]]
+    if len(repeated):
+        first = all_trials.iloc[repeated[0]]
+        raise ValueError('{0} trials with more than one fixation dim, the '
+                         'first participant {1} run {2} at {3:.3f} s'.format(
+                             len(np.unique(repeated)), first['participant'],
+                             first['run'], first['onset']))
+    dimmed = np.zeros(len(all_trials), dtype=bool)
+    dimmed[dim_trial] = True
+    dim_t = all_onsets.copy()
+    dim_t[dim_trial] = dims
+    dim_responded, dim_rt = first_responses(
+        all_onsets, dim_t,
+        np.where(dimmed, MAX_DIM_RT, windows), blue)
+
+    columns = RUN_KEYS + ['onset', 'stim_type', 'stim_fn']
+    return pd.concat([
+        trials[columns].assign(task='repeat', target=repeat,
+                               responded=repeat_responded,
+                               rt=np.where(repeat, repeat_rt, np.nan)),
+        all_trials[columns].assign(task='dim', target=dimmed,
+                                   responded=dim_responded,
+                                   rt=np.where(dimmed, dim_rt, np.nan)),
+    ], ignore_index=True)
+
+
+def summarize(scored, by):
+    """Hits, false alarms, d' and RT statistics of scored trials, grouped
+    by the columns `by` (pass ``['task']`` for the whole study)."""
+    counts = scored.assign(
+        hit=scored['target'] & scored['responded'],
+        false_alarm=~scored['target'] & scored['responded'],
+        noise=~scored['target'])
+    table = counts.groupby(by).agg(
+        targets=('target', 'sum'), hits=('hit', 'sum'),
+        noise=('noise', 'sum'), false_alarms=('false_alarm', 'sum'),
+        rt_mean=('rt', 'mean'), rt_median=('rt', 'median'),
+        rt_sd=('rt', 'std'))
+    table.insert(2, 'hit_rate', table['hits'] / table['targets'])
+    table.insert(5, 'fa_rate', table['false_alarms'] / table['noise'])
+    table.insert(6, 'd_prime', d_prime(table['hits'], table['targets'],
+                                       table['false_alarms'], table['noise']))
+    return table
+
+
+def score_study(store=DEFAULT_STORE):
+    """Score every exp_1 run in the log store.
+
+    Returns (trials, {'run': ..., 'participant': ..., 'study': ...}), the
+    scored trials and the summaries at each level.
+    """
+    filters = [('experiment', '=', 'exp_1')]
+    scored = score_trials(read_table('bids', store, filters),
+                          read_table('exp', store, filters))
+    return scored, {
+        'run': summarize(scored, ['participant', 'run', 'task']),
+        'participant': summarize(scored, ['participant', 'task']),
+        'study': summarize(scored, ['task']),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--store', default=DEFAULT_STORE,
+                        help='log store to score (default %(default)s)')
+    parser.add_argument('--level', choices=['run', 'participant', 'study'],
+                        default='participant',
+                        help='summary to print (default %(default)s)')
+    parser.add_argument('--trials', metavar='CSV',
+                        help='also write every scored trial here')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    scored, tables = score_study(args.store)
+    elapsed = time.time() - start
+    print(tables[args.level].round(3).to_string())
+    if args.trials:
+        scored.to_csv(args.trials, index=False)
+    print('{0} trials of {1} runs scored in {2:.2f} s'.format(
+        (scored['task'] == 'dim').sum(),
+        len(tables['run']) // 2, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Background reader for the button box / scanner trigger serial port.
+
+A dedicated thread drains the port in bulk and stamps every byte with a
+monotonic clock into a preallocated ring buffer. The frame loops only copy
+out what has arrived since they last looked, so serial I/O never runs on the
+render thread and presses that land in the same frame are all kept.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+
+class SerialReader(object):
+    """Read a `serial.Serial` port on a background thread.
+
+    `read` and `flushInput` mirror the pyserial calls the presentation scripts
+    already make, so a reader can stand in for the port itself. `events`
+    returns the bytes together with their timestamps.
+
+    clock must be monotonic; use the clock the rest of the run is timed with
+    (e.g. `psychopy.core.getTime`) so timestamps can be compared directly.
+    timeout is how long the thread blocks waiting for a byte before checking
+    whether it should stop; it does not delay bytes that do arrive.
+    """
+
+    def __init__(self, port, capacity=4096, clock=time.perf_counter,
+                 timeout=0.05):
+        self.port = port
+        self.port.timeout = timeout
+        self.clock = clock
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.codes = np.zeros(capacity, dtype=np.uint8)
+        self.overruns = 0
+        self._written = 0
+        self._read = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='SerialReader')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop the reader thread and close the port."""
+        self._stopping.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.port.close()
+
+    def _run(self):
+        port = self.port
+        while not self._stopping.is_set():
+            data = port.read(1)
+            if not data:
+                continue
+            t = self.clock()
+            waiting = port.in_waiting
+            if waiting:
+                data += port.read(waiting)
+            self._push(t, data)
+
+    def _push(self, t, data):
+        start = self._written
+        idx = np.arange(start, start + len(data)) % self.capacity
+        self.times[idx] = t
+        self.codes[idx] = np.frombuffer(data, dtype=np.uint8)
+        # publish only after the slots are filled
+        self._written = start + len(data)
+
+    def pending(self):
+        """Number of bytes that have arrived but not been read."""
+        return self._written - self._read
+
+    def events(self):
+        """Return ``(times, codes)`` arrays of every byte since the last read."""
+        written = self._written
+        if written - self._read > self.capacity:
+            self.overruns += written - self._read - self.capacity
+            self._read = written - self.capacity
+        idx = np.arange(self._read, written) % self.capacity
+        self._read = written
+        return self.times[idx], self.codes[idx]
+
+    def read(self):
+        """Non-blocking stand-in for ``Serial.read``: all unread bytes."""
+        if self._written == self._read:
+            return b''
+        return self.events()[1].tobytes()
+
+    def flushInput(self):
+        """Discard everything that has arrived so far."""
+        self._read = self._written
+
+    def wait_for(self, code, poll=0.0005):
+        """Block until the byte `code` arrives and return its timestamp."""
+        code = ord(code)
+        while True:
+            times, codes = self.events()
+            hits = np.flatnonzero(codes == code)
+            if hits.size:
+                return times[hits[0]]
+            time.sleep(poll)
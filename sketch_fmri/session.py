@@ -0,0 +1,100 @@
+"""Several runs of a presentation script in one process.
+
+Started on its own, a presentation script is one run: it opens the
+fullscreen window, measures the refresh, loads the fixation and decodes
+its clips, and quits at the end. Run as a session, the script is played
+once per run in the same process and keeps what it asks the session to
+keep (`Session.keep`) from one run to the next, so the window stays open
+and the caches stay warm. During the tail of a run, the first clips of
+the next run are decoded (`Session.hold`), and the next run is ready as
+soon as its instructions are dismissed.
+
+    python -m sketch_fmri.session exp_1/sketch-morph_presentation_fmri.py <DBIC ID> <accession> <participant> <run> [<run> ...]
+"""
+
+import argparse
+import runpy
+import sys
+
+# the session the script being run belongs to, if any
+_current = None
+
+
+class Session(object):
+    """What a presentation script keeps from one run to the next.
+
+    runs lists the runs of the session and index is the one being played;
+    a script started on its own is a session of just its run.
+    """
+
+    def __init__(self, runs=(None,)):
+        self.runs = list(runs)
+        self.index = 0
+        self._kept = {}
+        self._held = []
+
+    @property
+    def next_run(self):
+        """The run played after this one, or None in the last run."""
+        if self.index + 1 < len(self.runs):
+            return self.runs[self.index + 1]
+        return None
+
+    def keep(self, name, build):
+        """The object kept as `name`, built with build() in the first run."""
+        if name not in self._kept:
+            self._kept[name] = build()
+        return self._kept[name]
+
+    def hold(self, clips, paths):
+        """Decode the clips at `paths` in the `ClipCache` `clips` now, and
+        keep them decoded until the next call."""
+        held = [(clips, clips.get(path)) for path in paths]
+        for cache, clip in self._held:
+            cache.release(clip)
+        self._held = held
+
+
+def current_session():
+    """The session being run, or a session of one run."""
+    if _current is None:
+        return Session()
+    return _current
+
+
+def run_session(script, ids, runs, before_run=None):
+    """Play `script` once for each of `runs` in this process.
+
+    ids are the arguments before the run number (DBIC ID, accession
+    number, participant). before_run(run), if given, is called before each
+    run starts.
+    """
+    global _current
+    _current = session = Session(runs)
+    argv = sys.argv
+    try:
+        for session.index, run in enumerate(session.runs):
+            if before_run is not None:
+                before_run(run)
+            sys.argv = [script] + list(ids) + [str(run)]
+            runpy.run_path(script, run_name='__main__')
+    finally:
+        sys.argv = argv
+        _current = None
+    return session
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('script', help='presentation script to run')
+    parser.add_argument('dbic_id')
+    parser.add_argument('accession')
+    parser.add_argument('participant')
+    parser.add_argument('runs', type=int, nargs='+')
+    args = parser.parse_args(argv)
+    run_session(args.script, (args.dbic_id, args.accession, args.participant),
+                args.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,606 @@
+"""Headless simulation of a presentation script on a virtual clock.
+
+The window, clock, dialog, keyboard and movie backends are replaced with
+stand-ins and the unmodified script is run against a run CSV. Flips land on
+the vsync grid of a virtual display, waits advance the virtual clock instead
+of sleeping, the run configuration dialog accepts the defaults, the
+instruction screens are dismissed straight away and a virtual scanner sends
+'5' every TR from the moment the script starts listening for it. Sketch
+clips play for the length in their file name (``_6s.mov``, ``_8s.mov``), so
+no stimulus files or GPU are needed. The log, ``_events.tsv`` and flip
+record are written to ``res/`` as in a real run.
+
+    python -m sketch_fmri.simulate exp_1/sketch-morph_presentation_fmri.py 1 1 2 3
+
+runs participant 1, runs 1 to 3 of experiment 1 as fast as the CPU allows.
+"""
+
+import argparse
+import contextlib
+import os
+import random
+import re
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+from os.path import abspath, basename, dirname, exists, join, realpath
+
+import numpy as np
+
+NOT_STARTED, PLAYING, PAUSED, STOPPED, FINISHED = 0, 1, 2, -1, -1
+STARTED, PRESSED, RELEASED, FOREVER = 1, 1, -1, float('inf')
+
+CRITICAL, ERROR, WARNING, DATA, EXP, INFO, DEBUG = 50, 40, 30, 25, 22, 20, 10
+LEVEL_NAMES = {CRITICAL: 'CRITICAL', ERROR: 'ERROR', WARNING: 'WARNING',
+               DATA: 'DATA', EXP: 'EXP', INFO: 'INFO', DEBUG: 'DEBUG'}
+
+# the simulation the stand-in modules currently report to
+_current = None
+
+
+class VirtualClock(object):
+    """Simulated `core.getTime`.
+
+    Every read costs `tick` seconds so that polling loops move forward.
+    With a positive `speed` the simulation is paced at that multiple of real
+    time, otherwise it runs as fast as it can.
+    """
+
+    def __init__(self, tick=1e-5, speed=0.):
+        self.now = 0.
+        self.tick = tick
+        self.speed = speed
+        self._real_start = time.time()
+
+    def getTime(self):
+        self.now += self.tick
+        return self.now
+
+    def advance_to(self, t):
+        if t > self.now:
+            self.now = t
+        if self.speed > 0:
+            lag = self.now / self.speed - (time.time() - self._real_start)
+            if lag > 0:
+                time.sleep(lag)
+
+
+class Scanner(object):
+    """Virtual scanner sending `key` every `tr` seconds once started."""
+
+    def __init__(self, clock, tr=2., key='5'):
+        self.clock = clock
+        self.tr = tr
+        self.key = key
+        self.start = None
+        self.sent = 0
+
+    def due(self):
+        """Timestamps of the triggers sent since the last call."""
+        if self.start is None:
+            return []
+        n = int((self.clock.now - self.start) // self.tr) + 1
+        times = [self.start + k * self.tr for k in range(self.sent, n)]
+        self.sent = max(self.sent, n)
+        return times
+
+
+class Simulation(object):
+    """State shared by the stand-in modules during one simulated run."""
+
+    def __init__(self, refresh=60., tr=2., speed=0., drop_rate=0.,
+                 stall_rate=0., stall=.25, seed=None):
+        self.clock = VirtualClock(speed=speed)
+        self.scanner = Scanner(self.clock, tr)
+        self.period = 1. / refresh
+        self.drop_rate = drop_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.random = random.Random(seed)
+        self.log_files = []
+        self.log_clock = None
+        self.flips = 0
+        self._vsync = -1
+        # real time of the start, of the trigger wait and of every flip, for
+        # measuring what the script costs rather than what it schedules
+        self.real_start = time.perf_counter()
+        self.real_listen = None
+        self.real_flips = []
+
+    def next_vsync(self):
+        """Advance to the vsync the next flip lands on and return its time."""
+        index = max(self._vsync + 1, int(self.clock.now // self.period) + 1)
+        while self.drop_rate and self.random.random() < self.drop_rate:
+            index += 1
+        if self.stall_rate and self.random.random() < self.stall_rate:
+            index += int(round(self.stall / self.period))
+        self._vsync = index
+        self.real_flips.append(time.perf_counter())
+        self.clock.advance_to(index * self.period)
+        self.flips += 1
+        return index * self.period
+
+
+# -- psychopy.core -----------------------------------------------------------
+
+def getTime():
+    return _current.clock.getTime()
+
+
+def wait(secs, hogCPUperiod=0.2):
+    _current.clock.advance_to(_current.clock.now + max(secs, 0.))
+
+
+def _quit():
+    raise SystemExit(0)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self._timeAtLastReset = getTime()
+
+    def getTime(self):
+        return getTime() - self._timeAtLastReset
+
+    def reset(self, newT=0.0):
+        self._timeAtLastReset = getTime() - newT
+
+
+# -- psychopy.logging --------------------------------------------------------
+
+class LogFile(object):
+
+    def __init__(self, f=None, level=WARNING, filemode='a', logger=None,
+                 encoding='utf8'):
+        self.level = level
+        self.stream = open(f, filemode, encoding=encoding)
+        _current.log_files.append(self)
+
+    def write(self, t, level, msg):
+        if level >= self.level:
+            self.stream.write('{0:.4f} \t{1} \t{2}\n'.format(
+                t, LEVEL_NAMES.get(level, level), msg))
+
+
+def setDefaultClock(clock):
+    _current.log_clock = clock
+
+
+def log(msg, level, t=None, obj=None):
+    if _current is None:
+        # outside a simulated run there is no log file to write to
+        return
+    if t is None:
+        t = (_current.log_clock.getTime() if _current.log_clock is not None
+             else _current.clock.now)
+    for f in _current.log_files:
+        f.write(t, level, msg)
+
+
+def _level_logger(level):
+    return lambda msg, t=None, obj=None: log(msg, level, t, obj)
+
+
+def flush():
+    for f in _current.log_files:
+        f.stream.flush()
+
+
+class _Logger(object):
+
+    def removeTarget(self, target):
+        _current.log_files.remove(target)
+        target.stream.close()
+
+
+# -- psychopy.event and psychopy.gui ------------------------------------------
+
+def getKeys(keyList=None, timeStamped=False):
+    """Scanner triggers for the response loops, 'return' for any prompt."""
+    scanner = _current.scanner
+    getTime()
+    if keyList is None:
+        return ['return']
+    if scanner.key not in keyList:
+        return []
+    if scanner.start is None:
+        scanner.start = _current.clock.now
+        _current.real_listen = time.perf_counter()
+    presses = [(scanner.key, t) for t in scanner.due()]
+    if timeStamped:
+        return presses
+    return [key for key, t in presses]
+
+
+def clearEvents(eventType=None):
+    _current.scanner.due()
+
+
+class Dlg(object):
+    """Run configuration dialog that is always accepted as filled in."""
+
+    def __init__(self, title='', **kwargs):
+        self.data = []
+        self.OK = False
+
+    def addField(self, label, initial='', **kwargs):
+        self.data.append(initial)
+
+    def show(self):
+        self.OK = True
+        return self.data
+
+
+# -- psychopy.visual ---------------------------------------------------------
+
+class Window(object):
+
+    def __init__(self, size=(800, 600), units='norm', **kwargs):
+        self.size = size
+        self.units = units
+        self.mouseVisible = True
+        self._toLog = []
+        self._toCall = []
+
+    def logOnFlip(self, msg, level, obj=None):
+        self._toLog.append((msg, level, obj))
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._toCall.append((function, args, kwargs))
+
+    def flip(self, clearBuffer=True):
+        t = _current.next_vsync()
+        for function, args, kwargs in self._toCall:
+            function(*args, **kwargs)
+        for msg, level, obj in self._toLog:
+            log(msg, level, obj=obj)
+        self._toCall, self._toLog = [], []
+        return t
+
+    def clearBuffer(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Stim(object):
+
+    def __init__(self, win, *args, **kwargs):
+        self.win = win
+        self.name = kwargs.get('name')
+        self.pos = kwargs.get('pos', (0, 0))
+        self.units = kwargs.get('units') or win.units
+        self.autoDraw = False
+
+    def draw(self, win=None):
+        pass
+
+    def setAutoDraw(self, value, log=None):
+        self.autoDraw = value
+
+
+class ImageStim(_Stim):
+    pass
+
+
+class TextStim(_Stim):
+    """Text taking 12 by 24 pixels per character, on one line."""
+
+    def __init__(self, win, text='', **kwargs):
+        super(TextStim, self).__init__(win, **kwargs)
+        self.text = text
+        self.anchorHoriz = kwargs.get('alignHoriz') or kwargs.get(
+            'anchorHoriz', 'center')
+        self.anchorVert = kwargs.get('alignVert') or kwargs.get(
+            'anchorVert', 'center')
+        self.boundingBox = (12 * len(text), 24)
+
+
+class BufferImageStim(_Stim):
+    pass
+
+
+class MovieStim(_Stim):
+    """Clip that plays for the number of seconds in its file name."""
+
+    def __init__(self, win, filename='', duration=6., **kwargs):
+        super(MovieStim, self).__init__(win, **kwargs)
+        self.filename = filename
+        match = re.search(r'_(\d+(?:\.\d+)?)s\.\w+$', filename)
+        self.duration = float(match.group(1)) if match else duration
+        self.status = NOT_STARTED
+        self._startT = None
+        self.overlay = None
+
+    def loadMovie(self, filename, log=None):
+        self.filename = filename
+
+    def play(self, log=None):
+        if self.status != PLAYING:
+            self._startT = _current.clock.now
+        self.status = PLAYING
+
+    def pause(self, log=None):
+        self.status = PAUSED
+
+    def stop(self, log=None):
+        self.status = STOPPED
+
+    def reset(self):
+        self.status = NOT_STARTED
+
+    def draw(self, win=None):
+        if self.status == NOT_STARTED:
+            self.play()
+        if (self.status == PLAYING and
+                _current.clock.now - self._startT >= self.duration):
+            self.status = FINISHED
+
+
+def movie_stim(win, filename, **kwargs):
+    """Stand-in for `sketch_fmri.rawmovie.movie_stim`."""
+    return MovieStim(win, filename, **kwargs)
+
+
+def convertToPix(vertices, pos, units, win):
+    """Stand-in for `psychopy.tools.monitorunittools.convertToPix`."""
+    scale = {'pix': 1., 'norm': (win.size[0] / 2., win.size[1] / 2.),
+             'height': win.size[1]}[units]
+    return (vertices + pos) * scale
+
+
+# -- installing the stand-ins ------------------------------------------------
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+def _constants():
+    return dict(NOT_STARTED=NOT_STARTED, STARTED=STARTED, PLAYING=PLAYING,
+                PAUSED=PAUSED, STOPPED=STOPPED, FINISHED=FINISHED,
+                PRESSED=PRESSED, RELEASED=RELEASED, FOREVER=FOREVER)
+
+
+def install():
+    """Put the stand-in psychopy, serial and movie modules in sys.modules."""
+    levels = dict(CRITICAL=CRITICAL, ERROR=ERROR, WARNING=WARNING, DATA=DATA,
+                  EXP=EXP, INFO=INFO, DEBUG=DEBUG)
+    modules = {
+        'psychopy.constants': _module('psychopy.constants', **_constants()),
+        'psychopy.core': _module('psychopy.core', getTime=getTime, wait=wait,
+                                 quit=_quit, Clock=Clock,
+                                 MonotonicClock=Clock),
+        'psychopy.event': _module('psychopy.event', getKeys=getKeys,
+                                  clearEvents=clearEvents),
+        'psychopy.gui': _module('psychopy.gui', Dlg=Dlg),
+        'psychopy.logging': _module(
+            'psychopy.logging', LogFile=LogFile, log=log, flush=flush,
+            root=_Logger(),
+            setDefaultClock=setDefaultClock,
+            **dict(levels, **{name.lower(): _level_logger(level)
+                              for name, level in levels.items()})),
+        'psychopy.sound': _module('psychopy.sound'),
+        'psychopy.tools': _module('psychopy.tools', __path__=[]),
+        'psychopy.tools.monitorunittools': _module(
+            'psychopy.tools.monitorunittools', convertToPix=convertToPix),
+        'psychopy.visual': _module(
+            'psychopy.visual', Window=Window, ImageStim=ImageStim,
+            TextStim=TextStim, BufferImageStim=BufferImageStim,
+            MovieStim=MovieStim, MovieStim3=MovieStim,
+            **_constants()),
+        'serial': _module('serial', Serial=_SerialPort),
+    }
+    psychopy = _module('psychopy', __path__=[])
+    for name, module in modules.items():
+        if name.count('.') == 1 and name.startswith('psychopy.'):
+            setattr(psychopy, name.split('.', 1)[1], module)
+    modules['psychopy'] = psychopy
+    sys.modules.update(modules)
+
+    # clips are played by the stand-in movie and need not exist on disk, and
+    # no image is read for the fixation or the atlas
+    from sketch_fmri import atlas, clipcache, composite
+    sys.modules['sketch_fmri.rawmovie'] = _module('sketch_fmri.rawmovie',
+                                                  movie_stim=movie_stim)
+    sys.modules['sketch_fmri.clipcache'] = _module(
+        'sketch_fmri.clipcache', file_digest=clipcache.file_digest,
+        ClipCache=type('ClipCache', (_PathKeyed, clipcache.ClipCache), {}))
+    sys.modules['sketch_fmri.composite'] = _module(
+        'sketch_fmri.composite', OverlaidMovie=composite.OverlaidMovie,
+        Compositor=type('Compositor', (_Unread, composite.Compositor), {}))
+    sys.modules['sketch_fmri.atlas'] = _module(
+        'sketch_fmri.atlas', AtlasStim=atlas.AtlasStim,
+        AtlasGroup=atlas.AtlasGroup, shelf_pack=atlas.shelf_pack,
+        TextureAtlas=type('TextureAtlas', (_Unread, atlas.TextureAtlas), {}))
+
+
+class _PathKeyed(object):
+
+    def key(self, path):
+        if exists(path):
+            return super(_PathKeyed, self).key(path)
+        return realpath(path)
+
+
+class _Unread(object):
+    """Images that are not read, for the compositor and atlas."""
+
+    def _overlay_rgba(self, overlay_fn):
+        return ()
+
+    def _load(self, image_fn):
+        return np.zeros((64, 64, 4), dtype=np.uint8)
+
+    def _max_page_size(self):
+        return 4096
+
+    def _upload(self, page):
+        return page.shape
+
+    def _delete(self, texture):
+        pass
+
+    def _draw_page(self, texture, quads):
+        pass
+
+
+class _SerialPort(object):
+    """Serial port that never receives anything; triggers come as keys."""
+
+    def __init__(self, *args, **kwargs):
+        self.timeout = None
+        self.in_waiting = 0
+
+    def read(self, size=1):
+        time.sleep(self.timeout or 0.)
+        return b''
+
+    def flushInput(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def staged(script, res):
+    """Copy of the experiment directory whose ``res`` is `res`.
+
+    Everything else in the directory is linked, so the script reads the real
+    run files but writes its output to `res`. Returns the staged script path.
+    """
+    here = dirname(abspath(script))
+    stage = tempfile.mkdtemp(prefix='sketch_fmri_sim_')
+    for entry in os.listdir(here):
+        if entry != 'res':
+            os.symlink(join(here, entry), join(stage, entry))
+    if not exists(res):
+        os.makedirs(res)
+    os.symlink(abspath(res), join(stage, 'res'))
+    return join(stage, basename(script))
+
+
+@contextlib.contextmanager
+def _played(script, res):
+    """Yield the path to run `script` from, staged if `res` is given, with
+    the experiment directory as working directory."""
+    argv, cwd = sys.argv, os.getcwd()
+    script = abspath(script)
+    if res is not None:
+        script = staged(script, res)
+    os.chdir(dirname(script))
+    try:
+        yield script
+    except SystemExit:
+        pass
+    finally:
+        sys.argv = argv
+        os.chdir(cwd)
+        for f in _current.log_files:
+            f.stream.close()
+        if res is not None:
+            shutil.rmtree(dirname(script))
+
+
+def simulate(script, participant, run, res=None, **kwargs):
+    """Run `script` for one participant and run; returns the Simulation.
+
+    Output goes to the experiment's ``res`` directory unless `res` is given.
+    """
+    global _current
+    _current = sim = Simulation(**kwargs)
+    with _played(script, res) as script:
+        sys.argv = [script, 'SIM', 'SIM', str(participant), str(run)]
+        runpy.run_path(script, run_name='__main__')
+    return sim
+
+
+def simulate_session(script, participant, runs, res=None, **kwargs):
+    """Run `script` for several runs as one `sketch_fmri.session`.
+
+    Returns the Simulation, whose `loads` has the real time each run took
+    from its start to the trigger wait.
+    """
+    from sketch_fmri.session import run_session
+
+    global _current
+    _current = sim = Simulation(**kwargs)
+    sim.loads = []
+
+    def before_run(run):
+        # the scanner stops between runs and starts again when listened for
+        if sim.real_listen is not None:
+            sim.loads.append(sim.real_listen - sim.real_start)
+        sim.scanner = Scanner(sim.clock, sim.scanner.tr)
+        sim.real_start, sim.real_listen = time.perf_counter(), None
+
+    with _played(script, res) as script:
+        run_session(script, ('SIM', 'SIM', str(participant)), runs,
+                    before_run=before_run)
+    if sim.real_listen is not None:
+        sim.loads.append(sim.real_listen - sim.real_start)
+    return sim
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('script', help='presentation script to run')
+    parser.add_argument('participant', type=int)
+    parser.add_argument('runs', type=int, nargs='+')
+    parser.add_argument('--refresh', type=float, default=60.,
+                        help='refresh rate of the virtual display in Hz')
+    parser.add_argument('--tr', type=float, default=2.,
+                        help='seconds between scanner triggers')
+    parser.add_argument('--speed', type=float, default=0.,
+                        help='multiple of real time, 0 runs unpaced')
+    parser.add_argument('--drop-rate', type=float, default=0.,
+                        help='probability that a flip misses its vsync')
+    parser.add_argument('--stall-rate', type=float, default=0.,
+                        help='probability that a flip stalls for --stall '
+                             'seconds, like a decode stall')
+    parser.add_argument('--stall', type=float, default=.25,
+                        help='length of a stall in seconds')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--res', default=None,
+                        help="write output here instead of the experiment's "
+                             "res directory")
+    parser.add_argument('--session', action='store_true',
+                        help='play the runs as one session, in one process')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, dirname(dirname(abspath(__file__))))
+    install()
+    if args.session:
+        start = time.time()
+        sim = simulate_session(args.script, args.participant, args.runs,
+                               refresh=args.refresh, tr=args.tr,
+                               speed=args.speed, drop_rate=args.drop_rate,
+                               stall_rate=args.stall_rate, stall=args.stall,
+                               seed=args.seed, res=args.res)
+        for run, load in zip(args.runs, sim.loads):
+            print('participant {0} run {1}: ready for the trigger after '
+                  '{2:.3f} s'.format(args.participant, run, load))
+        print('session of {0} runs: {1:.1f} s simulated, {2} flips, in '
+              '{3:.1f} s'.format(len(args.runs), sim.clock.now, sim.flips,
+                                 time.time() - start))
+        return
+    for run in args.runs:
+        start = time.time()
+        sim = simulate(args.script, args.participant, run,
+                       refresh=args.refresh, tr=args.tr, speed=args.speed,
+                       drop_rate=args.drop_rate, stall_rate=args.stall_rate,
+                       stall=args.stall, seed=args.seed, res=args.res)
+        print('participant {0} run {1}: {2:.1f} s simulated, {3} flips, '
+              'in {4:.1f} s'.format(args.participant, run, sim.clock.now,
+                                    sim.flips, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
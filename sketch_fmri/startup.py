@@ -0,0 +1,43 @@
+"""Startup timing for the presentation scripts.
+
+Between back-to-back runs the scanner waits on script startup, so the
+scripts time their import blocks and print where the time went.
+"""
+
+import time
+from contextlib import contextmanager
+
+
+class ImportTimer(object):
+    """Time named blocks of a script's startup.
+
+        import_times = ImportTimer()
+        with import_times('psychopy'):
+            from psychopy import visual, core
+        import_times.report()
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.times = []
+
+    @contextmanager
+    def __call__(self, name):
+        t0 = self.clock()
+        try:
+            yield
+        finally:
+            self.times.append((name, self.clock() - t0))
+
+    def lines(self):
+        """One line per timed block plus their total."""
+        total = sum(seconds for name, seconds in self.times)
+        return (['{0:<16}{1:7.3f} s'.format(name, seconds)
+                 for name, seconds in self.times] +
+                ['{0:<16}{1:7.3f} s'.format('imports total', total)])
+
+    def report(self):
+        """Print the breakdown and return it as a list of lines."""
+        lines = self.lines()
+        print('\n'.join(lines))
+        return lines
@@ -0,0 +1,149 @@
+"""On-disk cache of decoded stimuli, shared by every script and run.
+
+Clips and images are decoded once into ``.rawclip`` files (see
+`sketch_fmri.rawclip`) in one cache directory, and every later load is a
+memory map. Entries are keyed by the content hash of the source file, the
+size the frames are scaled to and their pixel format, so renamed or copied
+stimuli share an entry and an edited stimulus gets a new one. The cache is
+kept under a size budget by evicting the least recently used entries.
+
+    python -m sketch_fmri.stimcache exp_1/stim exp_2/stim
+
+fills the cache before a scan session, so no run starts cold.
+"""
+
+import argparse
+import glob
+import os
+from os.path import expanduser, join, realpath
+
+import numpy as np
+
+from sketch_fmri.clipcache import file_digest
+from sketch_fmri.rawclip import EXT, decode_movie, open_rawclip, write_rawclip
+
+DEFAULT_ROOT = os.environ.get('SKETCH_FMRI_CACHE',
+                              expanduser(join('~', '.cache', 'sketch_fmri')))
+DEFAULT_BUDGET = 16 << 30
+
+# the cache at DEFAULT_ROOT, once something has used it
+_shared = None
+
+
+class StimulusCache(object):
+    """Decoded, display-ready frames of clips and images on disk.
+
+    `clip` returns the cached ``.rawclip`` of a clip and `image` the
+    memory-mapped pixels of an image, decoding the source into the cache
+    first if it is not there yet. budget is the size in bytes the cache is
+    kept under.
+    """
+
+    def __init__(self, root=DEFAULT_ROOT, budget=DEFAULT_BUDGET):
+        self.root = root
+        self.budget = budget
+        self._digests = {}
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def digest(self, path):
+        """Content hash of `path`, computed once per (path, size, mtime)."""
+        path = realpath(path)
+        st = os.stat(path)
+        stamp = (path, st.st_size, st.st_mtime)
+        if stamp not in self._digests:
+            self._digests[stamp] = file_digest(path)
+        return self._digests[stamp]
+
+    def entry(self, path, size=None, pixel_format='rgb8'):
+        """Cache file for `path` scaled to `size` in `pixel_format`."""
+        scale = 'native' if size is None else '{0}x{1}'.format(*size)
+        return join(self.root, '{0}_{1}_{2}{3}'.format(
+            self.digest(path), scale, pixel_format, EXT))
+
+    def clip(self, movie_fn, size=None):
+        """Path of the cached frames of `movie_fn`, decoding it on a miss."""
+        entry = self.entry(movie_fn, size, 'rgb8')
+        if not self._hit(entry):
+            decode_movie(movie_fn, entry, size)
+            self.evict(keep=entry)
+        return entry
+
+    def image(self, image_fn, size=None):
+        """Bottom-up (height, width, 4) uint8 memory map of `image_fn`."""
+        entry = self.entry(image_fn, size, 'rgba8')
+        if not self._hit(entry):
+            from PIL import Image
+            image = Image.open(image_fn).convert('RGBA')
+            if size is not None:
+                image = image.resize(tuple(size), Image.LANCZOS)
+            write_rawclip(entry, [np.asarray(image)], 0.)
+            self.evict(keep=entry)
+        frames, fps = open_rawclip(entry)
+        return frames[0]
+
+    def _hit(self, entry):
+        if not os.path.exists(entry):
+            return False
+        # the modification time orders entries for eviction
+        os.utime(entry)
+        return True
+
+    def entries(self):
+        """(mtime, bytes, path) of every entry, least recently used first."""
+        found = []
+        for path in glob.glob(join(self.root, '*' + EXT)):
+            st = os.stat(path)
+            found.append((st.st_mtime, st.st_size, path))
+        return sorted(found)
+
+    def evict(self, keep=None):
+        """Delete the least recently used entries until the cache fits its
+        budget, never `keep`. Returns the number of bytes freed."""
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        freed = 0
+        for mtime, size, path in entries:
+            if total - freed <= self.budget:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            freed += size
+        return freed
+
+
+def shared_cache():
+    """The `StimulusCache` at DEFAULT_ROOT, shared within the process."""
+    global _shared
+    if _shared is None:
+        _shared = StimulusCache()
+    return _shared
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('stimdirs', nargs='+',
+                        help='directories of .mov clips and .png images')
+    parser.add_argument('--root', default=DEFAULT_ROOT,
+                        help='cache directory (default %(default)s, or '
+                             '$SKETCH_FMRI_CACHE)')
+    parser.add_argument('--budget-gb', type=float,
+                        default=DEFAULT_BUDGET / float(1 << 30),
+                        help='size the cache is kept under')
+    args = parser.parse_args(argv)
+    cache = StimulusCache(args.root, int(args.budget_gb * (1 << 30)))
+    for stimdir in args.stimdirs:
+        for movie_fn in sorted(glob.glob(join(stimdir, '*.mov'))):
+            print('{0} -> {1}'.format(movie_fn, cache.clip(movie_fn)))
+        for image_fn in sorted(glob.glob(join(stimdir, '*.png'))):
+            cache.image(image_fn)
+            print('{0} -> {1}'.format(image_fn, cache.entry(image_fn, None,
+                                                           'rgba8')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Shared cache of pre-rasterized text screens.
+
+The question and instruction screens of the exp_2 scripts are a handful of
+TextStims each, and the same screen comes back many times in a run (one
+question per object pair and side, one instruction per block type). Each
+distinct screen is laid out and drawn once into a single texture, and
+every trial that shows it draws that texture, one draw call per frame. Only
+the box around the text is captured, not the whole window, so a screen
+takes a texture the size of its text.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+# pixels added around the text's box, for glyphs that overhang it
+PADDING = 4
+# where a TextStim's anchor is on its box, as a fraction of its size from
+# the left or bottom edge
+ANCHORS = {'left': 0., 'bottom': 0., 'center': .5, 'centre': .5,
+           'right': 1., 'top': 1.}
+
+
+class TextScreenCache(object):
+    """Rasterize each distinct text screen once and share it across trials.
+
+    Screens are keyed by whatever identifies their content, e.g. the texts
+    and sides of a question screen. `get` calls ``build()`` on a miss for
+    the list of stimuli making up the screen, draws them into a
+    `psychopy.visual.BufferImageStim` of the box around them (see
+    `text_box`) and keeps that; the least recently
+    used screens are dropped beyond `capacity`. The cache belongs to its
+    window, so it lasts as long as the window does, across runs of a
+    session.
+    """
+
+    def __init__(self, win, capacity=64, image_class=None):
+        if image_class is None:
+            from psychopy import visual
+            image_class = visual.BufferImageStim
+        self.win = win
+        self.capacity = capacity
+        self.image_class = image_class
+        self._screens = OrderedDict()
+
+    def __len__(self):
+        return len(self._screens)
+
+    def __contains__(self, key):
+        return key in self._screens
+
+    def get(self, key, build, name=None):
+        """Return the rasterized screen for `key`, building it on first use."""
+        screen = self._screens.get(key)
+        if screen is not None:
+            self._screens.move_to_end(key)
+            return screen
+        stims = list(build())
+        rect, pos = capture_rect(self.win, text_box(self.win, stims))
+        screen = self.image_class(self.win, stim=stims, rect=rect, pos=pos,
+                                  name=name)
+        # the capture leaves the screen in the back buffer
+        self.win.clearBuffer()
+        self._screens[key] = screen
+        while len(self._screens) > self.capacity:
+            self._screens.popitem(last=False)
+        return screen
+
+
+def text_box(win, stims, padding=PADDING):
+    """(left, bottom, right, top) in pixels from the window's centre of the
+    box around every stimulus in `stims`, or None if one of them is not a
+    TextStim anchored at a side or centre of its box (its extent is then
+    unknown, and the whole window is taken).
+    """
+    from psychopy.tools.monitorunittools import convertToPix
+
+    edges = []
+    for stim in stims:
+        # how far left and down of `pos` the box starts, in box sizes
+        left = ANCHORS.get(getattr(stim, 'anchorHoriz', None))
+        bottom = ANCHORS.get(getattr(stim, 'anchorVert', None))
+        if left is None or bottom is None or not hasattr(stim,
+                                                         'boundingBox'):
+            return None
+        width, height = stim.boundingBox
+        x, y = convertToPix(np.zeros(2), np.asarray(stim.pos, float),
+                            stim.units, win)
+        x, y = x - left * width, y - bottom * height
+        edges.append((x, y, x + width, y + height))
+    if not edges:
+        return None
+    edges = np.array(edges)
+    return (edges[:, 0].min() - padding, edges[:, 1].min() - padding,
+            edges[:, 2].max() + padding, edges[:, 3].max() + padding)
+
+
+def capture_rect(win, box):
+    """BufferImageStim's `rect` (norm units) and `pos` for a pixel `box` as
+    returned by `text_box`; the whole window if box is None."""
+    if box is None:
+        return (-1, 1, 1, -1), (0, 0)
+    half = np.asarray(win.size, float) / 2.
+    left, bottom, right, top = np.clip(np.array(box) / np.tile(half, 2),
+                                       -1, 1)
+    centre = np.array([left + right, bottom + top]) / 2.
+    # BufferImageStim takes pos in norm units in a norm window, else pixels
+    pos = centre if win.units == 'norm' else centre * half
+    return (float(left), float(top), float(right), float(bottom)), \
+        (float(pos[0]), float(pos[1]))
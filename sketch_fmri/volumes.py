@@ -0,0 +1,156 @@
+"""Scanner volume clock, estimated from the TR pulses.
+
+Every scanner trigger the input bus delivers is stored with its timestamp
+in a preallocated array, numbered with the volume it starts. A straight
+line fitted through (volume, time) as the pulses arrive gives the TR as
+measured on the presentation computer's clock, so the drift between that
+clock and the scanner's shows up as a TR a few parts per million off the
+nominal one. Onsets from the run CSV, which are in seconds of nominal TRs,
+can then be placed on the scanner's volume clock rather than on seconds
+since the first trigger, and the end of the run waits for the volumes the
+scanner is expected to acquire.
+"""
+
+from os.path import splitext
+
+import numpy as np
+from psychopy import core
+
+from sketch_fmri.waiter import shared_waiter
+
+
+class VolumeClock(object):
+    """TR pulses of a run and the volume clock fitted to them.
+
+    t0 is the time of the first trigger, volume 0, and tr the nominal TR in
+    seconds. A pulse more than `tolerance` of a TR away from where the fit
+    expects a volume to start (a stray key press, a repeated byte) is
+    counted but not used. The array doubles in size if the run turns out to
+    have more than `capacity` volumes.
+    """
+
+    def __init__(self, t0, tr, capacity=512, tolerance=.25):
+        self.t0 = t0
+        self.nominal_tr = tr
+        self.tolerance = tolerance
+        self.strays = 0
+        self._times = np.zeros(int(capacity), dtype=np.float64)
+        self._volumes = np.zeros(int(capacity), dtype=np.int32)
+        self._n = 0
+        # running sums for the least squares fit of time on volume
+        self._sums = np.zeros(5)
+        self._fit = (0., tr)
+        self.record(t0)
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def times(self):
+        return self._times[:self._n]
+
+    @property
+    def volumes(self):
+        return self._volumes[:self._n]
+
+    @property
+    def tr(self):
+        """TR fitted to the pulses so far, in seconds of this clock."""
+        return self._fit[1]
+
+    @property
+    def drift(self):
+        """How much faster the scanner's clock runs than this one, as a
+        fraction (parts per million when multiplied by 1e6)."""
+        return self.nominal_tr / self.tr - 1.
+
+    def volume_at(self, t):
+        """The volume, fractional, that starts at time `t`."""
+        offset, tr = self._fit
+        return (t - self.t0 - offset) / tr
+
+    def time_of(self, volume):
+        """Time at which `volume` (may be fractional) starts."""
+        offset, tr = self._fit
+        return self.t0 + offset + volume * tr
+
+    def time_at(self, seconds):
+        """Time of an onset `seconds` into the run, in nominal TRs."""
+        return self.time_of(seconds / self.nominal_tr)
+
+    def record(self, t):
+        """Store one trigger; returns its volume, or None for a stray."""
+        volume = int(round(self.volume_at(t)))
+        residual = t - self.time_of(volume)
+        if volume < 0 or abs(residual) > self.tolerance * self.tr or (
+                self._n and volume <= self._volumes[self._n - 1]):
+            self.strays += 1
+            return None
+        if self._n == len(self._times):
+            self._times = np.concatenate([self._times,
+                                          np.zeros_like(self._times)])
+            self._volumes = np.concatenate([self._volumes,
+                                            np.zeros_like(self._volumes)])
+        self._times[self._n] = t
+        self._volumes[self._n] = volume
+        self._n += 1
+        x, y = float(volume), t - self.t0
+        self._sums += (1., x, y, x * x, x * y)
+        self._refit()
+        return volume
+
+    def _refit(self):
+        n, sx, sy, sxx, sxy = self._sums
+        spread = n * sxx - sx * sx
+        if spread <= 0:
+            # a single volume fixes the offset, not the TR
+            self._fit = (sy / n - sx / n * self.nominal_tr, self.nominal_tr)
+            return
+        tr = (n * sxy - sx * sy) / spread
+        self._fit = ((sy - tr * sx) / n, tr)
+
+    def wait_for(self, volume, poll, interval=.05, waiter=None):
+        """Wait until `volume` starts on the fitted clock, calling poll()
+        about every `interval` seconds meanwhile so the pulses that arrive
+        keep the fit current. Waits go through `waiter`, by default the
+        shared `PrecisionWaiter`."""
+        if waiter is None:
+            waiter = shared_waiter()
+        while True:
+            now = core.getTime()
+            end = self.time_of(volume)
+            if now >= end:
+                return
+            poll()
+            waiter.wait_until(min(now + interval, end))
+
+    def residuals(self):
+        """Time of each stored pulse minus where the fit puts its volume."""
+        return self.times - self.time_of(self.volumes)
+
+    def summary(self):
+        """Text report of the pulses and the fitted volume clock."""
+        lines = ['volumes: {0} ({1} missed, {2} stray pulses)'.format(
+                     self._n, self.missed(), self.strays),
+                 'nominal TR: {0:.6f} s'.format(self.nominal_tr),
+                 'fitted TR: {0:.6f} s, drift {1:+.1f} ppm'.format(
+                     self.tr, self.drift * 1e6)]
+        if self._n > 2:
+            residuals = self.residuals() * 1000
+            lines.append('pulse jitter (ms): sd {0:.3f} max {1:.3f}'.format(
+                residuals.std(), np.abs(residuals).max()))
+        return '\n'.join(lines) + '\n'
+
+    def missed(self):
+        """Volumes between the first and the latest pulse that sent none."""
+        if not self._n:
+            return 0
+        return int(self._volumes[self._n - 1]) + 1 - self._n
+
+    def save(self, path):
+        """Save (volume, time) of the pulses to `path` (.npy) and the
+        summary beside it (.txt)."""
+        np.save(path, np.stack([self.volumes.astype(np.float64),
+                                self.times], axis=1))
+        with open(splitext(path)[0] + '.txt', 'w') as f:
+            f.write(self.summary())
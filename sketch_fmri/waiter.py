@@ -0,0 +1,111 @@
+"""Sleep-then-spin waiting with a learned spin margin.
+
+`core.wait(secs, hogCPUperiod)` spins for a fixed hogCPUperiod (0.1 to
+0.2 s) before every deadline, a full core that the decoding and prefetch
+threads could use. A `PrecisionWaiter` sleeps until shortly before the
+deadline and spins only for the last `margin`, which it learns from how
+late the OS wakes it on this machine: every sleep's overshoot is kept,
+and the margin follows a high quantile of the recent ones. How late each
+wait really ended and how long was spent spinning are kept as well.
+"""
+
+import numpy as np
+from psychopy import core
+
+# the waiter shared by everything in the process, once something has used it
+_shared = None
+
+
+class PrecisionWaiter(object):
+    """Wait for deadlines on the `core.getTime` clock.
+
+    The spin margin is the `quantile` of the last `history` sleep
+    overshoots plus `guard` seconds, and never less than `guard`; it starts
+    at `margin` until there are overshoots to learn from (see `calibrate`).
+    """
+
+    def __init__(self, margin=.002, quantile=.99, guard=.0002, history=256):
+        self.margin = margin
+        self.quantile = quantile
+        self.guard = guard
+        self.waits = 0
+        self.slept = 0.
+        self.spun = 0.
+        self._overshoots = np.zeros(history)
+        self._lateness = np.zeros(history)
+        self._n_sleeps = 0
+
+    def calibrate(self, n=50, duration=.001):
+        """Learn the margin from `n` sleeps of `duration` seconds."""
+        for i in range(n):
+            self._sleep(duration)
+        return self.margin
+
+    def _sleep(self, duration):
+        start = core.getTime()
+        core.wait(duration, hogCPUperiod=0)
+        woke = core.getTime()
+        self._overshoots[self._n_sleeps % len(self._overshoots)] = \
+            woke - start - duration
+        self._n_sleeps += 1
+        recent = self._overshoots[:min(self._n_sleeps, len(self._overshoots))]
+        self.margin = max(np.quantile(recent, self.quantile), 0.) + self.guard
+        self.slept += woke - start
+        return woke
+
+    def wait_until(self, deadline):
+        """Return at `deadline`, sleeping all but the margin before it.
+
+        Returns the time the wait ended.
+        """
+        now = core.getTime()
+        if now >= deadline:
+            # already past, nothing to measure
+            return now
+        if deadline - now > self.margin:
+            now = self._sleep(deadline - now - self.margin)
+        spin_start = now
+        while now < deadline:
+            now = core.getTime()
+        self.spun += now - spin_start
+        self._lateness[self.waits % len(self._lateness)] = now - deadline
+        self.waits += 1
+        return now
+
+    def wait(self, secs):
+        """Like `core.wait(secs)`, spinning only for the margin."""
+        return self.wait_until(core.getTime() + secs)
+
+    def overshoots(self):
+        """The recent sleep overshoots, in seconds."""
+        return self._overshoots[:min(self._n_sleeps, len(self._overshoots))]
+
+    def lateness(self):
+        """How late the recent waits ended, in seconds."""
+        return self._lateness[:min(self.waits, len(self._lateness))]
+
+    def summary(self):
+        """One line on the wake-up jitter and the time spent spinning."""
+        overshoots = self.overshoots() * 1000
+        lateness = self.lateness() * 1e6
+        line = '{0} waits, margin {1:.3f} ms, {2:.3f} s spinning'.format(
+            self.waits, self.margin * 1000, self.spun)
+        if len(overshoots):
+            line += ', sleep overshoot (ms) median {0:.3f} p99 {1:.3f} ' \
+                    'max {2:.3f}'.format(np.median(overshoots),
+                                         np.quantile(overshoots, .99),
+                                         overshoots.max())
+        if len(lateness):
+            line += ', late by (us) mean {0:.1f} max {1:.1f}'.format(
+                lateness.mean(), lateness.max())
+        return line
+
+
+def shared_waiter():
+    """The `PrecisionWaiter` shared within the process, calibrated when it
+    is first used."""
+    global _shared
+    if _shared is None:
+        _shared = PrecisionWaiter()
+        _shared.calibrate()
+    return _shared
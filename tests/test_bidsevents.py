@@ -0,0 +1,43 @@
+"""EventsWriter writing its queue out in the background."""
+
+import time
+
+import pytest
+
+from sketch_fmri.bidsevents import EventsWriter
+
+COLUMNS = ('onset', 'duration', 'trial_type', 'response')
+FORMATS = ('{:.3f}', '{:.3f}', '{}', '{}')
+
+
+def test_close_writes_every_queued_row(tmp_path):
+    path = tmp_path / 'sub-01_events.tsv'
+    writer = EventsWriter(str(path), COLUMNS, FORMATS)
+    for i in range(1000):
+        writer.put(4. + 8 * i, 6., 'photo', None if i % 2 else '1')
+    writer.close()
+
+    lines = path.read_text().splitlines()
+    assert lines[0] == 'onset\tduration\ttrial_type\tresponse'
+    assert len(lines) == 1001
+    assert lines[1] == '4.000\t6.000\tphoto\t1'
+    assert lines[-1] == '7996.000\t6.000\tphoto\tn/a'
+    assert writer._file.closed
+
+
+def test_flush_reaches_the_file_before_close(tmp_path):
+    path = tmp_path / 'sub-01_events.tsv'
+    writer = EventsWriter(str(path), COLUMNS, FORMATS)
+    writer.put(0., 0., 'button_press', '2')
+    writer.flush()
+    deadline = time.monotonic() + 5.
+    while len(path.read_text().splitlines()) < 2:
+        assert time.monotonic() < deadline, 'flush never reached the file'
+        time.sleep(.001)
+    assert path.read_text().splitlines()[1] == '0.000\t0.000\tbutton_press\t2'
+    writer.close()
+
+
+def test_one_format_per_column(tmp_path):
+    with pytest.raises(ValueError, match='one format per column'):
+        EventsWriter(str(tmp_path / 'x.tsv'), COLUMNS, FORMATS[:3])
@@ -0,0 +1,89 @@
+"""Overrun policies and correction labels of DriftCorrector."""
+
+import pytest
+
+PERIOD = .01
+
+
+class Scheduler(object):
+    """FrameScheduler on a 100 Hz grid from t = 0, with the frame the next
+    flip lands on set by the test."""
+
+    recorder = None
+
+    def __init__(self):
+        self.frame = 0
+        self.due = 1
+
+    def frame_at(self, t):
+        return int(round(t / PERIOD))
+
+    def next_frame(self):
+        return self.due
+
+
+@pytest.fixture
+def drift():
+    try:
+        from sketch_fmri import drift
+    except ImportError:
+        # without PsychoPy, on the stand-ins simulated runs use
+        from sketch_fmri.simulate import install
+        install()
+        from sketch_fmri import drift
+    return drift
+
+
+def corrector(drift, policy):
+    # 1 s trials at 0, 2 and 3 s, the last straight after the one before
+    sched = Scheduler()
+    return sched, drift.DriftCorrector(
+        sched, 0., [0., 2., 3.], [1., 1., 1.], ['photo', 'sketch', 'photo'],
+        {'sketch': 'truncate'}, default=policy)
+
+
+def play(sched, corrector, trial, late=0, overrun=0):
+    """Run `trial` starting `late` frames late and ending `overrun` frames
+    past its planned end; returns (start's result, correction)."""
+    planned = corrector.plan(trial)
+    sched.due = planned + late
+    started = corrector.start(100)
+    sched.frame = corrector.planned_end + overrun
+    return started, corrector.finish(started[0] * PERIOD)
+
+
+def test_on_time(drift):
+    sched, c = corrector(drift, 'drop_frames')
+    # an onset at 0 s is due on the first flip after the anchor
+    assert play(sched, c, 0) == ((1, 99), 'none')
+    assert c.rows[0][3:8] == (1, 1, 100, 100, 0)
+    assert not c.corrections()
+
+
+def test_late_start_drops_frames(drift):
+    sched, c = corrector(drift, 'drop_frames')
+    assert play(sched, c, 0, late=3) == ((1, 99), 'dropped_frames')
+    assert c.rows[0][7:] == (3, 0, 3, 0, 'dropped_frames')
+
+
+def test_late_end_is_dropped_frames_not_a_policy(drift):
+    sched, c = corrector(drift, 'drop_frames')
+    assert play(sched, c, 0, overrun=2)[1] == 'dropped_frames'
+    # the frames the fixation lost are still counted
+    assert c.rows[0][10] == 2
+
+
+def test_truncate_starts_late_and_cuts(drift):
+    sched, c = corrector(drift, 'drop_frames')
+    play(sched, c, 0)
+    # trial 1 ends the frame before trial 2's onset
+    assert play(sched, c, 1, late=5) == ((205, 94), 'truncated')
+    assert c.rows[1][5] == 299
+    assert c.rows[1][9] == 6
+    assert c.summary().startswith('1 of 2 trials corrected')
+
+
+def test_unknown_policy(drift):
+    with pytest.raises(ValueError, match='shorten_fixation'):
+        drift.DriftCorrector(Scheduler(), 0., [0.], [1.], ['photo'],
+                             {'photo': 'shorten_fixation'})
@@ -0,0 +1,37 @@
+"""RawMovieStim against a real PsychoPy window (skipped without one)."""
+
+import numpy as np
+import pytest
+
+visual = pytest.importorskip('psychopy.visual')
+
+from sketch_fmri.rawclip import write_rawclip
+from sketch_fmri.rawmovie import RawMovieStim
+
+TOP, BOTTOM = (200, 40, 10), (10, 90, 220)
+
+
+@pytest.fixture
+def win():
+    try:
+        win = visual.Window((128, 128), units='pix', color=(0, 0, 0),
+                            allowGUI=False)
+    except Exception as err:
+        pytest.skip('no window: {0!r}'.format(err))
+    yield win
+    win.close()
+
+
+def test_frames_reach_the_screen_unchanged(win, tmp_path):
+    frame = np.zeros((48, 64, 3), dtype=np.uint8)
+    frame[:24] = TOP
+    frame[24:] = BOTTOM
+    raw_fn = str(tmp_path / 'clip.rawclip')
+    write_rawclip(raw_fn, [frame, frame], 30.)
+
+    stim = RawMovieStim(win, raw_fn)
+    stim.draw()
+    shot = np.asarray(win.getMovieFrame(buffer='back'))[..., :3]
+    # the screenshot is top-down, the clip is centred in the window
+    assert np.abs(shot[64 - 12, 64].astype(int) - TOP).max() <= 1
+    assert np.abs(shot[64 + 12, 64].astype(int) - BOTTOM).max() <= 1
@@ -0,0 +1,71 @@
+"""The run file generator against the exp_1 notebook's code."""
+
+import numpy as np
+import pandas as pd
+
+from sketch_fmri.runfiles import (EXP1_OBJECTS, M_SEQUENCE, exp1_draw,
+                                  exp1_subject)
+
+
+def notebook_exp1(subject, sub_objects, jitter):
+    """exp_1/generate_run_files.ipynb for one subject (counting from 1),
+    with its random draws passed in: the object permutation and the jitter
+    of each run."""
+    m = list(M_SEQUENCE)
+    stim_no = np.repeat(5, 288)
+    fix_change = np.zeros(288)
+    for k in range(17):
+        k_idx = [i for i, n in enumerate(m) if n == k]
+        for q in range(4):
+            for q_idx in range(q, len(k_idx), 4):
+                stim_no[k_idx[q_idx]] = q
+        fix_change[k_idx[k]] = 1
+
+    objects_reversed = list(reversed(sub_objects))
+    sub_objects = np.insert(sub_objects, 0, 'fixation')
+    objects_reversed = np.insert(objects_reversed, 0, 'fixation')
+    if (subject - 1) % 2 == 0:
+        sketch_runs, photo_runs = range(0, 12, 2), range(1, 13, 2)
+    else:
+        sketch_runs, photo_runs = range(1, 13, 2), range(0, 12, 2)
+
+    runs = {}
+    for stim_type, order, run_numbers in (
+            ('sketch', sub_objects, sketch_runs),
+            ('photo', objects_reversed, photo_runs)):
+        trial_order = [order[i] for i in m]
+        for counter, run in enumerate(run_numbers):
+            block = slice(48 * counter, 48 * (counter + 1))
+            subDF = pd.DataFrame()
+            subDF['ObjectID'] = trial_order[block]
+            subDF['StimNo'] = stim_no[block]
+            subDF['FixChange'] = fix_change[block]
+            subDF['Onset'] = [4 + i * 8 for i in range(48)]
+            subDF['Duration'] = np.repeat(6, 48)
+            subDF['Jitter'] = pd.Series(jitter[run])
+            subDF['Repeat'] = subDF.ObjectID.eq(subDF.ObjectID.shift())
+            subDF['StimType'] = np.repeat(stim_type, 48)
+            subDF.loc[subDF['ObjectID'] == 'fixation', 'StimType'] = \
+                'fixation'
+            runs[run + 1] = subDF
+    return runs
+
+
+def test_exp1_csvs_match_the_notebook():
+    rng = np.random.default_rng(7)
+    for subject in (1, 2):
+        objects, jitter = exp1_draw(rng)
+        expected = notebook_exp1(subject, objects, jitter)
+        runs = exp1_subject(subject, objects, jitter)
+        assert sorted(runs) == sorted(expected) == list(range(1, 13))
+        for run in runs:
+            assert runs[run].to_csv() == expected[run].to_csv()
+
+
+def test_every_object_and_dim_once_per_category():
+    objects, jitter = exp1_draw(np.random.default_rng(0))
+    runs = exp1_subject(1, objects, jitter)
+    sketch = pd.concat([runs[run] for run in range(1, 13, 2)])
+    assert set(sketch['ObjectID']) == set(EXP1_OBJECTS) | {'fixation'}
+    assert (sketch.groupby('ObjectID')['FixChange'].sum() == 1).all()
+    assert ((jitter >= .3) & (jitter <= .7)).all()
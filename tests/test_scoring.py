@@ -0,0 +1,57 @@
+"""Scoring of the exp_1 tasks on a small synthetic run."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sketch_fmri.scoring import DIM_EVENT, score_trials, summarize
+
+
+def tables(dims, presses):
+    """bids and exp tables of one run: the same photo twice, a fixation
+    trial and another photo, 8 s apart."""
+    trials = [(0., 6., 'photo', 'bush', 0), (8., 6., 'photo', 'bush', 1),
+              (16., 6., 'fixation', 'fixation', 0),
+              (24., 6., 'photo', 'sun', 0)]
+    trials += [(t, 0., 'button_press', key, None) for t, key in presses]
+    bids = pd.DataFrame(trials, columns=['onset', 'duration', 'stim_type',
+                                         'stim_fn', 'repetition'])
+    exp = pd.DataFrame({'t': dims, 'message': DIM_EVENT})
+    return (bids.assign(participant=3, run=1),
+            exp.assign(participant=3, run=1))
+
+
+def task(scored, name):
+    return scored[scored['task'] == name].set_index('onset')
+
+
+def test_hits_false_alarms_and_rts():
+    bids, exp = tables(dims=[18., 25.],
+                       presses=[(9., '1'), (17., '1'), (18.5, '2'),
+                                (26., '2'), (3., '2')])
+    scored = score_trials(bids, exp)
+
+    repeat = task(scored, 'repeat')
+    assert list(repeat.index) == [0., 8., 24.]
+    assert list(repeat['target']) == [False, True, False]
+    # the press at 17 s is in the fixation trial, past trial 8's window
+    assert list(repeat['responded']) == [False, True, False]
+    assert repeat.loc[8., 'rt'] == pytest.approx(1.)
+
+    dim = task(scored, 'dim')
+    assert list(dim.index) == [0., 8., 16., 24.]
+    assert list(dim['target']) == [False, False, True, True]
+    assert list(dim['responded']) == [True, False, True, True]
+    assert dim.loc[16., 'rt'] == pytest.approx(.5)
+    assert dim.loc[24., 'rt'] == pytest.approx(1.)
+
+    study = summarize(scored, ['task'])
+    assert study.loc['dim', ['hits', 'false_alarms', 'noise']].tolist() == \
+        [2, 1, 2]
+    assert np.isfinite(study['d_prime']).all()
+
+
+def test_two_dims_in_one_trial_are_rejected():
+    bids, exp = tables(dims=[17., 19.], presses=[])
+    with pytest.raises(ValueError, match='more than one fixation dim'):
+        score_trials(bids, exp)
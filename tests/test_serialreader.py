@@ -0,0 +1,78 @@
+"""SerialReader's ring buffer across its wraparound."""
+
+import time
+
+import numpy as np
+
+from sketch_fmri.serialreader import SerialReader
+
+
+class Port(object):
+    """In-memory serial port that hands out `data` in reads of `chunk`."""
+
+    def __init__(self, data=b'', chunk=1):
+        self.data = data
+        self.chunk = chunk
+        self.timeout = None
+        self.in_waiting = 0
+        self.closed = False
+
+    def read(self, size=1):
+        if not self.data:
+            time.sleep(self.timeout or 0.)
+            return b''
+        size = max(size, self.chunk)
+        out, self.data = self.data[:size], self.data[size:]
+        return out
+
+    def close(self):
+        self.closed = True
+
+
+def test_reads_across_the_wraparound():
+    reader = SerialReader(Port(), capacity=8)
+    reader._push(1., b'12345')
+    assert reader.events()[1].tobytes() == b'12345'
+    # slots 5, 6, 7, 0, 1, 2
+    reader._push(2., b'ab')
+    reader._push(3., b'cdef')
+    assert reader.pending() == 6
+    times, codes = reader.events()
+    assert codes.tobytes() == b'abcdef'
+    assert times.tolist() == [2., 2., 3., 3., 3., 3.]
+    assert reader.pending() == 0 and reader.overruns == 0
+    assert reader.read() == b''
+
+
+def test_overrun_keeps_the_newest_bytes():
+    reader = SerialReader(Port(), capacity=8)
+    reader._push(1., b'0123456')
+    reader._push(2., b'789ab')
+    times, codes = reader.events()
+    assert codes.tobytes() == b'456789ab'
+    assert times.tolist() == [1.] * 3 + [2.] * 5
+    assert reader.overruns == 4
+
+
+def test_flush_input_skips_what_has_arrived():
+    reader = SerialReader(Port(), capacity=8)
+    reader._push(1., b'123456')
+    reader.flushInput()
+    reader._push(2., b'5t')
+    assert reader.read() == b'5t'
+
+
+def test_thread_stamps_every_byte():
+    data = b'125' * 10
+    port = Port(data, chunk=4)
+    ticks = iter(np.arange(100.))
+    reader = SerialReader(port, clock=lambda: next(ticks),
+                          timeout=.001).start()
+    while reader.pending() < len(data):
+        time.sleep(.001)
+    reader.close()
+    times, codes = reader.events()
+    assert codes.tobytes() == data
+    # one clock reading per chunk the port handed out
+    assert times.tolist() == np.repeat(np.arange(8.), 4)[:len(data)].tolist()
+    assert port.closed